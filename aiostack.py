@@ -0,0 +1,271 @@
+'''
+    aiostack.py
+    Interfaz asyncio para la pila Ethernet/ARP/IP/ICMP/UDP.
+    La recepción no usa el hilo rxThread: el descriptor de captura de pcap se pone en modo no bloqueante y se registra
+    en el bucle de eventos, que lee las tramas con pcap_dispatch cuando hay datos y las entrega al repartidor de
+    tramas del nivel Ethernet. Las operaciones que esperan una respuesta (resolución ARP, ping, recepción UDP) son
+    corrutinas que esperan a un Future, de modo que un único proceso puede tener miles de operaciones en curso
+    sin un hilo por operación.
+'''
+
+from rc1_pcap import *
+import ethernet
+import arp
+import ip
+import icmp
+import udp
+import asyncio
+import logging
+import time
+
+#Bucle de eventos que dirige la pila y descriptor de captura registrado en él (se fijan en startStack)
+eventLoop = None
+captureFd = None
+#Tareas de refresco de la caché ARP en segundo plano (se guarda una referencia para que no se destruyan)
+backgroundTasks = set()
+
+
+def onReadable():
+    #Lee todas las tramas disponibles sin bloquear y las entrega al nivel Ethernet
+    if ethernet.handle is None:
+        return
+    if pcap_dispatch(ethernet.handle,-1,ethernet.process_frame,None) == -1:
+        logging.error('[aiostack] Error en pcap_dispatch')
+
+
+def setFutureResult(future,result):
+    if not future.done():
+        future.set_result(result)
+
+
+def futureCallback(future):
+    '''
+        Devuelve una función que, llamada desde cualquier hilo, fija el resultado de future en el bucle de eventos.
+        Si se llama con un argumento ese es el resultado; si se llama con varios el resultado es la tupla.
+    '''
+    def callback(*result):
+        eventLoop.call_soon_threadsafe(setFutureResult,future,result[0] if len(result) == 1 else result)
+    return callback
+
+
+async def startStack(interface,opts=None,numWorkers=ethernet.DEFAULT_WORKERS,queueDepth=ethernet.DEFAULT_QUEUE_DEPTH,dropWhenFull=True):
+    '''
+        Nombre: startStack
+        Descripción: Esta corrutina inicializa la pila completa (Ethernet, ICMP, UDP e IP/ARP) sobre una interfaz y registra
+            el descriptor de captura en el bucle de eventos actual.
+        Argumentos:
+            -interface: nombre de la interfaz
+            -opts: opciones IP (ver initIP)
+            -numWorkers, queueDepth, dropWhenFull: parámetros del repartidor de tramas (ver startEthernetLevel). Por defecto
+                las tramas que no caben en la cola de un hilo se descartan: el reparto se hace en el hilo del bucle de
+                eventos, que no debe bloquearse esperando a que haya sitio
+        Retorno: True o False en función de si se ha inicializado la pila o no
+    '''
+    global eventLoop,captureFd
+    eventLoop = asyncio.get_running_loop()
+    if ethernet.startEthernetLevel(interface,numWorkers,queueDepth,dropWhenFull,startRxThread=False) != 0:
+        return False
+    errbuf = bytearray()
+    if pcap_setnonblock(ethernet.handle,1,errbuf) == -1:
+        logging.error('[aiostack] pcap_setnonblock: {}'.format(errbuf))
+        ethernet.stopEthernetLevel()
+        return False
+    captureFd = pcap_get_selectable_fd(ethernet.handle)
+    if captureFd < 0:
+        logging.error('[aiostack] La interfaz no tiene descriptor seleccionable')
+        captureFd = None
+        ethernet.stopEthernetLevel()
+        return False
+    eventLoop.add_reader(captureFd,onReadable)
+
+    icmp.initICMP()
+    udp.initUDP()
+    #initIP hace una resolución ARP bloqueante (ARP gratuito): se ejecuta fuera del bucle para que este siga recibiendo
+    if not await eventLoop.run_in_executor(None,ip.initIP,interface,opts):
+        stopStack()
+        return False
+    return True
+
+
+def stopStack():
+    '''
+        Nombre: stopStack
+        Descripción: Esta función retira el descriptor de captura del bucle de eventos y para el nivel Ethernet
+        Argumentos: Ninguno
+        Retorno: 0 si todo es correcto y -1 en otro caso
+    '''
+    global captureFd
+    if captureFd is not None:
+        eventLoop.remove_reader(captureFd)
+        captureFd = None
+    return ethernet.stopEthernetLevel()
+
+
+async def asyncARPResolution(ipAddr):
+    '''
+        Nombre: asyncARPResolution
+        Descripción: Versión asíncrona de ARPResolution. Consulta la caché ARP y, si no está la IP, envía las peticiones y
+            espera la respuesta sin bloquear el bucle. Comparte la tabla de resoluciones en curso con ARPResolution,
+            por lo que una resolución síncrona y otra asíncrona de la misma IP envían una sola petición.
+        Argumentos:
+            -ipAddr: entero de 32 bits con la IP a resolver
+        Retorno: Dirección MAC asociada a la IP o None si no se ha recibido respuesta
+    '''
+    state,mac = arp.cache.lookup(ipAddr)
+    if state == arp.CACHE_FRESH:
+        return mac
+    if state == arp.CACHE_STALE:
+        if ipAddr not in arp.pendingResolutions:
+            task = eventLoop.create_task(asyncResolve(ipAddr))
+            backgroundTasks.add(task)
+            task.add_done_callback(backgroundTasks.discard)
+        return mac
+    if state == arp.CACHE_NEGATIVE:
+        return None
+    mac = await asyncResolve(ipAddr)
+    if mac is None:
+        arp.arpCounters.inc('resolutions_failed')
+    return mac
+
+
+async def asyncResolve(ipAddr):
+    #Equivalente asíncrono de arp.resolve
+    pending,owner = arp.beginResolution(ipAddr)
+    future = eventLoop.create_future()
+    arp.addResolutionCallback(pending,futureCallback(future))
+    if not owner:
+        return await future
+
+    request = arp.createARPRequest(ipAddr)
+    try:
+        for i in range(arp.ARP_RETRIES):
+            ethernet.sendEthernetFrame(request,len(request),bytes([0x08,0x06]),arp.broadcastAddr)
+            arp.arpCounters.inc('requests_sent')
+            try:
+                await asyncio.wait_for(asyncio.shield(future),arp.ARP_TIMEOUT)
+                break
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        arp.finishResolution(ipAddr,pending)
+    return pending.mac
+
+
+async def asyncNextHopMAC(dstIP):
+    #Devuelve la MAC del siguiente salto hacia dstIP o None si no hay ruta o no responde
+    nextHop = ip.routingTable.nextHop(dstIP)
+    if nextHop is None:
+        ip.ipCounters.inc('tx_no_route')
+        return None
+    mac = await asyncARPResolution(nextHop)
+    if mac is None:
+        ip.ipCounters.inc('tx_no_arp')
+    return mac
+
+
+async def asyncSendIPDatagram(dstIP,data,protocol):
+    '''
+        Nombre: asyncSendIPDatagram
+        Descripción: Versión asíncrona de sendIPDatagram: la resolución ARP del siguiente salto no bloquea el bucle
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino del datagrama
+            -data: array de bytes con los datos a incluir como payload en el datagrama
+            -protocol: valor numérico del campo IP protocolo
+        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+    '''
+    dstMac = await asyncNextHopMAC(dstIP)
+    if dstMac is None:
+        return False
+    return ip.sendIPFragments(dstIP,data,protocol,dstMac)
+
+
+async def asyncPing(dstIP,data=b'',icmp_id=0,icmp_seqnum=0,timeout=1.0):
+    '''
+        Nombre: asyncPing
+        Descripción: Esta corrutina envía un ICMP ECHO_REQUEST y espera el ECHO_REPLY correspondiente
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino
+            -data: datos del mensaje de eco
+            -icmp_id: valor del campo ID de ICMP
+            -icmp_seqnum: valor del campo Seqnum de ICMP
+            -timeout: segundos de espera de la respuesta
+        Retorno: RTT en segundos (sin contar la resolución ARP) o None si no hay respuesta
+    '''
+    dstMac = await asyncNextHopMAC(dstIP)
+    if dstMac is None:
+        return None
+    future = eventLoop.create_future()
+    icmp.registerEchoReplyCallback(dstIP,icmp_id,icmp_seqnum,futureCallback(future))
+    message = icmp.buildICMPMessage(data,icmp.ICMP_ECHO_REQUEST_TYPE,0,icmp_id,icmp_seqnum)
+    try:
+        start = time.monotonic()
+        if not ip.sendIPFragments(dstIP,message,icmp.ICMP_PROTO,dstMac):
+            return None
+        icmp.icmpCounters.inc('tx_echo_requests')
+        await asyncio.wait_for(future,timeout)
+        return time.monotonic() - start
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        icmp.registerEchoReplyCallback(dstIP,icmp_id,icmp_seqnum,None)
+
+
+async def asyncSendUDPDatagram(data,dstPort,dstIP,srcPort=None):
+    '''
+        Nombre: asyncSendUDPDatagram
+        Descripción: Versión asíncrona de sendUDPDatagram
+        Argumentos:
+            -data: array de bytes con los datos del datagrama
+            -dstPort: entero de 16 bits con el puerto destino
+            -dstIP: entero de 32 bits con la IP destino
+            -srcPort: puerto origen (si es None se usa el del flujo, ver getFlowSourcePort)
+        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+    '''
+    if srcPort is None:
+        srcPort = udp.getFlowSourcePort(dstIP,dstPort)
+        if srcPort is None:
+            return False
+    if not await asyncSendIPDatagram(dstIP,udp.buildUDPDatagram(data,srcPort,dstPort),udp.UDP_PROTO):
+        return False
+    udp.udpCounters.inc('tx_datagrams')
+    return True
+
+
+class AsyncUDPSocket():
+    '''
+        Socket UDP asíncrono ligado a un puerto local (si port es None se asigna uno efímero). Los datagramas recibidos
+        en el puerto se encolan (hasta maxQueue; los que no caben se descartan y se cuentan en dropped) y se leen con recv.
+    '''
+    def __init__(self,port=None,maxQueue=1024):
+        self.queue = asyncio.Queue(maxQueue)
+        self.dropped = 0
+        self.port = udp.registerUDPPort(port,self.deliver)
+        if self.port is None:
+            if port is None:
+                raise OSError('No quedan puertos UDP efímeros libres')
+            raise OSError('El puerto UDP {} ya está en uso'.format(port))
+
+    def deliver(self,srcIP,srcPort,data):
+        #Se llama desde los hilos de procesamiento de tramas
+        eventLoop.call_soon_threadsafe(self.enqueue,(srcIP,srcPort,data))
+
+    def enqueue(self,item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def stats(self):
+        return {'port':self.port,'queued':self.queue.qsize(),'dropped':self.dropped}
+
+    async def recv(self):
+        '''
+            Devuelve una tupla (IP origen, puerto origen, datos) con el siguiente datagrama recibido
+        '''
+        return await self.queue.get()
+
+    async def sendto(self,data,dstIP,dstPort):
+        return await asyncSendUDPDatagram(data,dstPort,dstIP,self.port)
+
+    def close(self):
+        udp.registerUDPPort(self.port,None)
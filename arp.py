@@ -14,9 +14,13 @@ import struct
 import fcntl
 import time
 import binascii
-from threading import Lock
-from expiringdict import ExpiringDict
+import heapq
+import threading
+from threading import Lock,Event
 
+arpTrace = getTracer('arp')
+arpCounters = counters.getCounters('arp',('requests_received','replies_received','replies_unsolicited','replies_sent',
+    'requests_sent','resolutions_failed'))
 #Semáforo global
 globalLock =Lock()
 #Dirección de difusión (Broadcast)
@@ -26,20 +30,171 @@ ARPHeader = bytes([0x00,0x01,0x08,0x00,0x06,0x04])
 #longitud (en bytes) de la cabecera común ARP
 ARP_HLEN = 6
 
-#Variable que alamacenará que dirección IP se está intentando resolver
-requestedIP = None
-#Variable que alamacenará que dirección MAC resuelta o None si no se ha podido obtener
-resolvedMAC = None
-#Variable que alamacenará True mientras estemos esperando una respuesta ARP
-awaitingResponse = False
+#Tiempo máximo de espera (en segundos) de cada petición ARP y número máximo de peticiones por resolución
+ARP_TIMEOUT = 0.5
+ARP_RETRIES = 3
+#Resoluciones ARP en curso indexadas por IP. Se protege con globalLock
+pendingResolutions = {}
 #Variable que alamacenará My IP
 myIP = None
-#Variable para proteger la caché
-cacheLock = Lock()
-#Caché de ARP. Es un diccionario similar al estándar de Python solo que eliminará las entradas a los 10 segundos
-cache = ExpiringDict(max_len=100, max_age_seconds=10)
+#Valores por defecto de la caché ARP: número máximo de entradas, segundos durante los que una entrada es válida,
+#segundos adicionales durante los que se sirve una entrada caducada mientras se refresca y segundos durante
+#los que se recuerda que una IP no ha respondido
+ARP_CACHE_SIZE = 4096
+ARP_CACHE_TTL = 60
+ARP_CACHE_STALE_TTL = 30
+ARP_CACHE_NEGATIVE_TTL = 5
+#Resultados de una consulta a la caché
+CACHE_MISS = 0
+CACHE_FRESH = 1
+CACHE_STALE = 2
+CACHE_NEGATIVE = 3
+
+
+
+class PendingResolution():
+    '''
+        Clase que representa una resolución ARP en curso. Todos los hilos que piden la misma IP comparten
+        la misma petición y esperan el mismo evento, que processARPReply activa en cuanto llega la respuesta.
+    '''
+    def __init__(self):
+        self.event = Event()
+        self.mac = None
+        #Funciones a llamar con la MAC (o None) al terminar la resolución (ver addResolutionCallback)
+        self.callbacks = []
+
+
+class NeighborEntry():
+    '''
+        Entrada de la caché ARP. mac es None en las entradas negativas (IPs que no han respondido).
+        Las entradas no se modifican una vez insertadas (salvo lastUsed): para actualizarlas se sustituyen por otras.
+    '''
+    __slots__ = ('mac','expires','staleUntil','lastUsed')
+
+    def __init__(self,mac,expires,staleUntil,lastUsed):
+        self.mac = mac
+        self.expires = expires
+        self.staleUntil = staleUntil
+        self.lastUsed = lastUsed
 
 
+class NeighborCache():
+    '''
+        Caché ARP (tabla de vecinos) indexada por IP (entero de 32 bits).
+            -Las consultas no toman ningún Lock: leen el diccionario directamente. Solo las inserciones y
+            expulsiones se serializan con un Lock propio.
+            -Una entrada es válida durante ttl segundos. Durante los staleTtl segundos siguientes se sigue
+            sirviendo (CACHE_STALE) para que quien la consulta pueda refrescarla en segundo plano.
+            -Las IPs que no responden se guardan como entradas negativas durante negativeTtl segundos.
+            -Cuando se alcanza maxEntries se eliminan primero las entradas vencidas y, si no basta, la octava parte
+            de las entradas usadas hace más tiempo (LRU aproximado).
+        Los contadores (aciertos, fallos, expulsiones...) se incrementan sin Lock, por lo que son aproximados.
+    '''
+    def __init__(self,maxEntries=ARP_CACHE_SIZE,ttl=ARP_CACHE_TTL,staleTtl=ARP_CACHE_STALE_TTL,negativeTtl=ARP_CACHE_NEGATIVE_TTL):
+        self.entries = {}
+        self.lock = Lock()
+        self.configure(maxEntries,ttl,staleTtl,negativeTtl)
+        self.hits = 0
+        self.staleHits = 0
+        self.negativeHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def configure(self,maxEntries=None,ttl=None,staleTtl=None,negativeTtl=None):
+        if maxEntries is not None:
+            self.maxEntries = maxEntries
+        if ttl is not None:
+            self.ttl = ttl
+        if staleTtl is not None:
+            self.staleTtl = staleTtl
+        if negativeTtl is not None:
+            self.negativeTtl = negativeTtl
+
+    def lookup(self,ip):
+        '''
+            Devuelve una tupla (estado,mac) donde estado es CACHE_FRESH, CACHE_STALE, CACHE_NEGATIVE o CACHE_MISS
+        '''
+        entry = self.entries.get(ip)
+        if entry is None:
+            self.misses += 1
+            return CACHE_MISS,None
+        now = time.monotonic()
+        if now < entry.expires:
+            entry.lastUsed = now
+            if entry.mac is None:
+                self.negativeHits += 1
+                return CACHE_NEGATIVE,None
+            self.hits += 1
+            return CACHE_FRESH,entry.mac
+        if entry.mac is not None and now < entry.staleUntil:
+            entry.lastUsed = now
+            self.staleHits += 1
+            return CACHE_STALE,entry.mac
+        self.misses += 1
+        return CACHE_MISS,None
+
+    def insert(self,ip,mac):
+        now = time.monotonic()
+        self.store(ip,NeighborEntry(bytes(mac),now+self.ttl,now+self.ttl+self.staleTtl,now))
+
+    def insertNegative(self,ip):
+        now = time.monotonic()
+        self.store(ip,NeighborEntry(None,now+self.negativeTtl,now+self.negativeTtl,now))
+
+    def update(self,ip,mac):
+        #Actualiza la entrada solo si ya existe (por ejemplo al ver una petición ARP de un vecino conocido)
+        if ip in self.entries:
+            self.insert(ip,mac)
+
+    def store(self,ip,entry):
+        with self.lock:
+            if ip not in self.entries and len(self.entries) >= self.maxEntries:
+                self.evict(entry.lastUsed)
+            self.entries[ip] = entry
+
+    def evict(self,now):
+        #Se llama con self.lock tomado
+        expired = [ip for ip,e in self.entries.items() if e.staleUntil <= now]
+        for ip in expired:
+            del self.entries[ip]
+        self.expirations += len(expired)
+        if len(self.entries) >= self.maxEntries:
+            victims = heapq.nsmallest(max(1,self.maxEntries//8),self.entries.items(),key=lambda item: item[1].lastUsed)
+            for ip,e in victims:
+                del self.entries[ip]
+            self.evictions += len(victims)
+
+    def items(self):
+        #Copia de las entradas (dict.copy es atómico) para recorrerlas sin bloquear a nadie
+        return self.entries.copy().items()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'entries':len(self.entries),'hits':self.hits,'staleHits':self.staleHits,'negativeHits':self.negativeHits,
+            'misses':self.misses,'evictions':self.evictions,'expirations':self.expirations}
+
+
+#Caché de ARP
+cache = NeighborCache()
+counters.registerCollector('arp_cache',lambda: cache.stats())
+
+
+def configureARPCache(maxEntries=None,ttl=None,staleTtl=None,negativeTtl=None):
+    '''
+        Nombre: configureARPCache
+        Descripción: Esta función cambia los parámetros de la caché ARP. Los argumentos que sean None no se modifican.
+        Argumentos:
+            -maxEntries: número máximo de entradas
+            -ttl: segundos durante los que una entrada es válida
+            -staleTtl: segundos adicionales durante los que se sirve una entrada caducada mientras se refresca
+            -negativeTtl: segundos durante los que se recuerda que una IP no ha respondido
+        Retorno: Ninguno
+    '''
+    cache.configure(maxEntries,ttl,staleTtl,negativeTtl)
+
 
 def getIP(interface):
     '''
@@ -66,10 +221,16 @@ def printCache():
         Retorno: Ninguno
     '''
     print('{:>12}\t\t{:>12}'.format('IP','MAC'))
-    with cacheLock:
-        for k in cache:
-            if k in cache:
-                print ('{:>12}\t\t{:>12}'.format(socket.inet_ntoa(struct.pack('!I',k)),':'.join(['{:02X}'.format(b) for b in cache[k]])))
+    now = time.monotonic()
+    for k,entry in sorted(cache.items()):
+        if entry.staleUntil <= now:
+            continue
+        if entry.mac is None:
+            print ('{:>12}\t\t{:>12}'.format(socket.inet_ntoa(struct.pack('!I',k)),'(sin respuesta)'))
+        elif entry.expires <= now:
+            print ('{:>12}\t\t{:>12} (caducada)'.format(socket.inet_ntoa(struct.pack('!I',k)),':'.join(['{:02X}'.format(b) for b in entry.mac])))
+        else:
+            print ('{:>12}\t\t{:>12}'.format(socket.inet_ntoa(struct.pack('!I',k)),':'.join(['{:02X}'.format(b) for b in entry.mac])))
 
 
 
@@ -87,13 +248,14 @@ def processARPRequest(data,MAC):
                     -Construir una respuesta ARP llamando a createARPReply (descripción más adelante)
                     -Enviar la respuesta ARP usando el nivel Ethernet (sendEthernetFrame)
         Argumentos:
-            -data: bytearray con el contenido de la trama ARP (después de la cabecera común)
+            -data: memoryview con el contenido de la trama ARP (después de la cabecera común)
             -MAC: dirección MAC origen extraída por el nivel Ethernet
         Retorno: Ninguno
     '''
     #TODO implementar aquí
     global myIP
     #print("[processARPRequest] Processing ARP Request")
+    arpCounters.inc('requests_received')
     macOrigen = data[0:6]
 
     if macOrigen != MAC:
@@ -103,6 +265,9 @@ def processARPRequest(data,MAC):
     ipOrigen = data[6:10]
     ipDestino = data[16:20]
 
+    #Si el emisor ya está en la caché se refresca su entrada (RFC 826)
+    cache.update(struct.unpack('!I',ipOrigen)[0],macOrigen)
+
     if ipDestino != struct.pack('!I',myIP):
         #print("[processARPRequest] This request is not for me")
         return
@@ -110,6 +275,7 @@ def processARPRequest(data,MAC):
     #print("[processARPRequest] Calling createARPReply")
     reply = createARPReply(ipOrigen, macOrigen)
     sendEthernetFrame(reply,len(reply), bytes([0x08,0x06]), macOrigen)
+    arpCounters.inc('replies_sent')
 
 def processARPReply(data,MAC):
     ''' HECHO
@@ -123,20 +289,19 @@ def processARPReply(data,MAC):
             -Comprobar si la IP destino de la petición ARP es la propia IP:
                 -Si no es la propia IP retornar
                 -Si es la propia IP:
-                    -Comprobar si la IP origen se corresponde con la solicitada (requestedIP). Si no se corresponde retornar
-                    -Copiar la MAC origen a la variable global resolvedMAC
+                    -Comprobar si la IP origen tiene una resolución en curso (pendingResolutions). Si no la tiene retornar
+                    -Retirar la resolución de la tabla y guardar en ella la MAC origen
                     -Añadir a la caché ARP la asociación MAC/IP.
-                    -Cambiar el valor de la variable awaitingResponse a False
-                    -Cambiar el valor de la variable requestedIP a None
-        Las variables globales (requestedIP, awaitingResponse y resolvedMAC) son accedidas concurrentemente por la función ARPResolution y deben ser protegidas mediante un Lock.
+                    -Activar el evento de la resolución para despertar a los hilos que la esperan
+        La tabla pendingResolutions es accedida concurrentemente por la función ARPResolution y debe ser protegida mediante un Lock.
         Argumentos:
-            -data: bytearray con el contenido de la trama ARP (después de la cabecera común)
+            -data: memoryview con el contenido de la trama ARP (después de la cabecera común)
             -MAC: dirección MAC origen extraída por el nivel Ethernet
         Retorno: Ninguno
     '''
-    global requestedIP,resolvedMAC,awaitingResponse,cache
     #TODO implementar aquí
     #print("[processARPReply] Processing ARP Reply")
+    arpCounters.inc('replies_received')
     macOrigen = data[0:6]
 
     if macOrigen != MAC:
@@ -152,18 +317,18 @@ def processARPReply(data,MAC):
         #print("[processARPReply] This reply is not for me")
         return
 
+    cachekey = struct.unpack('!I',ipOrigen)[0]
+    #La MAC y la entrada de la caché se escriben con el cerrojo adquirido para que finishResolution no pueda
+    #añadir después una entrada negativa si el plazo vence a la vez
     with globalLock:
-        if struct.unpack('!I',ipOrigen)[0] != requestedIP:
-            return
-        #print("[processARPReply] Saving resolved MAC in global var")
-        resolvedMAC = macOrigen
-        awaitingResponse = False
-        requestedIP = None
-
-    with cacheLock:
-        cachekey = struct.unpack('!I',ipOrigen)[0]
-        #print("[processARPReply] Adding MAC for key", cachekey, "to cache")
-        cache[cachekey] = macOrigen
+        pending = pendingResolutions.pop(cachekey,None)
+        if pending is not None:
+            pending.mac = bytes(macOrigen)
+            cache.insert(cachekey,pending.mac)
+    if pending is None:
+        arpCounters.inc('replies_unsolicited')
+        return
+    completeResolution(pending)
 
 def createARPRequest(ip):
     '''HECHO
@@ -230,16 +395,17 @@ def process_arp_frame(us,header,data,srcMac):
         Retorno: Ninguno
     '''
     #TODO implementar aquí
-    cabecera = data[0:6]
-    opCode = data[6:8]
-    dataNew = data[8:]
+    message = ARPView(data)
+    if not message.valid():
+        return
+    opCode = message.opcode
 
-    if opCode == bytes([0x00,0x01]):
+    if opCode == 0x0001:
         #print("[process_arp_frame] opCode 0x0001. Calling processARPRequest")
-        processARPRequest(dataNew, srcMac)
-    elif opCode == bytes([0x00,0x02]):
+        processARPRequest(message.addresses, srcMac)
+    elif opCode == 0x0002:
         #print("[process_arp_frame] opCode 0x0002. Calling processARPReply")
-        processARPReply(dataNew, srcMac)
+        processARPReply(message.addresses, srcMac)
     else:
         #print("[process_arp_frame] UNKNOWN OPCODE IN FRAME" + str(opCode))
         return
@@ -249,24 +415,26 @@ def initARP(interface):
         Nombre: initARP
         Descripción: Esta función construirá inicializará el nivel ARP. Esta función debe realizar, al menos, las siguientes tareas:
             -Registrar la función del callback process_arp_frame con el Ethertype 0x0806
-            -Obtener y almacenar la dirección MAC e IP asociadas a la interfaz especificada
+            -Obtener y almacenar la dirección MAC e IP asociadas a la interfaz especificada (o las del enlace, ver getLink)
             -Realizar una petición ARP gratuita y comprobar si la IP propia ya está asignada. En caso positivo se debe devolver error.
             -Marcar la variable de nivel ARP inicializado a True
     '''
     global myIP,myMAC,arpInitialized
 
     #TODO implementar aquí
-    print("[init_arp] Initializing ARP")
+    arpTrace.log(TRACE_INFO,"[init_arp] Initializing ARP")
     arpInitialized = False
     registerCallback(process_arp_frame,  bytes([0x08,0x06]))
-    myIP = getIP(interface)
-    myMAC = getHwAddr(interface) #myMAC = bytes(binascii.hexlify(getHwAddr(interface)))
+    #Los enlaces que no son una interfaz real (link.py) llevan su propia IP
+    link = getLink()
+    myIP = link.ipAddr if link.ipAddr is not None else getIP(interface)
+    myMAC = link.mac
 
     if ARPResolution(myIP) != None:
-        print("[init_arp] Someone has my IP!!")
+        arpTrace.log(TRACE_ERROR,"[init_arp] Someone has my IP!!")
         return False
 
-    print("[init_arp] ARP initialized succesfully")
+    arpTrace.log(TRACE_INFO,"[init_arp] ARP initialized succesfully")
     arpInitialized = True
     return True
 
@@ -276,44 +444,150 @@ def ARPResolution(ip):
         Descripción: Esta función intenta realizar una resolución ARP para una IP dada y devuelve la dirección MAC asociada a dicha IP
             o None en caso de que no haya recibido respuesta. Esta función debe realizar, al menos, las siguientes tareas:
                 -Comprobar si la IP solicitada existe en la caché:
-                -Si está en caché devolver la información de la caché
-                -Si no está en la caché:
-                    -Construir una petición ARP llamando a la función createARPRequest (descripción más adelante)
-                    -Enviar dicha petición
-                    -Comprobar si se ha recibido respuesta o no:
-                        -Si no se ha recibido respuesta reenviar la petición hasta un máximo de 3 veces. Si no se recibe respuesta devolver None
+                -Si está en caché y es válida devolver la información de la caché
+                -Si está en caché pero ha caducado recientemente devolverla y refrescarla en segundo plano
+                -Si hay una entrada negativa (la IP no respondió hace poco) devolver None
+                -Si no está en la caché (la resolución se realiza en la función resolve):
+                    -Comprobar si ya hay una resolución en curso para esa IP (pendingResolutions):
+                        -Si la hay, esperar a que termine y devolver su resultado (no se envía otra petición)
+                        -Si no la hay, registrar una nueva, construir una petición ARP llamando a la función createARPRequest
+                        (descripción más adelante) y enviarla. Si no se ha recibido respuesta reenviar la petición
+                        hasta un máximo de ARP_RETRIES veces. Si no se recibe respuesta devolver None
                         -Si se ha recibido respuesta devolver la dirección MAC
-            Esta función necesitará comunicarse con el la función de recepción (para comprobar si hay respuesta y la respuesta en sí) mediante 3 variables globales:
-                -awaitingResponse: indica si está True que se espera respuesta. Si está a False quiere decir que se ha recibido respuesta
-                -requestedIP: contiene la IP por la que se está preguntando
-                -resolvedMAC: contiene la dirección MAC resuelta (en caso de que awaitingResponse) sea False.
-            Como estas variables globales se leen y escriben concurrentemente deben ser protegidas con un Lock
+            Esta función se comunica con la función de recepción mediante la tabla pendingResolutions: cada entrada tiene un evento
+            que processARPReply activa en cuanto llega la respuesta, por lo que no hay que esperar a que venza el plazo.
+            Las resoluciones de IPs distintas son independientes y pueden hacerse en paralelo.
+            Como la tabla se lee y escribe concurrentemente debe ser protegida con un Lock
     '''
-    global requestedIP,awaitingResponse,resolvedMAC
     #TODO implementar aquí
 
-    print("[ARPResolution] Who has", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',ip)) + "?"))
-    with cacheLock:
-        mac = cache.get(ip)
-        if mac != None:
-            print("[ARPResolution] Mac was cached:", ':'.join(['{:02X}'.format(b) for b in mac]))
-            return mac
+    state,mac = cache.lookup(ip)
+    if state == CACHE_FRESH:
+        if arpTrace.debug:
+            arpTrace.log(TRACE_DEBUG,"[ARPResolution] {} was cached: {}",socket.inet_ntoa(struct.pack('!I',ip)),bytes(mac).hex(':'))
+        return mac
+    if state == CACHE_STALE:
+        if arpTrace.debug:
+            arpTrace.log(TRACE_DEBUG,"[ARPResolution] {} was cached (stale, refreshing): {}",socket.inet_ntoa(struct.pack('!I',ip)),bytes(mac).hex(':'))
+        pending,owner = beginResolution(ip)
+        if owner:
+            refresh = threading.Thread(target=sendResolutionRequests,args=(ip,pending))
+            refresh.daemon = True
+            refresh.start()
+        return mac
+    if state == CACHE_NEGATIVE:
+        if arpTrace.debug:
+            arpTrace.log(TRACE_DEBUG,"[ARPResolution] {} unresolved (cached)",socket.inet_ntoa(struct.pack('!I',ip)))
+        return None
+
+    if arpTrace.debug:
+        arpTrace.log(TRACE_DEBUG,"[ARPResolution] Who has {}?",socket.inet_ntoa(struct.pack('!I',ip)))
+    mac = resolve(ip)
+    if mac is None:
+        arpCounters.inc('resolutions_failed')
+        if arpTrace.info:
+            arpTrace.log(TRACE_INFO,"[ARPResolution] {} unresolved",socket.inet_ntoa(struct.pack('!I',ip)))
+        return None
+    if arpTrace.debug:
+        arpTrace.log(TRACE_DEBUG,"[ARPResolution] Resolved MAC: {}",bytes(mac).hex(':'))
+    return mac
+
+def resolve(ip):
+    '''
+        Nombre: resolve
+        Descripción: Esta función envía peticiones ARP para una IP sin consultar la caché y espera la respuesta.
+            Si ya hay una resolución en curso para esa IP se espera a que termine en lugar de enviar otra petición.
+            Si la IP no responde se añade a la caché una entrada negativa.
+        Argumentos:
+            -ip: dirección a resolver
+        Retorno: Dirección MAC asociada a la IP o None si no se ha recibido respuesta
+    '''
+    pending,owner = beginResolution(ip)
 
-    with globalLock:
-        awaitingResponse = True
-        requestedIP = ip
+    if owner:
+        sendResolutionRequests(ip,pending)
+    else:
+        pending.event.wait(ARP_TIMEOUT*ARP_RETRIES)
 
+    return pending.mac
+
+def sendResolutionRequests(ip,pending):
+    '''
+        Nombre: sendResolutionRequests
+        Descripción: Esta función envía las peticiones ARP de una resolución registrada con beginResolution (por quien es
+            su owner) hasta recibir respuesta o agotar ARP_RETRIES, y la termina con finishResolution.
+        Argumentos:
+            -ip: dirección a resolver
+            -pending: PendingResolution devuelta por beginResolution
+        Retorno: Ninguno
+    '''
     data = createARPRequest(ip)
-    sendEthernetFrame(data, len(data), bytes([0x08,0x06]), broadcastAddr)
-
-    for i in range(3):
-        time.sleep(0.5)
-        with globalLock:
-            if awaitingResponse == True and requestedIP != None:
-                data = createARPRequest(ip)
-                sendEthernetFrame(data, len(data), bytes([0x08,0x06]), broadcastAddr)
-            else:
-                print("[ARPResolution] Resolved MAC:", ':'.join(['{:02X}'.format(b) for b in resolvedMAC]))
-                return resolvedMAC
-    print("[ARPResolution] MAC unresolved")
-    return None
+    for i in range(ARP_RETRIES):
+        sendEthernetFrame(data, len(data), bytes([0x08,0x06]), broadcastAddr)
+        arpCounters.inc('requests_sent')
+        if pending.event.wait(ARP_TIMEOUT):
+            break
+    finishResolution(ip,pending)
+
+def beginResolution(ip):
+    '''
+        Nombre: beginResolution
+        Descripción: Esta función busca la resolución en curso para una IP o registra una nueva si no la hay.
+        Argumentos:
+            -ip: dirección a resolver
+        Retorno: Tupla (PendingResolution, owner) donde owner es True si la resolución es nueva y quien llama debe enviar
+            las peticiones y llamar a finishResolution al terminar
+    '''
+    with globalLock:
+        pending = pendingResolutions.get(ip)
+        owner = pending is None
+        if owner:
+            pending = PendingResolution()
+            pendingResolutions[ip] = pending
+    return pending,owner
+
+def finishResolution(ip,pending):
+    '''
+        Nombre: finishResolution
+        Descripción: Esta función da por terminada una resolución (haya respondido la IP o no): la retira de la tabla,
+            añade una entrada negativa a la caché si no hubo respuesta y despierta a quien la esté esperando.
+        Argumentos:
+            -ip: dirección resuelta
+            -pending: PendingResolution devuelta por beginResolution
+        Retorno: Ninguno
+    '''
+    #Se decide con el cerrojo adquirido: si processARPReply ya ha guardado la MAC no se añade la entrada negativa
+    with globalLock:
+        if pendingResolutions.get(ip) is pending:
+            del pendingResolutions[ip]
+        if pending.mac is None:
+            cache.insertNegative(ip)
+    completeResolution(pending)
+
+def completeResolution(pending):
+    #Activa el evento y llama a las funciones registradas con addResolutionCallback
+    with globalLock:
+        if pending.event.is_set():
+            return
+        pending.event.set()
+        callbacks = pending.callbacks
+        pending.callbacks = []
+    for callback in callbacks:
+        callback(pending.mac)
+
+def addResolutionCallback(pending,callback):
+    '''
+        Nombre: addResolutionCallback
+        Descripción: Esta función registra una función a la que se llamará con la MAC resuelta (o None) cuando termine la
+            resolución. Si ya ha terminado se llama inmediatamente. Permite esperar una resolución sin bloquear un hilo.
+        Argumentos:
+            -pending: PendingResolution devuelta por beginResolution
+            -callback: función que recibe la MAC o None
+        Retorno: Ninguno
+    '''
+    with globalLock:
+        done = pending.event.is_set()
+        if not done:
+            pending.callbacks.append(callback)
+    if done:
+        callback(pending.mac)
@@ -0,0 +1,515 @@
+'''
+    benchmark.py
+    Pruebas de rendimiento de la pila. Cada prueba se selecciona con --test:
+        -pcap: lectura de una traza con libpcap (pcap_open_offline + pcap_loop) frente al lector mmap de rc1_pcap
+        -chksum: checksum IP (ip.chksum) frente a la suma palabra a palabra original, de 20 B a 64 KB
+        -pipeline: recepción completa (Ethernet -> ARP/IP -> ICMP/UDP y las respuestas) sin interfaz, con mezclas de
+        tráfico fijas (tormenta ARP, inundación de ECHO_REQUEST, UDP fragmentado) o con la traza indicada en --file.
+        Las tramas enviadas por la pila se recogen en un PcapTxSink (opcionalmente volcadas a --txdump).
+        -wire: dos pilas del mismo proceso unidas por un VirtualWire (link.py): ráfaga de pings y envío de datagramas
+        UDP de una a otra
+        -shard: recepción repartida entre procesos (shard.py) con 1, 2, 4... hasta --shards procesos: se clasifican las
+        tramas de la mezcla UDP fragmentado y se mide cuántas por segundo procesan entre todos los procesos
+    Si no se especifica traza se genera una sintética con el escritor PcapFileWriter.
+    Con --output los resultados se guardan en JSON para comparar versiones.
+'''
+
+from rc1_pcap import *
+from link import *
+import sys
+import os
+import argparse
+import tempfile
+import time
+import timeit
+import logging
+import json
+import platform
+import subprocess
+import tracemalloc
+import threading
+from argparse import RawTextHelpFormatter
+
+ETH_FRAME_MAX = 1514
+CHKSUM_SIZES = [20,60,576,1500,9000,65535]
+#Direcciones de la pila simulada en la prueba pipeline y número de equipos que le envían tráfico
+LOCAL_MAC = bytes([0x02,0x00,0x00,0x00,0x00,0x01])
+LOCAL_IP = 0x0a000001
+LOCAL_NETMASK = 0xffffff00
+PIPELINE_PEERS = 200
+PIPELINE_UDP_PORT = 9000
+PIPELINE_MIXES = ['arp','icmp','udp-frag']
+#Número de paquetes sobre los que se mide la memoria reservada por paquete
+ALLOC_SAMPLE = 500
+
+
+def generate_trace(fname,npackets,size):
+	'''
+		Genera una traza sintética de npackets tramas de size bytes
+	'''
+	frame = bytes(range(256))*(size//256) + bytes(range(size%256))
+	writer = PcapFileWriter(fname,DLT_EN10MB,ETH_FRAME_MAX)
+	header = pcap_pkthdr(size,size,timeval(0,0))
+	for i in range(npackets):
+		header.ts.tv_sec = i//1000
+		header.ts.tv_usec = (i%1000)*1000
+		writer.dump(header,frame)
+	writer.close()
+
+
+def time_loop(open_fun,fname):
+	'''
+		Recorre la traza abierta con open_fun y devuelve (paquetes, bytes, segundos)
+	'''
+	counters = [0,0]
+	def count(us,header,data):
+		counters[0] += 1
+		counters[1] += len(data)
+	errbuf = bytearray()
+	start = time.perf_counter()
+	handle = open_fun(fname,errbuf)
+	if handle is None:
+		logging.error('No se ha podido abrir la traza: {}'.format(errbuf))
+		return None
+	pcap_loop(handle,-1,count,None)
+	pcap_close(handle)
+	elapsed = time.perf_counter() - start
+	return counters[0],counters[1],elapsed
+
+
+def bench_pcap(args):
+	fname = args.tracefile
+	tmp = None
+	if fname is False:
+		tmp = tempfile.NamedTemporaryFile(suffix='.pcap',delete=False)
+		tmp.close()
+		fname = tmp.name
+		generate_trace(fname,args.npackets,args.size)
+	results = {}
+	try:
+		for name,open_fun in (('libpcap',pcap_open_offline),('mmap',pcap_open_offline_mmap)):
+			best = None
+			for i in range(args.repeat):
+				try:
+					ret = time_loop(open_fun,fname)
+				except OSError as e:
+					logging.error('{}: {}'.format(name,e))
+					ret = None
+				if ret is not None and (best is None or ret[2] < best[2]):
+					best = ret
+			if best is None:
+				continue
+			npkts,nbytes,elapsed = best
+			results[name] = {'packets':npkts,'bytes':nbytes,'seconds':elapsed,'pps':npkts/elapsed if elapsed else 0.0}
+	finally:
+		if tmp is not None:
+			os.unlink(fname)
+	for name,r in results.items():
+		print('{:>8}: {} paquetes en {:.4f} s -> {:.0f} paquetes/s'.format(name,r['packets'],r['seconds'],r['pps']))
+	return results
+
+
+def peer_ip(i):
+	return LOCAL_IP + 1 + i % PIPELINE_PEERS
+
+
+def peer_mac(i):
+	return bytes([0x02,0x00,0x00,0x01]) + struct.pack('!H',i % PIPELINE_PEERS)
+
+
+def build_ip_frame(src,payload,protocol,ipid,offset=0,more=False):
+	'''
+		Construye una trama Ethernet con un datagrama (o fragmento) IP dirigido a la pila simulada
+	'''
+	from ip import chksum
+	header = bytearray(struct.pack('!BBHHHBBHII',0x45,0,20 + len(payload),ipid,(offset // 8) | (0x2000 if more else 0),64,
+		protocol,0,src,LOCAL_IP))
+	header[10:12] = struct.pack('<H',chksum(header))
+	srcIndex = src - LOCAL_IP - 1
+	return bytearray(LOCAL_MAC + peer_mac(srcIndex) + b'\x08\x00') + header + payload
+
+
+def build_mix(mix,npackets,size):
+	'''
+		Genera las tramas de una mezcla de tráfico:
+			-arp: peticiones ARP de PIPELINE_PEERS equipos preguntando por la IP local
+			-icmp: ECHO_REQUEST de size bytes de datos (la pila contesta cada una)
+			-udp-frag: datagramas UDP de 4000 bytes fragmentados a MTU 1500 hacia un endpoint ligado
+	'''
+	from icmp import buildICMPMessage,ICMP_ECHO_REQUEST_TYPE
+	frames = []
+	if mix == 'arp':
+		for i in range(npackets):
+			arpData = bytes([0x00,0x01,0x08,0x00,0x06,0x04,0x00,0x01]) + peer_mac(i) + struct.pack('!I',peer_ip(i)) + bytes(6) + \
+				struct.pack('!I',LOCAL_IP)
+			frames.append(bytearray(bytes([0xff]*6) + peer_mac(i) + b'\x08\x06' + arpData))
+	elif mix == 'icmp':
+		payload = bytes(range(256))*(size//256) + bytes(range(size%256))
+		for i in range(npackets):
+			message = buildICMPMessage(payload,ICMP_ECHO_REQUEST_TYPE,0,i % PIPELINE_PEERS,i & 0xffff)
+			frames.append(build_ip_frame(peer_ip(i),message,1,i & 0xffff))
+	elif mix == 'udp-frag':
+		data = bytes(4000)
+		datagram = struct.pack('!HHHH',5000,PIPELINE_UDP_PORT,8 + len(data),0) + data
+		fragSize = 1480
+		i = 0
+		while len(frames) < npackets:
+			for offset in range(0,len(datagram),fragSize):
+				chunk = datagram[offset:offset + fragSize]
+				frames.append(build_ip_frame(peer_ip(i),chunk,17,i & 0xffff,offset,offset + fragSize < len(datagram)))
+			i += 1
+	return frames
+
+
+def setup_offline_stack(link):
+	'''
+		Inicializa Ethernet/ARP/IP/ICMP/UDP sin interfaz: las tramas se entregan llamando a process_Ethernet_frame y
+		las que envía la pila llegan a link (PcapFileLink, que las deja en link.sink). Devuelve el endpoint UDP de la
+		mezcla udp-frag.
+	'''
+	import ethernet,arp,ip,icmp,udp,tracing
+	tracing.setTraceLevel(None,tracing.TRACE_ERROR)
+	ethernet.macAddress = LOCAL_MAC
+	ethernet.link = link
+	ethernet.handle = None
+	ethernet.headerTemplates.clear()
+	ethernet.upperProtos.clear()
+	arp.myIP = LOCAL_IP
+	arp.myMAC = LOCAL_MAC
+	arp.configureARPCache(maxEntries=4*PIPELINE_PEERS)
+	ethernet.registerCallback(arp.process_arp_frame,bytes([0x08,0x06]))
+	ip.myIP = LOCAL_IP
+	ip.MTU = 1500
+	ip.netmask = LOCAL_NETMASK
+	ip.ipOpts = None
+	ip.routingTable.clear()
+	ip.routingTable.addRoute(LOCAL_IP & LOCAL_NETMASK,bin(LOCAL_NETMASK).count('1'))
+	ethernet.registerCallback(ip.process_IP_datagram,bytes([0x08,0x00]))
+	ip.protocols.clear()
+	icmp.initICMP()
+	udp.initUDP()
+	for i in range(PIPELINE_PEERS):
+		arp.cache.insert(peer_ip(i),peer_mac(i))
+	endpoint = udp.udpEndpoints.get(PIPELINE_UDP_PORT)
+	if endpoint is None:
+		endpoint = udp.bindUDPEndpoint(PIPELINE_UDP_PORT,1 << 16)
+	return endpoint
+
+
+def run_frames(frames,endpoint,header):
+	from ethernet import process_Ethernet_frame
+	for i,frame in enumerate(frames):
+		process_Ethernet_frame(None,header,frame)
+		if i & 0xff == 0:
+			endpoint.recv_many(1 << 16,0)
+	endpoint.recv_many(1 << 16,0)
+
+
+class LayerTimer():
+	'''
+		Sustituye los puntos de entrada de cada nivel por envoltorios que acumulan su tiempo (inclusivo). El tiempo
+		propio de cada nivel es el inclusivo menos el de los niveles a los que llama.
+	'''
+	def __init__(self):
+		import ethernet,arp,ip,icmp,udp
+		self.modules = (ethernet,arp,ip,icmp,udp)
+		self.ns = dict.fromkeys(('arp','ip','icmp','udp','arp_tx','icmp_tx'),0)
+		self.saved = []
+
+	def wrap(self,name,fun):
+		ns = self.ns
+		clock = time.perf_counter_ns
+		def timed(*args):
+			start = clock()
+			try:
+				return fun(*args)
+			finally:
+				ns[name] += clock() - start
+		return timed
+
+	def install(self):
+		ethernet,arp,ip,icmp,udp = self.modules
+		self.saved = [(ethernet.upperProtos,dict(ethernet.upperProtos)),(ip.protocols,dict(ip.protocols))]
+		ethernet.upperProtos[ethernet.ETHERTYPE_ARP] = self.wrap('arp',ethernet.upperProtos[ethernet.ETHERTYPE_ARP])
+		ethernet.upperProtos[ethernet.ETHERTYPE_IP] = self.wrap('ip',ethernet.upperProtos[ethernet.ETHERTYPE_IP])
+		ip.protocols[1] = self.wrap('icmp',ip.protocols[1])
+		ip.protocols[17] = self.wrap('udp',ip.protocols[17])
+		self.savedTx = (arp.sendEthernetFrame,icmp.sendIPDatagram)
+		arp.sendEthernetFrame = self.wrap('arp_tx',arp.sendEthernetFrame)
+		icmp.sendIPDatagram = self.wrap('icmp_tx',icmp.sendIPDatagram)
+
+	def uninstall(self):
+		ethernet,arp,ip,icmp,udp = self.modules
+		for table,saved in self.saved:
+			table.clear()
+			table.update(saved)
+		arp.sendEthernetFrame,icmp.sendIPDatagram = self.savedTx
+
+	def exclusive(self,total):
+		ns = self.ns
+		return {'eth':total - ns['arp'] - ns['ip'],'arp':ns['arp'] - ns['arp_tx'],'ip':ns['ip'] - ns['icmp'] - ns['udp'],
+			'icmp':ns['icmp'] - ns['icmp_tx'],'udp':ns['udp'],'tx':ns['arp_tx'] + ns['icmp_tx']}
+
+
+def measure_allocations(frames,endpoint,header):
+	'''
+		Devuelve (bytes, bloques) reservados por paquete. bytes es el pico de memoria temporal de cada paquete (CPython no
+		cuenta reservas, así que se usa el pico de tracemalloc) y bloques es el número de bloques que siguen vivos
+		después de procesar el paquete (crecimiento de cachés o fugas)
+	'''
+	from ethernet import process_Ethernet_frame
+	sample = frames[:ALLOC_SAMPLE]
+	tracemalloc.start()
+	peak = 0
+	startBlocks = sys.getallocatedblocks()
+	for frame in sample:
+		tracemalloc.reset_peak()
+		current = tracemalloc.get_traced_memory()[0]
+		process_Ethernet_frame(None,header,frame)
+		peak += tracemalloc.get_traced_memory()[1] - current
+	endpoint.recv_many(1 << 16,0)
+	blocks = sys.getallocatedblocks() - startBlocks
+	tracemalloc.stop()
+	return peak / len(sample),blocks / len(sample)
+
+
+def bench_pipeline(args):
+	import counters
+	#Solo se vuelcan las tramas enviadas en la primera pasada de cada mezcla
+	dumper = pcap_dump_open_file(args.txdump) if args.txdump else None
+	link = PcapFileLink(LOCAL_MAC)
+	sink = link.sink
+	endpoint = setup_offline_stack(link)
+	header = pcap_pkthdr(0,0,timeval(0,0))
+	if args.tracefile is not False:
+		errbuf = bytearray()
+		reader = pcap_open_offline_mmap(args.tracefile,errbuf)
+		if reader is None:
+			logging.error('No se ha podido abrir la traza: {}'.format(errbuf))
+			return None
+		mixes = {os.path.basename(args.tracefile):[bytearray(frame) for h,frame in reader]}
+		reader.close()
+	else:
+		mixes = {mix:build_mix(mix,args.npackets,args.size) for mix in PIPELINE_MIXES}
+
+	results = {}
+	for name,frames in mixes.items():
+		npkts = len(frames)
+		if npkts == 0:
+			continue
+		#Tiempo total: la mejor de args.repeat pasadas sin instrumentar
+		best = None
+		for i in range(args.repeat):
+			sink.reset()
+			sink.dumper = dumper if i == 0 else None
+			counters.resetCounters()
+			start = time.perf_counter_ns()
+			run_frames(frames,endpoint,header)
+			elapsed = time.perf_counter_ns() - start
+			if best is None or elapsed < best:
+				best = elapsed
+		txPackets = sink.packets
+		sink.dumper = None
+		stats = counters.snapshot()
+		#Reparto por niveles: una pasada con los envoltorios de LayerTimer
+		timer = LayerTimer()
+		timer.install()
+		try:
+			start = time.perf_counter_ns()
+			run_frames(frames,endpoint,header)
+			total = time.perf_counter_ns() - start
+		finally:
+			timer.uninstall()
+		layers = {layer:ns / npkts for layer,ns in timer.exclusive(total).items()}
+		allocBytes,allocBlocks = measure_allocations(frames,endpoint,header)
+		results[name] = {'packets':npkts,'seconds':best / 1e9,'pps':npkts * 1e9 / best,'ns_per_packet':best / npkts,
+			'tx_packets':txPackets,'layer_ns_per_packet':layers,'alloc_bytes_per_packet':allocBytes,
+			'retained_blocks_per_packet':allocBlocks,'counters':{k:stats[k] for k in ('eth','arp','ip','icmp','udp')}}
+		print('{:>10}: {} paquetes, {:.0f} paquetes/s, {:.0f} ns/paquete, {} enviados, {:.0f} B/paquete'.format(name,npkts,
+			npkts * 1e9 / best,best / npkts,txPackets,allocBytes))
+		print('{:>10}  '.format('') + '  '.join('{} {:.0f} ns'.format(layer,ns) for layer,ns in layers.items()))
+	if dumper is not None:
+		pcap_dump_close(dumper)
+	return results
+
+
+def bench_wire(args):
+	import tracing
+	tracing.setTraceLevel(None,tracing.TRACE_ERROR)
+	wire = VirtualWire()
+	stacks = []
+	for i in range(2):
+		stack = loadStackInstance()
+		name = 'veth{}'.format(i)
+		port = VirtualLink(wire,bytes([0x02,0x00,0x00,0x00,0x10,i + 1]),LOCAL_IP + i,LOCAL_NETMASK)
+		if stack.ethernet.startEthernetLevel(name,backend=port) != 0 or not stack.ip.initIP(name):
+			logging.error('No se ha podido inicializar la pila {}'.format(name))
+			return None
+		stack.icmp.initICMP()
+		stack.udp.initUDP()
+		stacks.append((stack,port))
+	(a,portA),(b,portB) = stacks
+	results = {}
+	try:
+		payload = bytes(max(8,args.size))
+		engine = a.icmp.PingEngine(LOCAL_IP + 1,args.npackets,0,len(payload),1.0,1,64)
+		start = time.perf_counter()
+		results['ping'] = engine.run()
+		results['ping']['pps'] = engine.received / (time.perf_counter() - start)
+		print('ping: {} enviados, {} recibidos, {:.0f} respuestas/s'.format(engine.sent,engine.received,results['ping']['pps']))
+		if engine.received:
+			print('      RTT (us) min/avg/max = {:.1f}/{:.1f}/{:.1f}  p50 {:.1f}  p99 {:.1f}'.format(results['ping']['min'],results['ping']['avg'],
+				results['ping']['max'],results['ping']['p50'],results['ping']['p99']))
+
+		receiver = b.udp.bindUDPEndpoint(PIPELINE_UDP_PORT,1 << 16)
+		sender = a.udp.bindUDPEndpoint()
+		received = [0,0]
+		def drain():
+			while received[0] < args.npackets:
+				batch = receiver.recv_many(1024,1.0)
+				if not batch:
+					return
+				received[0] += len(batch)
+				received[1] += sum(len(d[2]) for d in batch)
+		t = threading.Thread(target=drain)
+		t.start()
+		start = time.perf_counter()
+		for i in range(args.npackets):
+			sender.sendto(payload,LOCAL_IP + 1,PIPELINE_UDP_PORT)
+		t.join()
+		elapsed = time.perf_counter() - start
+		results['udp'] = {'sent':args.npackets,'received':received[0],'seconds':elapsed,'pps':received[0] / elapsed,
+			'mbps':received[1] * 8 / elapsed / 1e6,'linkDrops':portB.dropped,'endpointDrops':receiver.dropped}
+		print('udp: {} enviados, {} recibidos en {:.3f} s, {:.0f} datagramas/s, {:.1f} Mbit/s, {} descartes en el enlace'.format(
+			args.npackets,received[0],elapsed,results['udp']['pps'],results['udp']['mbps'],portB.dropped))
+	finally:
+		for stack,port in stacks:
+			stack.ethernet.stopEthernetLevel()
+	return results
+
+
+def shard_setup(index):
+	#Se ejecuta en cada proceso de la prueba shard: liga el endpoint de la mezcla y cuenta los datagramas recibidos
+	import udp
+	endpoint = udp.bindUDPEndpoint(PIPELINE_UDP_PORT,1 << 16)
+	received = [0]
+	def collect():
+		received[0] += len(endpoint.recv_many(1 << 16,0))
+		return {'received':received[0]}
+	return collect
+
+
+def bench_shard(args):
+	import shard
+	frames = build_mix('udp-frag',args.npackets,args.size)
+	header = pcap_pkthdr(0,0,timeval(0,0))
+	results = {}
+	nshards = 1
+	while nshards <= args.shards:
+		link = PcapFileLink(LOCAL_MAC,ipAddr=LOCAL_IP,netmask=LOCAL_NETMASK)
+		stack = shard.ShardedStack(link,'bench',nshards,setup=shard_setup,statsInterval=0.05)
+		if not stack.start():
+			logging.error('No se ha podido arrancar la pila con {} procesos'.format(nshards))
+			return None
+		try:
+			base = stack.stats()['total'].get('eth',{}).get('rx_frames',0)
+			start = time.perf_counter()
+			for frame in frames:
+				header.len = header.caplen = len(frame)
+				stack.classify(None,header,frame)
+			classified = time.perf_counter() - start
+			while stack.stats()['total'].get('eth',{}).get('rx_frames',0) - base < len(frames):
+				time.sleep(0.01)
+			elapsed = time.perf_counter() - start
+			stats = stack.stats()
+		finally:
+			stack.stop()
+		results[str(nshards)] = {'frames':len(frames),'seconds':elapsed,'fps':len(frames) / elapsed,
+			'classify_fps':len(frames) / classified,'per_shard':[s['eth']['rx_frames'] for s in stats['shards']],
+			'datagrams':stats['total']['udp']['rx_datagrams']}
+		print('{:>2} procesos: {} tramas en {:.3f} s, {:.0f} tramas/s (clasificación {:.0f} tramas/s), reparto {}'.format(nshards,
+			len(frames),elapsed,len(frames) / elapsed,len(frames) / classified,results[str(nshards)]['per_shard']))
+		nshards *= 2
+	return results
+
+
+def git_version():
+	try:
+		return subprocess.run(['git','describe','--always','--dirty'],cwd=os.path.dirname(os.path.abspath(__file__)),
+			capture_output=True,text=True,timeout=5).stdout.strip() or None
+	except (OSError,subprocess.SubprocessError):
+		return None
+
+
+def chksum_reference(msg):
+	'''
+		Suma palabra a palabra original de ip.chksum. Se usa como referencia de rendimiento y de resultados
+	'''
+	s = 0
+	for i in range(0, len(msg), 2):
+		if (i+1) < len(msg):
+			a = msg[i]
+			b = msg[i+1]
+			s = s + (a+(b << 8))
+		elif (i+1)==len(msg):
+			s += msg[i]
+	while s >> 16:
+		s = (s & 0xffff) + (s >> 16)
+	return ~s & 0xffff
+
+
+def bench_chksum(args):
+	from ip import chksum,chksum_update_bytes
+	results = {}
+	for size in CHKSUM_SIZES:
+		msg = bytes((i*7+3) & 0xff for i in range(size))
+		if chksum(msg) != chksum_reference(msg):
+			logging.error('Resultado distinto para {} bytes'.format(size))
+		number = max(1,200000//size)
+		ref = min(timeit.repeat(lambda: chksum_reference(msg),number=max(1,number//10),repeat=args.repeat))/max(1,number//10)
+		new = min(timeit.repeat(lambda: chksum(msg),number=number,repeat=args.repeat))/number
+		results[str(size)] = {'reference_ns':ref*1e9,'chksum_ns':new*1e9}
+		print('{:>6} B: referencia {:>12.0f} ns  chksum {:>9.0f} ns  (x{:.1f})'.format(size,ref*1e9,new*1e9,ref/new if new else 0))
+	header = bytearray(msg[:20])
+	c = chksum(header)
+	number = 200000
+	inc = min(timeit.repeat(lambda: chksum_update_bytes(c,header[8:10],b'\x3f\x01'),number=number,repeat=args.repeat))/number
+	results['update'] = {'chksum_update_ns':inc*1e9}
+	print('actualización incremental (RFC 1624): {:.0f} ns'.format(inc*1e9))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Pruebas de rendimiento de la pila de protocolos',
+	formatter_class=RawTextHelpFormatter)
+	parser.add_argument('--test', dest='test', default='pcap', choices=['pcap','chksum','pipeline','wire','shard'],help='Prueba a ejecutar')
+	parser.add_argument('--file', dest='tracefile', default=False,help='Fichero pcap a leer (por defecto se genera uno sintético)')
+	parser.add_argument('--npackets', dest='npackets', type=int, default=100000,help='Número de paquetes de la traza sintética')
+	parser.add_argument('--size', dest='size', type=int, default=512,help='Tamaño de las tramas de la traza sintética')
+	parser.add_argument('--repeat', dest='repeat', type=int, default=3,help='Repeticiones de cada medida (se toma la mejor)')
+	parser.add_argument('--shards', dest='shards', type=int, default=os.cpu_count() or 1,help='Número máximo de procesos (prueba shard)')
+	parser.add_argument('--txdump', dest='txdump', default=False,help='Fichero pcap donde volcar las tramas enviadas (prueba pipeline)')
+	parser.add_argument('--output', dest='output', default=False,help='Fichero JSON donde guardar los resultados')
+	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
+	args = parser.parse_args()
+
+	if args.debug:
+		logging.basicConfig(level = logging.DEBUG, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+	else:
+		logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+	if args.test == 'pcap':
+		results = bench_pcap(args)
+	elif args.test == 'chksum':
+		results = bench_chksum(args)
+	elif args.test == 'pipeline':
+		results = bench_pipeline(args)
+	elif args.test == 'wire':
+		results = bench_wire(args)
+	elif args.test == 'shard':
+		results = bench_shard(args)
+
+	if args.output:
+		with open(args.output,'w') as f:
+			json.dump({'test':args.test,'version':git_version(),'python':platform.python_version(),'time':int(time.time()),
+				'npackets':args.npackets,'size':args.size,'results':results},f,indent=2,sort_keys=True)
@@ -0,0 +1,230 @@
+'''
+    counters.py
+    Contadores de la pila por nivel y consulta conjunta de todas las estadísticas.
+    Cada nivel crea un CounterSet con getCounters. Los contadores se guardan en un diccionario por hilo, de modo que
+    inc no usa cerrojos ni se pierden incrementos entre los hilos de procesamiento de tramas; snapshot suma las copias
+    de todos los hilos. Las estructuras que ya llevan sus propios contadores (repartidor de tramas, caché ARP,
+    reensamblador...) se añaden con registerCollector.
+    exportStats escribe la instantánea en un fichero con el formato de texto de Prometheus y startStatsExporter
+    lo hace periódicamente en un hilo aparte.
+'''
+
+import itertools
+import logging
+import os
+import threading
+import time
+import weakref
+
+#Prefijo de las métricas exportadas
+STATS_PREFIX = 'rc1'
+#Periodo por defecto (en segundos) de la exportación periódica
+STATS_EXPORT_INTERVAL = 10
+
+counterSets = {}
+collectors = {}
+registryLock = threading.Lock()
+exporterThread = None
+exporterStop = None
+
+
+class ShardOwner():
+    #Objeto centinela guardado en el threading.local de cada hilo: desaparece cuando termina el hilo
+    __slots__ = ('__weakref__',)
+
+
+class CounterSet():
+    '''
+        Conjunto de contadores de un nivel. Cada hilo incrementa su propia copia (shard) y snapshot las suma. Cuando un
+        hilo termina su copia se suma a retired y se descarta, de modo que los hilos de corta duración (refrescos ARP,
+        ejecutores...) no acumulan copias.
+    '''
+    def __init__(self,layer,names):
+        self.layer = layer
+        self.names = tuple(names)
+        self.local = threading.local()
+        self.shards = {}
+        self.retired = dict.fromkeys(self.names,0)
+        self.shardKeys = itertools.count()
+        self.lock = threading.Lock()
+
+    def newShard(self):
+        shard = dict.fromkeys(self.names,0)
+        key = next(self.shardKeys)
+        owner = ShardOwner()
+        with self.lock:
+            self.shards[key] = shard
+        weakref.finalize(owner,self.retireShard,key)
+        self.local.owner = owner
+        self.local.shard = shard
+        return shard
+
+    def retireShard(self,key):
+        #Se llama al terminar el hilo dueño de la copia (ya nadie la incrementa)
+        with self.lock:
+            shard = self.shards.pop(key,None)
+            if shard is not None:
+                for name,value in shard.items():
+                    self.retired[name] += value
+
+    def inc(self,name,n=1):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.newShard()
+        shard[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            total = dict(self.retired)
+            shards = list(self.shards.values())
+        for shard in shards:
+            for name,value in shard.items():
+                total[name] += value
+        return total
+
+    def reset(self):
+        with self.lock:
+            for shard in self.shards.values():
+                for name in shard:
+                    shard[name] = 0
+            for name in self.retired:
+                self.retired[name] = 0
+
+
+def getCounters(layer,names):
+    '''
+        Nombre: getCounters
+        Descripción: Esta función devuelve el CounterSet de un nivel (lo crea la primera vez)
+        Argumentos:
+            -layer: nombre del nivel ('eth', 'arp', 'ip', 'icmp', 'udp', ...)
+            -names: nombres de los contadores del nivel
+        Retorno: CounterSet del nivel
+    '''
+    with registryLock:
+        counters = counterSets.get(layer)
+        if counters is None:
+            counters = CounterSet(layer,names)
+            counterSets[layer] = counters
+    return counters
+
+
+def registerCollector(name,collector):
+    '''
+        Nombre: registerCollector
+        Descripción: Esta función registra una función sin argumentos que devuelve un diccionario nombre -> valor numérico
+        y que se incluirá en snapshot con el nombre indicado. Si collector es None se elimina el registro.
+        Argumentos:
+            -name: nombre del grupo de estadísticas (por ejemplo 'eth_dispatcher')
+            -collector: función que devuelve las estadísticas
+        Retorno: Ninguno
+    '''
+    with registryLock:
+        if collector is None:
+            collectors.pop(name,None)
+        else:
+            collectors[name] = collector
+
+
+def snapshot():
+    '''
+        Nombre: snapshot
+        Descripción: Esta función devuelve una instantánea de todos los contadores y estadísticas registrados
+        Argumentos: Ninguno
+        Retorno: Diccionario grupo -> {nombre: valor}
+    '''
+    with registryLock:
+        sets = list(counterSets.items())
+        funcs = list(collectors.items())
+    result = {}
+    for layer,counters in sets:
+        result[layer] = counters.snapshot()
+    for name,collector in funcs:
+        try:
+            result[name] = collector()
+        except Exception:
+            logging.exception('Error obteniendo las estadísticas de {}'.format(name))
+    return result
+
+
+def resetCounters():
+    with registryLock:
+        sets = list(counterSets.values())
+    for counters in sets:
+        counters.reset()
+
+
+def formatStats(stats=None):
+    '''
+        Nombre: formatStats
+        Descripción: Esta función convierte una instantánea en el formato de texto de Prometheus. Los contadores de los
+        CounterSet se declaran como counter y el resto de estadísticas como gauge.
+        Argumentos:
+            -stats: instantánea a convertir (por defecto se toma una con snapshot)
+        Retorno: Cadena con las métricas
+    '''
+    if stats is None:
+        stats = snapshot()
+    lines = []
+    for group in sorted(stats):
+        kind = 'counter' if group in counterSets else 'gauge'
+        for name,value in sorted(stats[group].items()):
+            if isinstance(value,bool) or not isinstance(value,(int,float)):
+                continue
+            metric = '{}_{}_{}'.format(STATS_PREFIX,group,name)
+            lines.append('# TYPE {} {}'.format(metric,kind))
+            lines.append('{} {}'.format(metric,value))
+    return '\n'.join(lines) + '\n'
+
+
+def exportStats(path):
+    '''
+        Nombre: exportStats
+        Descripción: Esta función escribe una instantánea de las estadísticas en path. Se escribe en un fichero temporal
+        que después se renombra, de modo que quien lea el fichero nunca ve una exportación a medias.
+        Argumentos:
+            -path: ruta del fichero
+        Retorno: Ninguno
+    '''
+    tmp = '{}.tmp'.format(path)
+    with open(tmp,'w') as f:
+        f.write('# {}\n'.format(int(time.time())))
+        f.write(formatStats())
+    os.replace(tmp,path)
+
+
+def exporterLoop(path,interval,stop):
+    while not stop.wait(interval):
+        try:
+            exportStats(path)
+        except OSError as e:
+            logging.error('Error exportando estadísticas a {}: {}'.format(path,e))
+
+
+def startStatsExporter(path,interval=STATS_EXPORT_INTERVAL):
+    '''
+        Nombre: startStatsExporter
+        Descripción: Esta función arranca un hilo que exporta las estadísticas a path cada interval segundos
+        Argumentos:
+            -path: ruta del fichero
+            -interval: periodo de exportación en segundos
+        Retorno: True si se ha arrancado y False si ya había un exportador en marcha
+    '''
+    global exporterThread,exporterStop
+    if exporterThread is not None:
+        return False
+    exporterStop = threading.Event()
+    exporterThread = threading.Thread(target=exporterLoop,args=(path,interval,exporterStop))
+    exporterThread.daemon = True
+    exporterThread.start()
+    return True
+
+
+def stopStatsExporter():
+    global exporterThread,exporterStop
+    if exporterThread is None:
+        return
+    exporterStop.set()
+    exporterThread.join(1)
+    exporterThread = None
+    exporterStop = None
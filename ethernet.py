@@ -6,25 +6,75 @@
 '''
 
 from rc1_pcap import *
+from tracing import *
+from link import *
+from views import *
+import counters
 import logging
 import socket
 import struct
 from binascii import hexlify
 import struct
 import threading
+import queue
+
+ethTrace = getTracer('eth')
 #Tamaño máximo de una trama Ethernet (para las prácticas)
 ETH_FRAME_MAX = 1514
 #Tamaño mínimo de una trama Ethernet
 ETH_FRAME_MIN = 60
+#Tamaño de la cabecera Ethernet
+ETH_HLEN = 14
 PROMISC = 1
 NO_PROMISC = 0
 TO_MS = 10
+#Precisión y tipo de las marcas de tiempo que se piden al abrir la interfaz (ver pcap_open_live_tstamp). Con
+#TSTAMP_TYPE = PCAP_TSTAMP_ADAPTER se usan las marcas hardware de la tarjeta si las tiene
+TSTAMP_PRECISION = PCAP_TSTAMP_PRECISION_NANO
+TSTAMP_TYPE = None
 #Dirección de difusión (Broadcast)
 broadcastAddr = bytes([0xFF]*6)
+#Ethertypes de IP y ARP
+ETHERTYPE_IP = 0x0800
+ETHERTYPE_ARP = 0x0806
+#Número de hilos de procesamiento de tramas y tamaño de la cola de cada uno por defecto
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_DEPTH = 1024
+#Espera máxima (en segundos) del hilo de recepción a que haya sitio en una cola llena con dropWhenFull=False
+QUEUE_PUT_TIMEOUT = 0.05
 #Diccionario que alamacena para un Ethertype dado qué función de callback se debe ejecutar
 upperProtos = {}
 levelInitialized = False
 macAddress = None
+#Backend de enlace (ver link.py) y descriptor de pcap asociado si lo hay
+link = None
+handle = None
+#Si es True se instala en el enlace un filtro BPF que solo deja pasar las tramas dirigidas a la MAC propia o a broadcast
+#con un Ethertype registrado, de modo que el resto se descarta en el kernel sin copiarse al proceso
+KERNEL_FILTER = True
+#Repartidor de tramas entre los hilos de procesamiento (se crea en startEthernetLevel)
+dispatcher = None
+#Cabeceras Ethernet (14 bytes) ya construidas para cada par (MAC destino, Ethertype)
+headerTemplates = {}
+MAX_HEADER_TEMPLATES = 4096
+#Buffer de transmisión de cada hilo. Se reserva una vez y se reutiliza en cada envío
+txBuffers = threading.local()
+#Bytes de relleno para tramas de tamaño inferior al mínimo
+padding = bytes(ETH_FRAME_MIN)
+#Contadores del nivel Ethernet
+ethCounters = counters.getCounters('eth',('rx_frames','rx_bytes','rx_not_for_us','rx_unknown_ethertype',
+    'tx_frames','tx_bytes','tx_errors'))
+counters.registerCollector('eth_dispatcher',lambda: dispatcher.stats() if dispatcher is not None else {})
+
+def getLink():
+    '''
+        Nombre: getLink
+        Descripción: Esta función devuelve el backend de enlace abierto por startEthernetLevel (los niveles superiores lo
+            consultan para obtener la configuración IP de los enlaces que no son una interfaz real)
+        Argumentos: Ninguno
+        Retorno: LinkBackend o None si el nivel no está inicializado
+    '''
+    return link
 
 def getHwAddr(interface):
     '''
@@ -59,36 +109,114 @@ def process_Ethernet_frame(us,header,data):
                     -En caso de que no exista retornar
         Argumentos:
             -us: datos de usuarios pasados desde pcap_loop (en nuestro caso será None)
-            -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
+            -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts. ts es un timeval con resolución de
+                nanosegundos (tv_sec, tv_nsec) y se entrega sin cambios a los niveles superiores
             -data: bytearray con el contenido de la trama Ethernet
         Retorno:
             -Ninguno
     '''
     #TODO: Implementar aquí el código que procesa una trama Ethernet en recepción
     global macAddress
-    destino = data[0:6]
-    origen = data[6:12]
-    ethertype = data[12:14]
+    ethCounters.inc('rx_frames')
+    ethCounters.inc('rx_bytes',len(data))
+    frame = EthernetView(data)
+    destino = frame.dst
     #print("[process_ethernet_frame]: data: " + str(data))
     #print("[process_ethernet_frame]: " + "dest: " + str(destino) + "src: " + str(origen) + "ethertype: " + str(int.from_bytes(ethertype, byteorder='big')))
     if (destino != broadcastAddr) and (destino != macAddress):
+        ethCounters.inc('rx_not_for_us')
         return
     #print("[process_Ethernet_frame]", "Processing a frame for", ':'.join(['{:02X}'.format(b) for b in destino]))
 
-    etherkey = int.from_bytes(ethertype, byteorder='big')
+    etherkey = frame.ethertype
     if upperProtos.get(etherkey) == None:
-    	return
+        ethCounters.inc('rx_unknown_ethertype')
+        return
+
+    #Payload y MAC origen se pasan como memoryview sobre la trama (sin copia)
+    upperProtos[etherkey](us,header,frame.payload,frame.src)
+
 
-    upperProtos[etherkey](us,header,data[14:],origen)
 
+class FrameDispatcher():
+    '''
+        Clase que reparte las tramas recibidas entre un número fijo de hilos de procesamiento, cada uno con su
+        propia cola acotada. Las tramas se asignan a un hilo según un hash de la IP origen (datagramas IP) o de la
+        MAC origen (resto de tramas), de modo que las tramas de un mismo flujo se procesan siempre en orden.
+        Las tramas ARP se procesan directamente en el hilo de recepción: su procesamiento nunca bloquea y así una
+        resolución ARP en curso dentro de un hilo de procesamiento no espera a una respuesta encolada tras ella.
+        Cuando una cola está llena se descarta la trama contabilizándola (dropWhenFull=True, por defecto) o el hilo de
+        recepción espera a que haya sitio como mucho QUEUE_PUT_TIMEOUT segundos antes de descartarla (dropWhenFull=False).
+        La espera es acotada porque mientras dura no se procesan las respuestas ARP que esperan los hilos de
+        procesamiento.
+    '''
+    def __init__(self,nworkers=DEFAULT_WORKERS,queueDepth=DEFAULT_QUEUE_DEPTH,dropWhenFull=True):
+        if nworkers < 1 or queueDepth < 1:
+            raise ValueError('nworkers y queueDepth deben ser positivos')
+        self.nworkers = nworkers
+        self.dropWhenFull = dropWhenFull
+        self.queues = [queue.Queue(queueDepth) for i in range(nworkers)]
+        #Contadores por cola. Solo los modifica el hilo de recepción
+        self.enqueued = [0]*nworkers
+        self.dropped = [0]*nworkers
+        self.workers = []
+
+    def start(self):
+        for q in self.queues:
+            w = threading.Thread(target=self.run,args=(q,))
+            w.daemon = True
+            w.start()
+            self.workers.append(w)
+
+    def run(self,q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                process_Ethernet_frame(*item)
+            except Exception:
+                logging.exception('Error procesando trama')
+
+    def dispatch(self,us,header,data):
+        if len(data) < 14:
+            return
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype == ETHERTYPE_ARP:
+            process_Ethernet_frame(us,header,data)
+            return
+        if ethertype == ETHERTYPE_IP and len(data) >= 30:
+            key = int.from_bytes(data[26:30],byteorder='big')
+        else:
+            key = int.from_bytes(data[6:12],byteorder='big')
+        i = (key ^ (key >> 16)) % self.nworkers
+        try:
+            if self.dropWhenFull:
+                self.queues[i].put_nowait((us,header,data))
+            else:
+                self.queues[i].put((us,header,data),timeout=QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            self.dropped[i] += 1
+            return
+        self.enqueued[i] += 1
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for w in self.workers:
+            w.join(1)
+        self.workers = []
+
+    def stats(self):
+        return {'enqueued':sum(self.enqueued),'dropped':sum(self.dropped),'queued':sum(q.qsize() for q in self.queues)}
 
 
 def process_frame(us,header,data):
     '''
         Nombre: process_frame
         Descripción: Esta función se pasa a pcap_loop y se ejecutará cada vez que llegue una trama. La función
-        ejecutará la función process_Ethernet_frame en un hilo nuevo para evitar interbloqueos entre 2 recepciones
-        consecutivas de tramas dependientes. Esta función NO debe modifciarse
+        entrega la trama al repartidor (FrameDispatcher), que ejecutará process_Ethernet_frame en uno de sus hilos
+        de procesamiento para evitar interbloqueos entre 2 recepciones consecutivas de tramas dependientes.
         Argumentos:
             -us: datos de usuarios pasados desde pcap_loop (en nuestro caso será None)
             -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
@@ -96,28 +224,40 @@ def process_frame(us,header,data):
         Retorno:
             -Ninguno
     '''
-    threading.Thread(target=process_Ethernet_frame,args=(us,header,data)).start()
+    dispatcher.dispatch(us,header,data)
 
 
-class rxThread(threading.Thread):
-    ''' Clase que implementa un hilo de recepción. De esta manera al iniciar el nivel Ethernet
-        podemos dejar un hilo con pcap_loop que reciba los paquetes sin bloquear el envío.
-        En esta clase NO se debe modificar código
+def buildFrameFilter():
     '''
-    def __init__(self):
-        threading.Thread.__init__(self)
-
-    def run(self):
-        global handle
-        #Ejecuta pcap_loop. OJO: handle debe estar inicializado con el resultado de pcap_open_live
-        if handle is not None:
-            pcap_loop(handle,-1,process_frame,None)
-    def stop(self):
-        global handle
-        #Para la ejecución de pcap_loop
-        if handle is not None:
-            pcap_breakloop(handle)
+        Nombre: buildFrameFilter
+        Descripción: Esta función construye la expresión de filtro (sintaxis de tcpdump) con la MAC propia, broadcast y los
+            Ethertypes registrados en upperProtos
+        Argumentos: Ninguno
+        Retorno: Cadena con la expresión de filtro
+    '''
+    expr = '(ether dst {} or ether broadcast)'.format(bytes(macAddress).hex(':'))
+    if upperProtos:
+        expr += ' and ({})'.format(' or '.join('ether proto 0x{:04x}'.format(e) for e in sorted(upperProtos)))
+    return expr
 
+def updateFrameFilter():
+    '''
+        Nombre: updateFrameFilter
+        Descripción: Esta función instala en el enlace el filtro de buildFrameFilter (si KERNEL_FILTER es True). Se llama
+            al iniciar el nivel y cada vez que se registra un Ethertype nuevo.
+        Argumentos: Ninguno
+        Retorno: 0 si todo es correcto (o no hay filtro que instalar) y -1 en otro caso
+    '''
+    if link is None or not KERNEL_FILTER:
+        return 0
+    errbuf = bytearray()
+    expr = buildFrameFilter()
+    if link.setFilter(expr,errbuf) != 0:
+        ethTrace.log(TRACE_ERROR,"[updateFrameFilter] Error instalando el filtro '{}': {}",expr,errbuf)
+        return -1
+    if ethTrace.debug:
+        ethTrace.log(TRACE_DEBUG,"[updateFrameFilter] Filtro instalado: {}",expr)
+    return 0
 
 def registerCallback(callback_func, ethertype):
     '''HECHO
@@ -127,6 +267,7 @@ def registerCallback(callback_func, ethertype):
             Este mecanismo nos permite saber a qué función de nivel superior debemos llamar al recibir una trama de determinado tipo.
             Por ejemplo, podemos registrar una función llamada process_IP_datagram asociada al Ethertype 0x0800 y otra llamada process_arp_packet
             asocaida al Ethertype 0x0806.
+            Si el Ethertype es nuevo se actualiza el filtro de tramas del kernel (updateFrameFilter).
         Argumentos:
             -callback_fun: función de callback a ejecutar cuando se reciba el Ethertype especificado.
                 La función que se pase como argumento debe tener el siguiente prototipo: funcion(us,header,data,srcMac)
@@ -134,7 +275,8 @@ def registerCallback(callback_func, ethertype):
                     -us: son los datos de usuarios pasados por pcap_loop (en nuestro caso este valor será siempre None)
                     -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
                     -data: payload de la trama Ethernet. Es decir, la cabecera Ethernet NUNCA se pasa hacia arriba.
-                    -srcMac: dirección MAC que ha enviado la trama actual.
+                    Es un memoryview sobre la trama recibida (ver views.py).
+                    -srcMac: dirección MAC que ha enviado la trama actual (memoryview de 6 bytes).
                 La función no retornará nada. Si una trama se quiere descartar basta con hacer un return sin valor y dejará de procesarse.
             -ethertype: valor de Ethernethertype para el cuál se quiere registrar una función de callback.
         Retorno: Ninguno
@@ -142,99 +284,162 @@ def registerCallback(callback_func, ethertype):
     global upperProtos
     #upperProtos es el diccionario que relaciona función de callback y ethertype
     etherkey = int.from_bytes(ethertype, byteorder='big')
+    isNew = etherkey not in upperProtos
     upperProtos[etherkey]=callback_func
+    #Un Ethertype nuevo debe dejarse pasar por el filtro del kernel
+    if isNew:
+        updateFrameFilter()
 
 
-def startEthernetLevel(interface):
+def startEthernetLevel(interface,numWorkers=DEFAULT_WORKERS,queueDepth=DEFAULT_QUEUE_DEPTH,dropWhenFull=True,startRxThread=True,backend=None):
     '''HECHO
         Nombre: startEthernetLevel
         Descripción: Esta función recibe el nombre de una interfaz de red e inicializa el nivel Ethernet.
             Esta función debe realizar , al menos, las siguientes tareas:
                 -Comprobar si el nivel Ethernet ya estaba inicializado (mediante una variable global). Si ya estaba inicializado devolver -1.
-                -Obtener y almacenar en una variable global la dirección MAC asociada a la interfaz que se especifica
-                -Abrir la interfaz especificada en modo promiscuo usando la librería rc1-pcap
-                -Arrancar un hilo de recepción (rxThread) que llame a la función pcap_loop.
+                -Abrir el backend de enlace (link.py). Si no se indica ninguno se abre la interfaz especificada en modo promiscuo
+                usando la librería rc1-pcap (PcapLiveLink)
+                -Obtener y almacenar en una variable global la dirección MAC del enlace
+                -Instalar en el enlace el filtro de tramas (updateFrameFilter)
+                -Arrancar los hilos de procesamiento de tramas (FrameDispatcher)
+                -Arrancar la recepción del enlace (para PcapLiveLink un hilo que llama a pcap_loop), salvo que startRxThread
+                sea False (por ejemplo cuando la recepción la dirige un bucle de eventos de asyncio, ver aiostack.py).
                 -Si todo es correcto marcar la variable global de nivel incializado a True
         Argumentos:
             -Interface: nombre de la interfaz sobre la que inicializar el nivel Ethernet
+            -numWorkers: número de hilos de procesamiento de tramas
+            -queueDepth: número máximo de tramas encoladas en cada hilo de procesamiento
+            -dropWhenFull: si es True se descartan las tramas cuando la cola está llena. Si es False la recepción espera a que
+                haya sitio como mucho QUEUE_PUT_TIMEOUT segundos y después la descarta (ver FrameDispatcher)
+            -startRxThread: si es False no se arranca la recepción y las tramas se deben leer con pcap_dispatch
+            -backend: LinkBackend sobre el que trabajar (PcapLiveLink, PcapFileLink, VirtualLink...). Si es None se usa la interfaz
         Retorno: 0 si todo es correcto, -1 en otro caso
     '''
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,link,dispatcher
     #TODO: implementar aquí la inicialización de la interfaz y de las variables globales
     handle = None
 
     errbuf = bytearray()
     if levelInitialized == True:
-        print("startEthernetLevel return")
+        ethTrace.log(TRACE_ERROR,"[startEthernetLevel] El nivel Ethernet ya está inicializado")
+        return -1
+    if backend is None:
+        backend = PcapLiveLink(interface, getHwAddr(interface), ETH_FRAME_MAX, PROMISC, TO_MS, TSTAMP_PRECISION, TSTAMP_TYPE)
+    if backend.open(errbuf) != 0:
+        ethTrace.log(TRACE_ERROR,"[startEthernetLevel] Error abriendo el enlace: {}",errbuf)
         return -1
-    macAddress = getHwAddr(interface)
-    handle = pcap_open_live(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf) #TODO: ETH_FRAME_MAX??
+    link = backend
+    macAddress = link.mac
+    handle = link.handle
+    headerTemplates.clear()
+    updateFrameFilter()
+
+    dispatcher = FrameDispatcher(numWorkers,queueDepth,dropWhenFull)
+    dispatcher.start()
 
     levelInitialized = True
-    #Una vez hemos abierto la interfaz para captura y hemos inicializado las variables globales (macAddress, handle y levelInitialized) arrancamos
-    #el hilo de recepción
-    recvThread = rxThread()
-    recvThread.daemon = True
-    recvThread.start()
+    #Una vez hemos abierto el enlace y hemos inicializado las variables globales (macAddress, link y levelInitialized) arrancamos
+    #la recepción
+    if startRxThread:
+        link.start(process_frame)
     return 0
 
 def stopEthernetLevel():
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,link,dispatcher
     '''HECHO
         Nombre: stopEthernetLevel
         Descripción_ Esta función parará y liberará todos los recursos necesarios asociados al nivel Ethernet.
             Esta función debe realizar, al menos, las siguientes tareas:
-                -Parar el hilo de recepción de paquetes
-                -Cerrar la interfaz (handle de pcap)
+                -Parar la recepción de paquetes del enlace
+                -Parar los hilos de procesamiento de tramas
+                -Cerrar el enlace
                 -Marcar la variable global de nivel incializado a False
         Argumentos: Ninguno
         Retorno: 0 si todo es correcto y -1 en otro caso
     '''
-    recvThread.stop()
-
-    if handle:
-        pcap_close(handle)
-    else:
+    if link is None:
         return -1
+    link.stop()
+    if dispatcher is not None:
+        dispatcher.stop()
+        dispatcher = None
+    link.close()
+    link = None
+    handle = None
 
     levelInitialized = False
     return 0
 
+def getHeaderTemplate(dstMac,etherType):
+    '''
+        Nombre: getHeaderTemplate
+        Descripción: Esta función construye la cabecera Ethernet (14 bytes) para una MAC destino y un Ethertype dados
+            y la guarda en headerTemplates para reutilizarla en los siguientes envíos.
+        Argumentos:
+            -dstMac: Dirección MAC destino
+            -etherType: valor de tipo Ethernet (2 bytes)
+        Retorno: Bytes con la cabecera Ethernet
+    '''
+    key = (bytes(dstMac),bytes(etherType))
+    if len(headerTemplates) >= MAX_HEADER_TEMPLATES:
+        headerTemplates.clear()
+    template = key[0] + macAddress + key[1]
+    headerTemplates[key] = template
+    return template
+
 def sendEthernetFrame(data,len,etherType,dstMac):
     ''' HECHO
         Nombre: sendEthernetFrame
         Descripción: Esta función construirá una trama Ethernet con lo datos recibidos y la enviará por la interfaz de red.
             Esta función debe realizar, al menos, las siguientes tareas:
                 -Construir la trama Ethernet a enviar (incluyendo cabecera + payload). Los campos propios (por ejemplo la dirección Ethernet origen)
-                    deben obtenerse de las variables que han sido inicializadas en startEthernetLevel
+                    deben obtenerse de las variables que han sido inicializadas en startEthernetLevel.
+                    La trama se escribe en el buffer de transmisión del hilo actual (sin concatenaciones intermedias) a partir de
+                    la cabecera precalculada para la MAC destino y el Ethertype
                 -Comprobar los límites de Ethernet. Si la trama es muy pequeña se debe rellenar con 0s mientras que
                     si es muy grande se debe devolver error.
-                -Llamar a pcap_inject para enviar la trama y comprobar el retorno de dicha llamada. En caso de que haya error notificarlo
+                -Enviar la trama con el backend de enlace (link.send, que en PcapLiveLink llama a pcap_inject) y comprobar el retorno
+                de dicha llamada. En caso de que haya error notificarlo
         Argumentos:
-            -data: datos útiles o payload a encapsular dentro de la trama Ethernet
+            -data: datos útiles o payload a encapsular dentro de la trama Ethernet (bytes, bytearray o memoryview)
             -len: longitud de los datos útiles expresada en bytes
             -etherType: valor de tipo Ethernet a incluir en la trama
             -dstMac: Dirección MAC destino a incluir en la trama que se enviará
         Retorno: 0 si todo es correcto, -1 en otro caso
     '''
-    global macAddress,handle
+    global macAddress,link
     #print("[sendEthernetFrame] Frame sent from", ':'.join(['{:02X}'.format(b) for b in macAddress]), "to", ':'.join(['{:02X}'.format(b) for b in dstMac]))
-    if (len+14) > ETH_FRAME_MAX:
-        print("[sendEthernetFrame] Oversized")
+    if (len+ETH_HLEN) > ETH_FRAME_MAX:
+        if ethTrace.error:
+            ethTrace.log(TRACE_ERROR,"[sendEthernetFrame] Oversized ({} bytes)",len)
+        ethCounters.inc('tx_errors')
         return -1
+    if dstMac is None:
+        ethCounters.inc('tx_errors')
+        return -1
+
+    #bytes() no copia si ya son bytes. Las MAC extraídas de tramas recibidas son bytearray (no indexables en el diccionario)
+    template = headerTemplates.get((bytes(dstMac),bytes(etherType)))
+    if template is None:
+        template = getHeaderTemplate(dstMac,etherType)
 
-    trama = bytes()
-    trama += dstMac
-    trama += macAddress
-    trama += etherType
-    trama += data
+    trama = getattr(txBuffers,'view',None)
+    if trama is None:
+        txBuffers.buffer = bytearray(ETH_FRAME_MAX)
+        txBuffers.view = trama = memoryview(txBuffers.buffer)
 
-    if (len+14) < ETH_FRAME_MIN:
-        for i in range(len+14, ETH_FRAME_MIN):
-            trama+=bytes(0)
-            len = ETH_FRAME_MIN-14
+    #Cabecera y payload se escriben directamente en el buffer de transmisión
+    size = len+ETH_HLEN
+    trama[0:ETH_HLEN] = template
+    trama[ETH_HLEN:size] = data
+    if size < ETH_FRAME_MIN:
+        trama[size:ETH_FRAME_MIN] = padding[size:]
+        size = ETH_FRAME_MIN
 
     #print("[sendEthernetFrame] Frame:", trama)
-    if (pcap_inject(handle, trama, len+14) == (len+14)):
+    if (link.send(txBuffers.buffer, size) == size):
+        ethCounters.inc('tx_frames')
+        ethCounters.inc('tx_bytes',size)
         return 0
+    ethCounters.inc('tx_errors')
     return -1
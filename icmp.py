@@ -1,14 +1,24 @@
 from ip import *
-from threading import Lock
+from threading import Lock,Condition
 import struct
 
+icmpTrace = getTracer('icmp')
+icmpCounters = counters.getCounters('icmp',('rx_messages','rx_echo_requests','rx_echo_replies','tx_echo_requests','tx_echo_replies'))
+
 ICMP_PROTO = 1
+ICMP_HLEN = 8
 
 ICMP_ECHO_REQUEST_TYPE = 8
 ICMP_ECHO_REPLY_TYPE = 0
 
+#Número máximo de ECHO_REQUEST pendientes de respuesta en icmp_send_times (se olvidan los más antiguos)
+MAX_SEND_TIMES = 4096
+
 timeLock = Lock()
+#Tiempo de envío de cada ECHO_REQUEST, indexado por (IP destino, icmp_id, icmp_seqnum), en orden de envío
 icmp_send_times = {}
+#Funciones a llamar cuando llegue un ECHO_REPLY, indexadas por (IP origen, icmp_id, icmp_seqnum). Se protege con timeLock
+echoReplyCallbacks = {}
 
 def process_ICMP_message(us,header,data,srcIp):
     '''
@@ -19,14 +29,15 @@ def process_ICMP_message(us,header,data,srcIp):
             -Calcular el checksum de ICMP:
                 -Si es distinto de 0 el checksum es incorrecto y se deja de procesar el mensaje
             -Extraer campos tipo y código de la cabecera ICMP
-            -Loggear (con logging.debug) el valor de tipo y código
+            -Loggear (con una traza de nivel TRACE_DEBUG de icmpTrace) el valor de tipo y código
             -Si el tipo es ICMP_ECHO_REQUEST_TYPE:
                 -Generar un mensaje de tipo ICMP_ECHO_REPLY como respuesta. Este mensaje debe contener
                 los datos recibidos en el ECHO_REQUEST. Es decir, "rebotamos" los datos que nos llegan.
                 -Enviar el mensaje usando la función sendICMPMessage
             -Si el tipo es ICMP_ECHO_REPLY_TYPE:
-                -Extraer del diccionario icmp_send_times el valor de tiempo de envío usando como clave los campos srcIP e icmp_id e icmp_seqnum
-                contenidos en el mensaje ICMP. Restar el tiempo de envio extraído con el tiempo de recepción (contenido en la estructura pcap_pkthdr)
+                -Extraer del diccionario icmp_send_times el valor de tiempo de envío usando como clave la tupla (srcIP, icmp_id, icmp_seqnum)
+                contenida en el mensaje ICMP. Restar el tiempo de envio extraído con el tiempo de recepción (contenido en la estructura pcap_pkthdr,
+                con resolución de microsegundos)
                 -Se debe proteger el acceso al diccionario de tiempos usando la variable timeLock
                 -Mostrar por pantalla la resta. Este valor será una estimación del RTT
             -Si es otro tipo:
@@ -41,29 +52,32 @@ def process_ICMP_message(us,header,data,srcIp):
 
     '''
     #HACER
-    print("[process_ICMP_message] Processing ICMP message with data", data)
-    checksum = data[2:4]
+    icmpCounters.inc('rx_messages')
+    message = ICMPView(data)
+    if not message.valid():
+        return
+    type,code,checksum,identifier,sequenceNumber = message.fields()
     #if checksum != 0:
     #    return
-    type = data[0]
-    code = data[1]
-    logging.debug(type)
-    logging.debug(code)
+    if icmpTrace.debug:
+        icmpTrace.log(TRACE_DEBUG,"[process_ICMP_message] type={} code={} from {}",type,code,socket.inet_ntoa(bytes(srcIp)))
 
-
-    identifier = struct.unpack('!H', data[4:6])[0]
-    sequenceNumber = struct.unpack('!H', data[6:8])[0]
     if type == ICMP_ECHO_REQUEST_TYPE:
-        print("[process_ICMP_message] Received an ICMP_ECHO_REQUEST")
+        icmpCounters.inc('rx_echo_requests')
         #print("SRC IP:", srcIp, "identifier:", identifier, "SEQ:", sequenceNumber)
-        sendICMPMessage(data[8:], ICMP_ECHO_REPLY_TYPE, code, identifier, sequenceNumber, struct.unpack('!I', srcIp)[0])
+        sendICMPEchoReply(data, struct.unpack('!I', srcIp)[0])
 
     if type == ICMP_ECHO_REPLY_TYPE:
-        print("[process_ICMP_message] Received an ICMP_ECHO_REPLY")
+        icmpCounters.inc('rx_echo_replies')
         #print("SRC IP:", srcIp, "identifier:", identifier, "SEQ:", sequenceNumber)
+        key = (struct.unpack('!I', srcIp)[0], identifier, sequenceNumber)
         with timeLock:
-            time = header.ts.tv_sec - icmp_send_times[struct.unpack('!I', srcIp)[0] + identifier + sequenceNumber]
-        print("ESTIMACION DE RTT: {}".format(time))
+            callback = echoReplyCallbacks.pop(key, None)
+            sendTime = icmp_send_times.pop(key, None)
+        if callback is not None:
+            callback(header, data)
+        if sendTime is not None:
+            icmpTrace.log(TRACE_INFO,"ESTIMACION DE RTT: {:.3f} ms",(header.ts.ns() / 1e9 - sendTime) * 1000)
 
 
 def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
@@ -77,7 +91,8 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
                 -Calcular el checksum y añadirlo al mensaje donde corresponda
                 -Si type es ICMP_ECHO_REQUEST_TYPE
                     -Guardar el tiempo de envío (llamando a time.time()) en el diccionario icmp_send_times
-                    usando como clave el valor de dstIp+icmp_id+icmp_seqnum
+                    usando como clave la tupla (dstIp, icmp_id, icmp_seqnum). Si hay más de MAX_SEND_TIMES
+                    entradas se descarta la más antigua
                     -Se debe proteger al acceso al diccionario usando la variable timeLock
 
                 -Llamar a sendIPDatagram para enviar el mensaje ICMP
@@ -99,6 +114,33 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
     if type != ICMP_ECHO_REQUEST_TYPE and type != ICMP_ECHO_REPLY_TYPE:
         return False
 
+    message = buildICMPMessage(data,type,code,icmp_id,icmp_seqnum)
+    if icmpTrace.debug:
+        icmpTrace.log(TRACE_DEBUG,"[sendICMPMessage] Sending message to {}",socket.inet_ntoa(struct.pack('!I',dstIP)))
+
+    if type == ICMP_ECHO_REQUEST_TYPE:
+        with timeLock:
+            if len(icmp_send_times) >= MAX_SEND_TIMES:
+                del icmp_send_times[next(iter(icmp_send_times))]
+            icmp_send_times[(dstIP, icmp_id, icmp_seqnum)] = time.time()
+
+    if not sendIPDatagram(dstIP, message, ICMP_PROTO):
+        return False
+    icmpCounters.inc('tx_echo_requests' if type == ICMP_ECHO_REQUEST_TYPE else 'tx_echo_replies')
+    return True
+
+def buildICMPMessage(data,type,code,icmp_id,icmp_seqnum):
+    '''
+        Nombre: buildICMPMessage
+        Descripción: Esta función construye un mensaje ICMP de tipo eco (cabecera, datos y checksum) sin enviarlo
+        Argumentos:
+            -data: array de bytes con los datos a incluir como payload en el mensaje ICMP
+            -type: valor del campo tipo de ICMP
+            -code: valor del campo code de ICMP
+            -icmp_id: entero que contiene el valor del campo ID de ICMP
+            -icmp_seqnum: entero que contiene el valor del campo Seqnum de ICMP
+        Retorno: bytearray con el mensaje ICMP
+    '''
     message = bytearray()
     message += bytes(struct.pack('B', type))
     message += bytes(struct.pack('B', code))
@@ -107,17 +149,251 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
     message += bytes(struct.pack('!H', icmp_seqnum))
     message += data
 
-    #SEEMS CHKSUM HAS TO BE LITTLE ENDIAN SO THAT WIRESHARK VALIDATES IT. WONDER WHY
-    message[2] = bytes(struct.pack('!H', chksum(message)))[1]
-    message[3] = bytes(struct.pack('!H', chksum(message)))[0]
-    #message[2:4] = bytes(struct.pack('!H', chksum(message)))
-    print("[sendICMPMessage] Sending message to", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',dstIP))))
+    #chksum suma las palabras en orden de host (little endian), por eso se guarda con '<H'
+    message[2:4] = struct.pack('<H', chksum(message))
+    return message
 
-    if type == ICMP_ECHO_REQUEST_TYPE:
-        with timeLock:
-            icmp_send_times[dstIP + icmp_id + icmp_seqnum] = time.time()
+def registerEchoReplyCallback(srcIP,icmp_id,icmp_seqnum,callback):
+    '''
+        Nombre: registerEchoReplyCallback
+        Descripción: Esta función registra una función a la que se llamará (una sola vez) cuando llegue el ECHO_REPLY
+        con la IP origen, el ID y el Seqnum indicados. Si callback es None se elimina el registro.
+        Argumentos:
+            -srcIP: entero de 32 bits con la IP que debe contestar
+            -icmp_id: valor del campo ID de ICMP
+            -icmp_seqnum: valor del campo Seqnum de ICMP
+            -callback: función que recibe (header, data) con la cabecera pcap y el mensaje ICMP recibido
+        Retorno: Ninguno
+    '''
+    with timeLock:
+        if callback is None:
+            echoReplyCallbacks.pop((srcIP,icmp_id,icmp_seqnum), None)
+        else:
+            echoReplyCallbacks[(srcIP,icmp_id,icmp_seqnum)] = callback
+
+def sendICMPEchoReply(request,dstIP):
+    '''
+        Nombre: sendICMPEchoReply
+        Descripción: Esta función construye la respuesta a un ECHO_REQUEST reutilizando el mensaje recibido y la envía.
+        La respuesta solo se diferencia de la petición en el campo tipo, por lo que el checksum se actualiza de forma
+        incremental (RFC 1624) en lugar de volver a calcularse sobre todos los datos.
+
+        Argumentos:
+            -request: array de bytes con el mensaje ICMP ECHO_REQUEST recibido (cabecera incluida)
+            -dstIP: entero de 32 bits con la IP destino del mensaje ICMP
+        Retorno: True o False en función de si se ha enviado el mensaje correctamente o no
 
-    return sendIPDatagram(dstIP, message, ICMP_PROTO)
+    '''
+    message = bytearray(request)
+    oldWord = struct.unpack('<H', message[0:2])[0]
+    message[0] = ICMP_ECHO_REPLY_TYPE
+    newWord = struct.unpack('<H', message[0:2])[0]
+    checksum = struct.unpack('<H', message[2:4])[0]
+    message[2:4] = struct.pack('<H', chksum_update(checksum, oldWord, newWord))
+    if icmpTrace.debug:
+        icmpTrace.log(TRACE_DEBUG,"[sendICMPEchoReply] Sending message to {}",socket.inet_ntoa(struct.pack('!I',dstIP)))
+
+    if not sendIPDatagram(dstIP, message, ICMP_PROTO):
+        return False
+    icmpCounters.inc('tx_echo_replies')
+    return True
+
+class LatencyHistogram():
+    '''
+        Histograma de latencias (valores enteros, por ejemplo en nanosegundos) con cubetas log-lineales: cada potencia
+        de 2 se divide en HISTOGRAM_SUB_BUCKETS cubetas iguales, por lo que el error relativo de los percentiles es menor
+        que 1/HISTOGRAM_SUB_BUCKETS y el tamaño no depende del número de muestras. min, max y la media son exactos.
+    '''
+    SUB_BITS = 4
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self,value):
+        #Índice de cubeta de un valor entero >= 0
+        shift = max(0,value.bit_length() - self.SUB_BITS - 1)
+        return (shift << self.SUB_BITS) + (value >> shift)
+
+    def bucketTop(self,index):
+        #Mayor valor que cae en la cubeta index (inversa de bucket)
+        shift = max(0,(index >> self.SUB_BITS) - 1)
+        mantissa = index - (shift << self.SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def add(self,value):
+        value = int(value)
+        b = self.bucket(value)
+        self.counts[b] = self.counts.get(b,0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self,p):
+        '''
+            Devuelve el valor por debajo del cual está el p por ciento de las muestras (None si no hay muestras)
+        '''
+        if self.count == 0:
+            return None
+        target = max(1,math.ceil(self.count * p / 100))
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= target:
+                return min(self.bucketTop(b),self.max)
+        return self.max
+
+    def summary(self,percentiles=(50,90,99,99.9)):
+        if self.count == 0:
+            return {'count':0}
+        result = {'count':self.count,'min':self.min,'avg':self.total / self.count,'max':self.max}
+        for p in percentiles:
+            result['p{}'.format(p)] = self.percentile(p)
+        return result
+
+
+class PingEngine():
+    '''
+        Generador de ECHO_REQUEST a ritmo fijo hacia un destino. Cada petición lleva en los primeros 8 bytes de datos el
+        instante de envío (time.time_ns). Si el enlace marca las tramas con la hora del sistema (hostClock), el RTT se
+        calcula con la marca de tiempo pcap de la respuesta, así que no depende de cuándo se procese la trama; si no (marcas
+        de la tarjeta, trazas), se mide con time.monotonic_ns al procesar la respuesta. El histograma se guarda en
+        nanosegundos y report() lo devuelve en microsegundos. Las peticiones en vuelo se guardan en una tabla acotada
+        (maxInFlight) indexada por seqnum con su instante de envío monotónico: si está llena el envío espera, y las que
+        superan timeout se dan por perdidas.
+    '''
+    def __init__(self,dstIP,count=100,rate=10.0,size=56,timeout=1.0,icmp_id=None,maxInFlight=1024):
+        self.dstIP = dstIP
+        self.count = count
+        self.rate = rate
+        self.timeout = timeout
+        self.icmp_id = icmp_id if icmp_id is not None else os.getpid() & 0xffff
+        self.maxInFlight = maxInFlight
+        self.padding = bytes(max(0,size - 8))
+        self.cond = Condition(Lock())
+        self.inFlight = {}
+        self.histogram = LatencyHistogram()
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.errors = 0
+
+    def onReply(self,header,data):
+        #Se llama desde los hilos de procesamiento de tramas con el ECHO_REPLY completo
+        seq = struct.unpack('!H',data[6:8])[0]
+        recvAt = time.monotonic_ns()
+        with self.cond:
+            stamps = self.inFlight.pop(seq,None)
+            if stamps is None:
+                return
+            sentAt,sentWall = stamps
+            link = getLink()
+            if link is not None and link.hostClock and header.ts.ns() != 0:
+                #La marca de la captura y la de la petición son del mismo reloj (el del sistema)
+                if len(data) >= ICMP_HLEN + 8:
+                    sentWall = struct.unpack('!Q',data[ICMP_HLEN:ICMP_HLEN + 8])[0]
+                sentAt,recvAt = sentWall,header.ts.ns()
+            self.histogram.add(max(0,recvAt - sentAt))
+            self.received += 1
+            self.cond.notify_all()
+
+    def expire(self,now):
+        #Da por perdidas las peticiones enviadas antes de now - timeout (now en time.monotonic_ns). Se llama con self.cond
+        #adquirido
+        limit = now - int(self.timeout * 1000000000)
+        expired = [seq for seq,(sentAt,sentWall) in self.inFlight.items() if sentAt < limit]
+        for seq in expired:
+            del self.inFlight[seq]
+            registerEchoReplyCallback(self.dstIP,self.icmp_id,seq,None)
+        self.lost += len(expired)
+        return len(expired)
+
+    def sendOne(self,seq):
+        #El siguiente salto se resuelve antes de tomar el instante de envío, para que el RTT no incluya la resolución ARP
+        nextHop = routingTable.nextHop(self.dstIP)
+        if nextHop is None:
+            ipCounters.inc('tx_no_route')
+            self.errors += 1
+            return False
+        dstMac = ARPResolution(nextHop)
+        if dstMac is None:
+            ipCounters.inc('tx_no_arp')
+            self.errors += 1
+            return False
+        sentWall = time.time_ns()
+        with self.cond:
+            self.inFlight[seq] = (time.monotonic_ns(),sentWall)
+        registerEchoReplyCallback(self.dstIP,self.icmp_id,seq,self.onReply)
+        message = buildICMPMessage(struct.pack('!Q',sentWall) + self.padding,ICMP_ECHO_REQUEST_TYPE,0,self.icmp_id,seq)
+        if not sendIPFragments(self.dstIP,message,ICMP_PROTO,dstMac):
+            registerEchoReplyCallback(self.dstIP,self.icmp_id,seq,None)
+            with self.cond:
+                self.inFlight.pop(seq,None)
+            self.errors += 1
+            return False
+        self.sent += 1
+        icmpCounters.inc('tx_echo_requests')
+        return True
+
+    def run(self):
+        '''
+            Envía count peticiones a rate peticiones por segundo (rate <= 0: tan rápido como se pueda) y espera a las
+            respuestas pendientes. Devuelve el resumen de report()
+        '''
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        start = time.monotonic()
+        for i in range(self.count):
+            delay = start + i * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.cond:
+                while len(self.inFlight) >= self.maxInFlight:
+                    if not self.expire(time.monotonic_ns()):
+                        self.cond.wait(self.timeout / 10)
+            self.sendOne(i & 0xffff)
+        with self.cond:
+            deadline = time.monotonic() + self.timeout
+            while self.inFlight and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            self.expire(time.monotonic_ns() + int(self.timeout * 1000000000))
+        return self.report()
+
+    def report(self):
+        result = {'sent':self.sent,'received':self.received,'lost':self.lost,'errors':self.errors}
+        result.update({k:v if k == 'count' else v / 1000 for k,v in self.histogram.summary().items()})
+        return result
+
+    def printReport(self):
+        r = self.report()
+        print('{} enviados, {} recibidos, {} perdidos ({:.1f}%), {} errores de envío'.format(r['sent'],r['received'],
+            r['lost'],100.0 * r['lost'] / r['sent'] if r['sent'] else 0.0,r['errors']))
+        if r['count']:
+            print('RTT (ms) min/avg/max = {:.3f}/{:.3f}/{:.3f}'.format(r['min'] / 1000,r['avg'] / 1000,r['max'] / 1000))
+            print('RTT (ms) ' + '  '.join('{} = {:.3f}'.format(k,v / 1000) for k,v in r.items() if k.startswith('p')))
+
+
+def runPing(dstIP,count=100,rate=10.0,size=56,timeout=1.0):
+    '''
+        Nombre: runPing
+        Descripción: Esta función envía una ráfaga de ECHO_REQUEST con PingEngine y muestra el resumen de RTT
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino
+            -count: número de peticiones a enviar
+            -rate: peticiones por segundo
+            -size: tamaño de los datos de cada petición (mínimo 8, donde va la marca de tiempo de envío)
+            -timeout: segundos tras los que una petición sin respuesta se da por perdida
+        Retorno: Diccionario con los contadores y el resumen del histograma de RTT (en microsegundos)
+    '''
+    engine = PingEngine(dstIP,count,rate,size,timeout)
+    result = engine.run()
+    engine.printReport()
+    return result
 
 def initICMP():
     '''
@@ -133,5 +409,5 @@ def initICMP():
     '''
     #HACER
     registerIPProtocol(process_ICMP_message, ICMP_PROTO) #Mandar el proto en bytes?
-    print("[initICMP] ICMP initialized succesfully")
+    icmpTrace.log(TRACE_INFO,"[initICMP] ICMP initialized succesfully")
     return
@@ -0,0 +1,250 @@
+'''
+    interfaces.py
+    Varias interfaces de red en un mismo proceso. Los niveles Ethernet, ARP e IP guardan su estado (descriptor de
+    captura, MAC, IP, MTU, caché ARP, tabla de rutas...) en variables globales de su módulo, por lo que cada
+    NetworkInterface carga su propia instancia de los módulos de la pila con loadStackInstance (link.py): cada interfaz
+    tiene así su descriptor, su hilo de recepción, su caché ARP y su MTU.
+    MultiInterfaceStack reúne las interfaces: elige la interfaz de salida de cada datagrama con una tabla de rutas
+    común (la unión de las rutas de todas las interfaces, cada una con el nombre de su interfaz) y, si se activa el
+    reenvío (forward=True), encamina entre interfaces los datagramas recibidos que van dirigidos a otra IP.
+'''
+
+from link import *
+import counters
+import logging
+import struct
+import threading
+
+routerCounters = counters.getCounters('router',('tx_datagrams','tx_no_route','tx_no_arp','fwd_datagrams','fwd_no_route',
+    'fwd_ttl_exceeded','fwd_too_big','fwd_no_arp','fwd_errors'))
+
+
+class NetworkInterface():
+    '''
+        Interfaz de red con su propia instancia de la pila (atributo stack, con los módulos ethernet, arp, ip, icmp, udp
+        y counters). backend es el LinkBackend de la interfaz (por defecto PcapLiveLink sobre la interfaz real).
+    '''
+    def __init__(self,name,backend=None,opts=None,numWorkers=None,queueDepth=None,dropWhenFull=True):
+        self.name = name
+        self.backend = backend
+        self.opts = opts
+        self.stack = loadStackInstance()
+        self.numWorkers = numWorkers if numWorkers is not None else self.stack.ethernet.DEFAULT_WORKERS
+        self.queueDepth = queueDepth if queueDepth is not None else self.stack.ethernet.DEFAULT_QUEUE_DEPTH
+        self.dropWhenFull = dropWhenFull
+        self.started = False
+
+    def start(self):
+        '''
+            Inicializa la pila de la interfaz (Ethernet con su hilo de recepción, ICMP, UDP e IP/ARP). Devuelve True o False
+        '''
+        stack = self.stack
+        if stack.ethernet.startEthernetLevel(self.name,self.numWorkers,self.queueDepth,self.dropWhenFull,backend=self.backend) != 0:
+            return False
+        stack.icmp.initICMP()
+        stack.udp.initUDP()
+        if not stack.ip.initIP(self.name,self.opts):
+            stack.ethernet.stopEthernetLevel()
+            return False
+        self.started = True
+        return True
+
+    def stop(self):
+        if self.started:
+            self.stack.ethernet.stopEthernetLevel()
+            self.started = False
+
+    @property
+    def ipAddr(self):
+        return self.stack.ip.myIP
+
+    @property
+    def netmask(self):
+        return self.stack.ip.netmask
+
+    @property
+    def mac(self):
+        return self.stack.ethernet.macAddress
+
+    @property
+    def mtu(self):
+        return self.stack.ip.MTU
+
+    def routes(self):
+        #Rutas de la interfaz, todas con su nombre (las del kernel ya lo llevan; la de la red propia se añade con él)
+        return [route for route in self.stack.ip.routingTable.routes() if route.interface in (None,self.name)]
+
+    def stats(self):
+        return self.stack.counters.snapshot()
+
+
+class MultiInterfaceStack():
+    '''
+        Conjunto de interfaces de red con encaminamiento entre ellas. Si forward es True los datagramas recibidos por una
+        interfaz con destino a otra IP (que no sea de difusión ni multicast) se reenvían por la interfaz que indique la
+        tabla de rutas común, decrementando el TTL. Los datagramas que no caben en la MTU de salida se descartan (no se
+        fragmentan al reenviar).
+    '''
+    def __init__(self,forward=False):
+        self.forward = forward
+        self.interfaces = {}
+        self.routingTable = None
+        self.lock = threading.Lock()
+        self.rebuildRoutes()
+
+    def addInterface(self,name,backend=None,opts=None,**kwargs):
+        '''
+            Crea e inicializa una interfaz (ver NetworkInterface). Devuelve la interfaz o None si no se ha podido inicializar
+        '''
+        if name in self.interfaces:
+            raise ValueError('La interfaz {} ya existe'.format(name))
+        iface = NetworkInterface(name,backend,opts,**kwargs)
+        if not iface.start():
+            logging.error('[MultiInterfaceStack] No se ha podido inicializar la interfaz {}'.format(name))
+            return None
+        if self.forward:
+            iface.stack.ip.setForwardCallback(lambda us,header,datagram: self.forwardDatagram(iface,datagram))
+        with self.lock:
+            self.interfaces[name] = iface
+        counters.registerCollector('if_{}'.format(name),lambda: {'{}_{}'.format(group,key):value
+            for group,values in iface.stats().items() for key,value in values.items()
+            if isinstance(value,(int,float)) and not isinstance(value,bool)})
+        self.rebuildRoutes()
+        return iface
+
+    def removeInterface(self,name):
+        with self.lock:
+            iface = self.interfaces.pop(name,None)
+        if iface is None:
+            return False
+        counters.registerCollector('if_{}'.format(name),None)
+        iface.stack.ip.setForwardCallback(None)
+        iface.stop()
+        self.rebuildRoutes()
+        return True
+
+    def rebuildRoutes(self):
+        '''
+            Reconstruye la tabla de rutas común con las rutas de todas las interfaces. Hay que llamarla si se cambian las
+            rutas de alguna interfaz después de añadirla
+        '''
+        with self.lock:
+            interfaces = list(self.interfaces.values())
+        if not interfaces:
+            self.routingTable = None
+            return
+        table = interfaces[0].stack.ip.RoutingTable()
+        for iface in interfaces:
+            for route in iface.routes():
+                table.addRoute(route.prefix,route.prefixLen,route.gateway,route.metric,iface.name)
+        self.routingTable = table
+
+    def route(self,dstIP):
+        '''
+            Devuelve una tupla (interfaz de salida, IP del siguiente salto) para dstIP o (None, None) si no hay ruta
+        '''
+        table = self.routingTable
+        route = table.lookup(dstIP) if table is not None else None
+        if route is None:
+            return None,None
+        iface = self.interfaces.get(route.interface)
+        if iface is None:
+            return None,None
+        return iface,route.gateway if route.gateway else dstIP
+
+    def getInterface(self,name):
+        return self.interfaces.get(name)
+
+    def sendIPDatagram(self,dstIP,data,protocol):
+        '''
+            Envía un datagrama IP por la interfaz que indique la tabla de rutas común. Devuelve True o False
+        '''
+        iface,nextHop = self.route(dstIP)
+        if iface is None:
+            routerCounters.inc('tx_no_route')
+            return False
+        dstMac = iface.stack.arp.ARPResolution(nextHop)
+        if dstMac is None:
+            routerCounters.inc('tx_no_arp')
+            return False
+        if not iface.stack.ip.sendIPFragments(dstIP,data,protocol,dstMac):
+            return False
+        routerCounters.inc('tx_datagrams')
+        return True
+
+    def sendUDPDatagram(self,data,dstPort,dstIP,srcPort=None):
+        '''
+            Envía un datagrama UDP por la interfaz de salida hacia dstIP. Si srcPort es None se usa el puerto del flujo en
+            esa interfaz (ver udp.getFlowSourcePort)
+        '''
+        iface,nextHop = self.route(dstIP)
+        if iface is None:
+            routerCounters.inc('tx_no_route')
+            return False
+        udp = iface.stack.udp
+        if srcPort is None:
+            srcPort = udp.getFlowSourcePort(dstIP,dstPort)
+            if srcPort is None:
+                return False
+        if not self.sendIPDatagram(dstIP,udp.buildUDPDatagram(data,srcPort,dstPort),udp.UDP_PROTO):
+            return False
+        udp.udpCounters.inc('tx_datagrams')
+        return True
+
+    def registerUDPPort(self,port,callback):
+        '''
+            Registra callback(srcIP, srcPort, data) para los datagramas recibidos en el puerto UDP port por cualquier
+            interfaz (si callback es None se elimina el registro). Devuelve False si el puerto está en uso en alguna de
+            ellas (en ese caso no queda registrado en ninguna)
+        '''
+        with self.lock:
+            interfaces = list(self.interfaces.values())
+        registered = []
+        for iface in interfaces:
+            if iface.stack.udp.registerUDPPort(port,callback) is None and callback is not None:
+                for done in registered:
+                    done.stack.udp.registerUDPPort(port,None)
+                return False
+            registered.append(iface)
+        return True
+
+    def forwardDatagram(self,ingress,datagram):
+        #Se ejecuta en los hilos de procesamiento de la interfaz de entrada
+        if datagram[8] <= 1:
+            routerCounters.inc('fwd_ttl_exceeded')
+            return
+        dstIP = struct.unpack_from('!I',datagram,16)[0]
+        iface,nextHop = self.route(dstIP)
+        if iface is None or iface is ingress:
+            routerCounters.inc('fwd_no_route')
+            return
+        if len(datagram) > iface.mtu:
+            routerCounters.inc('fwd_too_big')
+            return
+        dstMac = iface.stack.arp.ARPResolution(nextHop)
+        if dstMac is None:
+            routerCounters.inc('fwd_no_arp')
+            return
+        packet = bytearray(datagram)
+        old = bytes(packet[8:10])
+        packet[8] -= 1
+        checksum = struct.unpack('<H',packet[10:12])[0]
+        packet[10:12] = struct.pack('<H',iface.stack.ip.chksum_update_bytes(checksum,old,packet[8:10]))
+        if iface.stack.ethernet.sendEthernetFrame(packet,len(packet),bytes([0x08,0x00]),dstMac) == -1:
+            routerCounters.inc('fwd_errors')
+            return
+        routerCounters.inc('fwd_datagrams')
+
+    def stats(self):
+        '''
+            Devuelve un diccionario nombre de interfaz -> instantánea de sus contadores, más los del encaminamiento ('router')
+        '''
+        with self.lock:
+            interfaces = list(self.interfaces.items())
+        result = {name:iface.stats() for name,iface in interfaces}
+        result['router'] = routerCounters.snapshot()
+        return result
+
+    def stop(self):
+        for name in list(self.interfaces):
+            self.removeInterface(name)
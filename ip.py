@@ -1,13 +1,19 @@
 from ethernet import *
 from arp import *
 from fcntl import ioctl
-import subprocess
 import math
+import time
+import threading
 SIOCGIFMTU = 0x8921
 SIOCGIFNETMASK = 0x891b
+ipTrace = getTracer('ip')
+ipCounters = counters.getCounters('ip',('rx_datagrams','rx_bad_length','rx_fragments','rx_reassembled','rx_unknown_protocol',
+    'tx_datagrams','tx_fragments','tx_no_route','tx_no_arp'))
 #Diccionario de protocolos. Las claves con los valores numéricos de protocolos de nivel superior a IP
 #por ejemplo (1, 6 o 17) y los valores son los nombres de las funciones de callback a ejecutar.
 protocols={}
+#Función a la que se entregan los datagramas recibidos dirigidos a otra IP (ver setForwardCallback)
+forwardCallback = None
 #Valor inicial para el IPID
 IPID = 0
 #Valor de ToS por defecto
@@ -22,30 +28,374 @@ DEFAULT_TTL = 64
 ICMP = 1
 TCP = 6
 UDP = 17
+#Tamaño máximo de un datagrama IP
+IP_MAX_DATAGRAM = 65535
+#Tiempo máximo (en segundos) para completar el reensamblado de un datagrama
+REASSEMBLY_TIMEOUT = 30
+#Memoria máxima (en bytes) ocupada por todos los datagramas que se están reensamblando
+REASSEMBLY_MAX_MEMORY = 4*1024*1024
+
+
+class Reassembly():
+    '''
+        Datagrama en reensamblado. Los huecos pendientes se guardan como una lista de intervalos [primero,último]
+        (RFC 815): cada fragmento recorta o parte los huecos con los que se solapa, de modo que los fragmentos
+        pueden llegar desordenados o solapados. El último fragmento (MF=0) fija la longitud total.
+    '''
+    __slots__ = ('buffer','holes','total','deadline')
+
+    def __init__(self,deadline):
+        self.buffer = bytearray()
+        self.holes = [(0,IP_MAX_DATAGRAM)]
+        self.total = None
+        self.deadline = deadline
+
+    def add(self,first,payload,more):
+        last = first + len(payload) - 1
+        holes = []
+        for hfirst,hlast in self.holes:
+            if not more and hlast >= first:
+                #El último fragmento fija el final: desde first no queda hueco aunque el fragmento venga vacío
+                if hfirst < first:
+                    holes.append((hfirst,first-1))
+                continue
+            if first > hlast or last < hfirst:
+                holes.append((hfirst,hlast))
+                continue
+            if first > hfirst:
+                holes.append((hfirst,first-1))
+            if last < hlast and more:
+                holes.append((last+1,hlast))
+        self.holes = holes
+        if not more:
+            self.total = last+1
+        if len(self.buffer) <= last:
+            self.buffer.extend(bytes(last+1-len(self.buffer)))
+        self.buffer[first:last+1] = payload
+
+    def complete(self):
+        return not self.holes and self.total is not None
+
+
+class IPReassembler():
+    '''
+        Reensamblador de fragmentos IP. Los datagramas se indexan por (IP origen, IP destino, protocolo, IPID).
+        La memoria ocupada por todos los datagramas en reensamblado se limita a maxMemory bytes: si se supera se
+        descartan los datagramas más antiguos. Los datagramas que no se completan en timeout segundos se descartan.
+        Cada datagrama se entrega una única vez, en cuanto llega el último fragmento que faltaba.
+    '''
+    def __init__(self,timeout=REASSEMBLY_TIMEOUT,maxMemory=REASSEMBLY_MAX_MEMORY):
+        self.timeout = timeout
+        self.maxMemory = maxMemory
+        #Diccionario ordenado por instante de creación: los más antiguos son los primeros
+        self.datagrams = {}
+        self.memory = 0
+        self.lock = threading.Lock()
+        self.fragments = 0
+        self.reassembled = 0
+        self.timeouts = 0
+        self.memoryDrops = 0
+        self.invalid = 0
+
+    def add(self,key,offset,payload,more):
+        '''
+            Añade un fragmento. Devuelve el payload completo del datagrama si este fragmento lo completa o None en otro caso
+        '''
+        now = time.monotonic()
+        with self.lock:
+            self.fragments += 1
+            if offset + len(payload) > IP_MAX_DATAGRAM - IP_MIN_HLEN or (more and (len(payload) == 0 or len(payload) % 8 != 0)):
+                self.invalid += 1
+                return None
+            self.expire(now)
+            r = self.datagrams.get(key)
+            if r is None:
+                r = Reassembly(now+self.timeout)
+                self.datagrams[key] = r
+            before = len(r.buffer)
+            r.add(offset,payload,more)
+            self.memory += len(r.buffer) - before
+            if r.complete():
+                del self.datagrams[key]
+                self.memory -= len(r.buffer)
+                self.reassembled += 1
+                #El buffer ya no lo referencia el reensamblador: se entrega sin copiarlo
+                return memoryview(r.buffer)[:r.total]
+            while self.memory > self.maxMemory and self.datagrams:
+                oldest = next(iter(self.datagrams))
+                self.memory -= len(self.datagrams.pop(oldest).buffer)
+                self.memoryDrops += 1
+            return None
+
+    def expire(self,now):
+        #Se llama con self.lock tomado
+        while self.datagrams:
+            oldest = next(iter(self.datagrams))
+            r = self.datagrams[oldest]
+            if r.deadline > now:
+                return
+            del self.datagrams[oldest]
+            self.memory -= len(r.buffer)
+            self.timeouts += 1
+
+    def stats(self):
+        return {'pending':len(self.datagrams),'memory':self.memory,'fragments':self.fragments,'reassembled':self.reassembled,
+            'timeouts':self.timeouts,'memoryDrops':self.memoryDrops,'invalid':self.invalid}
+
+
+#Reensamblador de los datagramas fragmentados recibidos
+reassembler = IPReassembler()
+counters.registerCollector('ip_reassembly',lambda: reassembler.stats())
+
+#Fichero del kernel con la tabla de rutas
+PROC_NET_ROUTE = '/proc/net/route'
+#Bandera RTF_UP de las rutas del kernel
+RTF_UP = 0x0001
+#Métrica por defecto de las rutas
+DEFAULT_METRIC = 0
+#Número máximo de destinos en la caché de rutas
+ROUTE_CACHE_SIZE = 4096
+
+
+class Route():
+    '''
+        Ruta de la tabla de rutas. gateway es 0 en las rutas directamente conectadas (el siguiente salto es el propio destino)
+    '''
+    __slots__ = ('prefix','prefixLen','gateway','metric','interface')
+
+    def __init__(self,prefix,prefixLen,gateway,metric,interface):
+        self.prefix = prefix
+        self.prefixLen = prefixLen
+        self.gateway = gateway
+        self.metric = metric
+        self.interface = interface
+
+
+class RouteNode():
+    __slots__ = ('children','routes')
+
+    def __init__(self):
+        self.children = [None,None]
+        #Rutas con este prefijo ordenadas por métrica (la primera es la preferida)
+        self.routes = []
+
+
+class RoutingTable():
+    '''
+        Tabla de rutas IPv4 sobre un trie binario (radix) indexado por los bits de la dirección, de mayor a menor peso.
+        La búsqueda devuelve la ruta de prefijo más largo que contiene al destino y, entre las rutas con el mismo
+        prefijo, la de menor métrica.
+        El resultado de cada búsqueda se guarda en una caché por destino (dst -> siguiente salto) para que el
+        envío solo tenga que consultar un diccionario. La caché se vacía cada vez que cambia la tabla.
+    '''
+    def __init__(self):
+        self.root = RouteNode()
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def addRoute(self,prefix,prefixLen,gateway=0,metric=DEFAULT_METRIC,interface=None):
+        mask = (0xFFFFFFFF << (32-prefixLen)) & 0xFFFFFFFF
+        prefix &= mask
+        with self.lock:
+            node = self.root
+            for i in range(prefixLen):
+                bit = (prefix >> (31-i)) & 1
+                if node.children[bit] is None:
+                    node.children[bit] = RouteNode()
+                node = node.children[bit]
+            node.routes.append(Route(prefix,prefixLen,gateway,metric,interface))
+            node.routes.sort(key=lambda r: r.metric)
+            self.cache = {}
+
+    def deleteRoute(self,prefix,prefixLen,gateway=None):
+        '''
+            Borra las rutas con el prefijo dado (solo las que usan gateway si no es None). Devuelve cuántas se han borrado
+        '''
+        mask = (0xFFFFFFFF << (32-prefixLen)) & 0xFFFFFFFF
+        prefix &= mask
+        with self.lock:
+            node = self.root
+            for i in range(prefixLen):
+                node = node.children[(prefix >> (31-i)) & 1]
+                if node is None:
+                    return 0
+            before = len(node.routes)
+            node.routes = [r for r in node.routes if gateway is not None and r.gateway != gateway]
+            self.cache = {}
+            return before - len(node.routes)
+
+    def clear(self):
+        with self.lock:
+            self.root = RouteNode()
+            self.cache = {}
+
+    def lookup(self,dst):
+        '''
+            Devuelve la ruta (Route) de prefijo más largo para dst o None si no hay ninguna
+        '''
+        node = self.root
+        best = node.routes[0] if node.routes else None
+        for i in range(32):
+            node = node.children[(dst >> (31-i)) & 1]
+            if node is None:
+                break
+            if node.routes:
+                best = node.routes[0]
+        return best
+
+    def nextHop(self,dst):
+        '''
+            Devuelve la IP del siguiente salto para dst (el gateway de la ruta o el propio destino si está directamente
+            conectado) o None si no hay ruta
+        '''
+        hop = self.cache.get(dst)
+        if hop is None:
+            route = self.lookup(dst)
+            if route is None:
+                return None
+            hop = route.gateway if route.gateway else dst
+            cache = self.cache
+            if len(cache) >= ROUTE_CACHE_SIZE:
+                cache = self.cache = {}
+            cache[dst] = hop
+        return hop
+
+    def routes(self):
+        result = []
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            result.extend(node.routes)
+            pending.extend(n for n in node.children if n is not None)
+        return sorted(result,key=lambda r: (-r.prefixLen,r.prefix,r.metric))
+
+    def loadFromProc(self,interface=None,path=PROC_NET_ROUTE):
+        '''
+            Añade las rutas activas del kernel (de la interfaz indicada o de todas si es None). Devuelve cuántas se han añadido
+        '''
+        n = 0
+        for iface,dst,gw,mask,metric in readKernelRoutes(path):
+            if interface is not None and iface != interface:
+                continue
+            self.addRoute(dst,bin(mask).count('1'),gw,metric,iface)
+            n += 1
+        return n
+
+
+def readKernelRoutes(path=PROC_NET_ROUTE):
+    '''
+        Nombre: readKernelRoutes
+        Descripción: Esta función lee las rutas activas del kernel. En /proc/net/route las direcciones aparecen en hexadecimal
+            y en el orden de bytes de la máquina, por lo que se convierten a enteros de 32 bits en orden de red.
+        Argumentos:
+            -path: fichero con la tabla de rutas
+        Retorno: Lista de tuplas (interfaz, destino, gateway, máscara, métrica)
+    '''
+    routes = []
+    try:
+        with open(path) as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return routes
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8 or not (int(fields[3],16) & RTF_UP):
+            continue
+        dst,gw,mask = (socket.ntohl(int(fields[i],16)) for i in (1,2,7))
+        routes.append((fields[0],dst,gw,mask,int(fields[6])))
+    return routes
+
+
+#Tabla de rutas
+routingTable = RoutingTable()
+
+
+def addRoute(prefix,prefixLen,gateway=0,metric=DEFAULT_METRIC):
+    '''
+        Nombre: addRoute
+        Descripción: Esta función añade una ruta a la tabla de rutas
+        Argumentos:
+            -prefix: entero de 32 bits con la dirección de red
+            -prefixLen: longitud del prefijo (0 para la ruta por defecto)
+            -gateway: entero de 32 bits con la IP del siguiente salto o 0 si la red está directamente conectada
+            -metric: métrica de la ruta. Entre rutas con el mismo prefijo se usa la de menor métrica
+        Retorno: Ninguno
+    '''
+    routingTable.addRoute(prefix,prefixLen,gateway,metric)
+
+
+def deleteRoute(prefix,prefixLen,gateway=None):
+    '''
+        Nombre: deleteRoute
+        Descripción: Esta función borra rutas de la tabla de rutas
+        Argumentos:
+            -prefix: entero de 32 bits con la dirección de red
+            -prefixLen: longitud del prefijo
+            -gateway: si no es None solo se borran las rutas que usan este siguiente salto
+        Retorno: Número de rutas borradas
+    '''
+    return routingTable.deleteRoute(prefix,prefixLen,gateway)
+
+
+def printRoutes():
+    '''
+        Nombre: printRoutes
+        Descripción: Esta función imprime la tabla de rutas
+        Argumentos: Ninguno
+        Retorno: Ninguno
+    '''
+    print('{:>18}\t{:>15}\t{:>6}'.format('Destino','Gateway','Métrica'))
+    for r in routingTable.routes():
+        dst = socket.inet_ntoa(struct.pack('!I',r.prefix)) + '/' + str(r.prefixLen)
+        print('{:>18}\t{:>15}\t{:>6}'.format(dst,socket.inet_ntoa(struct.pack('!I',r.gateway)),r.metric))
 
 
 def chksum(msg):
     '''
         Nombre: chksum
-        Descripción: Esta función calcula el checksum IP sobre unos datos de entrada dados (msg)
+        Descripción: Esta función calcula el checksum IP sobre unos datos de entrada dados (msg).
+            En lugar de sumar las palabras de 16 bits una a una se interpreta todo el mensaje como un único entero
+            (con el mismo orden de bytes que las palabras) y se reduce módulo 0xFFFF, que equivale a la suma
+            en complemento a 1 con todos los acarreos.
         Argumentos:
             -msg: array de bytes con el contenido sobre el que se calculará el checksum
         Retorno: Entero de 16 bits con el resultado del checksum en ORDEN DE RED
     '''
-    s = 0
-    for i in range(0, len(msg), 2):
-        if (i+1) < len(msg):
-            a = msg[i]
-            b = msg[i+1]
-            s = s + (a+(b << 8))
-        elif (i+1)==len(msg):
-            s += msg[i]
-        else:
-            raise 'Error calculando el checksum'
-    s = s + (s >> 16)
-    s = ~s & 0xffff
+    s = int.from_bytes(msg,byteorder='little')
+    if s != 0:
+        s %= 0xffff
+        if s == 0:
+            s = 0xffff
+    return ~s & 0xffff
 
-    return s
+def chksum_update(checksum,oldWord,newWord):
+    '''
+        Nombre: chksum_update
+        Descripción: Esta función actualiza un checksum calculado con chksum cuando cambia una palabra de 16 bits
+            del mensaje, sin volver a sumar todo el mensaje (RFC 1624, ecuación 3: HC' = ~(~HC + ~m + m')).
+        Argumentos:
+            -checksum: checksum previo (tal y como lo devuelve chksum)
+            -oldWord: valor anterior de la palabra, leída con el mismo orden de bytes que usa chksum (struct '<H')
+            -newWord: valor nuevo de la palabra, leída de la misma forma
+        Retorno: Entero de 16 bits con el checksum actualizado
+    '''
+    s = (~checksum & 0xffff) + (~oldWord & 0xffff) + newWord
+    s = (s & 0xffff) + (s >> 16)
+    s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+def chksum_update_bytes(checksum,oldBytes,newBytes):
+    '''
+        Nombre: chksum_update_bytes
+        Descripción: Igual que chksum_update pero para un campo de longitud par que empieza en una posición par
+            del mensaje (por ejemplo la longitud total, el IPID o el TTL y protocolo de la cabecera IP).
+        Argumentos:
+            -checksum: checksum previo (tal y como lo devuelve chksum)
+            -oldBytes: bytes anteriores del campo
+            -newBytes: bytes nuevos del campo
+        Retorno: Entero de 16 bits con el checksum actualizado
+    '''
+    return chksum_update(checksum,int.from_bytes(oldBytes,byteorder='little') % 0xffff,int.from_bytes(newBytes,byteorder='little') % 0xffff)
 
 def getMTU(interface):
     '''
@@ -84,15 +434,16 @@ def getNetmask(interface):
 def getDefaultGW(interface):
     '''
         Nombre: getDefaultGW
-        Descripción: Esta función obteiene el gateway por defecto para una interfaz dada
+        Descripción: Esta función obteiene el gateway por defecto para una interfaz dada a partir de la tabla de rutas del kernel
         Argumentos:
             -interface: cadena con el nombre la interfaz sobre la que consultar el gateway
-        Retorno: Entero de 32 bits con la IP del gateway
+        Retorno: Entero de 32 bits con la IP del gateway o None si la interfaz no tiene ruta por defecto
     '''
-    p = subprocess.Popen(['ip r | grep default | awk \'{print $3}\''], stdout=subprocess.PIPE, shell=True)
-    dfw = p.stdout.read().decode('utf-8')
-    #print(dfw)
-    return struct.unpack('!I',socket.inet_aton(dfw))[0]
+    best = None
+    for iface,dst,gw,mask,metric in readKernelRoutes():
+        if iface == interface and dst == 0 and mask == 0 and (best is None or metric < best[1]):
+            best = (gw,metric)
+    return best[0] if best is not None else None
 
 
 def process_IP_datagram(us,header,data,srcMac):
@@ -104,8 +455,9 @@ def process_IP_datagram(us,header,data,srcMac):
                 -Extraer los campos de la cabecera IP (includa la longitud de la cabecera)
                 -Calcular el checksum sobre los bytes de la cabecera IP
                     -Comprobar que el resultado del checksum es 0. Si es distinto el datagrama se deja de procesar
-                -Analizar los bits de de MF y el offset. Si el offset tiene un valor != 0 dejar de procesar el datagrama (no vamos a reensamblar)
-                -Loggear (usando logging.debug) el valor de los siguientes campos:
+                -Analizar los bits de de MF y el offset. Si el datagrama es un fragmento (MF=1 u offset != 0) se entrega al reensamblador
+                y solo se continúa cuando el datagrama está completo
+                -Loggear (con una traza de nivel TRACE_DEBUG de ipTrace) el valor de los siguientes campos:
                     -Longitud de la cabecera IP
                     -IPID
                     -Valor de las banderas DF y MF
@@ -115,7 +467,7 @@ def process_IP_datagram(us,header,data,srcMac):
                 -Comprobar si tenemos registrada una función de callback de nivel superior consultando el diccionario protocols y usando como
                 clave el valor del campo protocolo del datagrama IP.
                     -En caso de que haya una función de nivel superior registrada, debe llamarse a dicha funciñón
-                    pasando los datos (payload) contenidos en el datagrama IP.
+                    pasando los datos (payload) contenidos en el datagrama IP (sin el relleno Ethernet que pueda haber tras la longitud total).
 
         Argumentos:
             -us: Datos de usuario pasados desde la llamada de pcap_loop. En nuestro caso será None
@@ -125,51 +477,51 @@ def process_IP_datagram(us,header,data,srcMac):
         Retorno: Ninguno
     '''
     #TODO:
-    version = data[0] & 0xF0
-    ihl = (data[0] & 0x0F)*4
-    typeOfService = data[1]
-    totalLength = data[2:4]
-    IPID_read = data[4:6] #se llama asi para no destrozar la variable global IPID
-    flagDF = ((data[6]>>5) & 0x02)>>1
-    flagMF = (data[6]>>5) & 0x01
-    print("DATA 6:", data[6:8])
-    offset = 0
-    '''if flagMF:
-        offset = ((struct.unpack('B', data[6])[0])*256-0b00100000)*8 + struct.unpack('B', data[7])[0]*8
-    else:
-        offset = (struct.unpack('B', data[6])[0])*256*8 + struct.unpack('B', data[7])[0]*8
-    '''
-
-    timeToLive = data[8]
-    protocol = data[9]
-    headerChecksum = data[10:12]
-    ipOrigen = data[12:16]
-    ipDestino = data[16:20]
-    options = data[20:]
-
-    print("[process_IP_datagram] Extracted all fields from datagram")
+    ipCounters.inc('rx_datagrams')
+    datagram = IPView(data)
+    if len(data) < IP_MIN_HLEN:
+        ipCounters.inc('rx_bad_length')
+        return
+    #Cabecera fija decodificada de una vez sobre la trama, sin copiar nada
+    versionIHL,typeOfService,length,IPID_read,flagsOffset,timeToLive,protocol,headerChecksum,ipOrigen,ipDestino = datagram.fields()
+    ihl = (versionIHL & 0x0F)*4
+    flagDF = (flagsOffset >> 14) & 0x01
+    flagMF = (flagsOffset >> 13) & 0x01
+    #El offset son los 13 bits de menor peso de los bytes 6 y 7, en unidades de 8 bytes
+    offset = (flagsOffset & 0x1FFF)*8
 
     #if chksum(data[:4*ihl]) != 0: 
     #    print("[process_IP_datagram] Checksum != 0, it's",chksum(data),".Returning")
     #    return
-    #OJO: Dice "Analizar los bits de de MF y el offset". Que analizamos de mf??
-    #OJO: Dice "para obtener el valor real de offset se debe multiplicar por 8"
-    #if offset != 0: return #
-    logging.debug(ihl)
-    #logging.debug(struct.unpack('!H', totalLength)[0])
-    logging.debug(IPID_read)
-    logging.debug(flagDF)
-    logging.debug(flagMF)
-    logging.debug(offset)
-    logging.debug(ipOrigen)
-    logging.debug(ipDestino)
-    logging.debug(protocol)
+    if ipTrace.debug:
+        ipTrace.log(TRACE_DEBUG,"[process_IP_datagram] ihl={} IPID={:04x} DF={} MF={} offset={} {} -> {} protocol={}",ihl,IPID_read,
+            flagDF,flagMF,offset,socket.inet_ntoa(struct.pack('!I',ipOrigen)),socket.inet_ntoa(struct.pack('!I',ipDestino)),protocol)
+
+    if length < ihl or length > len(data) or ihl < IP_MIN_HLEN:
+        ipCounters.inc('rx_bad_length')
+        if ipTrace.error:
+            ipTrace.log(TRACE_ERROR,"[process_IP_datagram] Wrong total length {}",length)
+        return
+
+    if forwardCallback is not None and ipDestino != myIP and ipDestino != 0xFFFFFFFF and (ipDestino | netmask) != 0xFFFFFFFF \
+            and (ipDestino >> 28) != 0xE:
+        forwardCallback(us, header, datagram.buf[:length])
+        return
 
     if protocols.get(protocol):
-        payload = data[ihl:]
-        protocols[protocol](us, header, payload, ipOrigen)
+        #Payload e IP origen son memoryview sobre la trama: no se copian al pasar al nivel superior
+        payload = datagram.buf[ihl:length]
+        if flagMF or offset:
+            ipCounters.inc('rx_fragments')
+            payload = reassembler.add((ipOrigen, ipDestino, protocol, IPID_read), offset, payload, flagMF)
+            if payload is None:
+                return
+            ipCounters.inc('rx_reassembled')
+        protocols[protocol](us, header, payload, datagram.srcBytes)
     else:
-        print("[process_IP_datagram] No function registered for protocol", protocol)
+        ipCounters.inc('rx_unknown_protocol')
+        if ipTrace.debug:
+            ipTrace.log(TRACE_DEBUG,"[process_IP_datagram] No function registered for protocol {}",protocol)
 
 
 def registerIPProtocol(callback,protocol):
@@ -188,7 +540,8 @@ def registerIPProtocol(callback,protocol):
                     -us: son los datos de usuarios pasados por pcap_loop (en nuestro caso este valor será siempre None)
                     -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
                     -data: payload del datagrama IP. Es decir, la cabecera IP NUNCA se pasa hacia arriba.
-                    -srcIP: dirección IP que ha enviado el datagrama actual.
+                    Es un memoryview sobre la trama recibida o sobre el datagrama reensamblado (ver views.py).
+                    -srcIP: dirección IP que ha enviado el datagrama actual (memoryview de 4 bytes).
                 La función no retornará nada. Si un datagrama se quiere descartar basta con hacer un return sin valor y dejará de procesarse.
             -protocol: valor del campo protocolo de IP para el cuál se quiere registrar una función de callback.
         Retorno: Ninguno
@@ -198,17 +551,35 @@ def registerIPProtocol(callback,protocol):
         protocols[protocol] = callback
 
 
+def setForwardCallback(callback):
+    '''
+        Nombre: setForwardCallback
+        Descripción: Esta función registra la función a la que se entregan los datagramas recibidos cuya IP destino no es
+            la propia (ni de difusión ni multicast), por ejemplo para reenviarlos por otra interfaz (ver interfaces.py).
+            Si callback es None (valor por defecto) todos los datagramas se procesan localmente.
+        Argumentos:
+            -callback: función con el prototipo funcion(us,header,datagram), donde datagram es un memoryview con el
+            datagrama IP completo (cabecera incluida, sin el relleno Ethernet)
+        Retorno: Ninguno
+    '''
+    global forwardCallback
+    forwardCallback = callback
+
+
 def initIP(interface,opts=None):
     global myIP, MTU, netmask, defaultGW,ipOpts
     '''
         Nombre: initIP
         Descripción: Esta función inicializará el nivel IP. Esta función debe realizar, al menos, las siguientes tareas:
             -Llamar a initARP para inicializar el nivel ARP
-            -Obtener (llamando a las funciones correspondientes) y almacenar en variables globales los siguientes datos:
+            -Obtener (llamando a las funciones correspondientes, o del enlace si este lleva su configuración IP) y almacenar
+            en variables globales los siguientes datos:
                 -IP propia
                 -MTU
                 -Máscara de red (netmask)
-                -Gateway por defecto
+                -Gateway por defecto (puede no existir)
+            -Cargar en la tabla de rutas las rutas del kernel para la interfaz. Si no hay ninguna, añadir la ruta de la
+            red propia y, si existe, la ruta por defecto
             -Almacenar el valor de opts en la variable global ipOpts
             -Registrar a nivel Ethernet (llamando a registerCallback) la función process_IP_datagram con el Ethertype 0x0800
         Argumentos:
@@ -220,16 +591,30 @@ def initIP(interface,opts=None):
     if initARP(interface) != True:
         return False
     #Guardando en variables globales. OJO: FUNCIONES DEVUELVEN ENTEROS?
-    myIP = getIP(interface) #
-    MTU = getMTU(interface)
-    netmask = getNetmask(interface) #
-    defaultGW = getDefaultGW(interface) #
-    if myIP == None or MTU == None or netmask == None or defaultGW == None:
+    link = getLink()
+    if link.ipAddr is not None:
+        #Enlace sin interfaz real (link.py): la configuración la lleva el propio enlace
+        myIP = link.ipAddr
+        MTU = link.mtu
+        netmask = link.netmask
+        defaultGW = link.gateway
+    else:
+        myIP = getIP(interface) #
+        MTU = getMTU(interface)
+        netmask = getNetmask(interface) #
+        defaultGW = getDefaultGW(interface) #
+    if myIP == None or MTU == None or netmask == None:
         return False
 
+    routingTable.clear()
+    if link.ipAddr is not None or routingTable.loadFromProc(interface) == 0:
+        routingTable.addRoute(myIP & netmask, bin(netmask).count('1'), 0, DEFAULT_METRIC, interface)
+        if defaultGW is not None:
+            routingTable.addRoute(0, 0, defaultGW, DEFAULT_METRIC, interface)
+
     ipOpts = opts
     registerCallback(process_IP_datagram, bytes([0x08,0x00]))
-    print("[initIP] IP initialized succesfully")
+    ipTrace.log(TRACE_INFO,"[initIP] IP initialized succesfully")
     return True
 
 
@@ -247,11 +632,9 @@ def sendIPDatagram(dstIP,data,protocol):
                 -Añadir los datos a la cabecera IP
                 -En el caso de que sea un fragmento ajustar los valores de los campos MF y offset de manera adecuada
                 -Enviar el datagrama o fragmento llamando a sendEthernetFrame. Para determinar la dirección MAC de destino
-                al enviar los datagramas:
-                    -Si la dirección IP destino está en mi subred:
-                        -Realizar una petición ARP para obtener la MAC asociada a dstIP y usar dicha MAC
-                    -Si la dirección IP destino NO está en mi subred:
-                        -Realizar una petición ARP para obtener la MAC asociada al gateway por defecto y usar dicha MAC
+                al enviar los datagramas (una única vez por datagrama):
+                    -Consultar en la tabla de rutas el siguiente salto (ruta de prefijo más largo). Si no hay ruta devolver False
+                    -Realizar una petición ARP para obtener la MAC asociada al siguiente salto y usar dicha MAC
             -Para cada datagrama (no fragmento):
                 -Incrementar la variable IPID en 1.
         Argumentos:
@@ -263,61 +646,86 @@ def sendIPDatagram(dstIP,data,protocol):
 
     '''
     #TODO:
-    print("[sendIPDatagram] Sending frame with protocol", protocol, "to", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',dstIP))))
+    if ipTrace.debug:
+        ipTrace.log(TRACE_DEBUG,"[sendIPDatagram] Sending datagram with protocol {} to {}",protocol,socket.inet_ntoa(struct.pack('!I',dstIP)))
 
+    nextHop = routingTable.nextHop(dstIP)
+    if nextHop is None:
+        ipCounters.inc('tx_no_route')
+        if ipTrace.info:
+            ipTrace.log(TRACE_INFO,"[sendIPDatagram] No route to {}",socket.inet_ntoa(struct.pack('!I',dstIP)))
+        return False
+    dstMac = ARPResolution(nextHop)
+    if dstMac is None:
+        ipCounters.inc('tx_no_arp')
+        return False
+
+    return sendIPFragments(dstIP,data,protocol,dstMac)
+
+
+def sendIPFragments(dstIP,data,protocol,dstMac):
+    global IPID, MTU, ipOpts
+    '''
+        Nombre: sendIPFragments
+        Descripción: Esta función construye y envía los fragmentos de un datagrama IP (ver sendIPDatagram) a una MAC de destino
+        ya resuelta. Permite enviar datagramas cuando la resolución ARP se ha hecho por otra vía (por ejemplo desde asyncio).
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino del datagrama
+            -data: array de bytes con los datos a incluir como payload en el datagrama
+            -protocol: valor numérico del campo IP protocolo
+            -dstMac: dirección MAC del siguiente salto
+        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+    '''
     len_opts = len(ipOpts) if ipOpts else 0
     if len_opts % 4 != 0:
-        ipOpts = ipOpts + (4 - (len_opts % 4)) * [0x00]
+        ipOpts = bytes(ipOpts) + bytes(4 - (len_opts % 4))
         len_opts = len(ipOpts)
 
     header_len = 20 + len_opts
     max_du = (MTU-header_len) - (MTU-header_len)%8 #max len datos utiles
     num_fragmentos = math.ceil(len(data) / max_du)
     
+    #La cabecera solo cambia entre fragmentos en la longitud total y en los campos de flags y offset
+    template = bytearray()
+    template += bytes(struct.pack('B', 0b01000000 + int(header_len/4)))#byte con 04 en 4 bits y hlen reducido en otros 4
+    template += bytes([0x00])#type of service always 0
+    template += bytes(struct.pack('!H', 0)) #totalLength (se rellena en cada fragmento)
+    template += bytes(struct.pack('!H', IPID))
+    template += bytes(struct.pack('!H', 0)) #flags y offset (se rellenan en cada fragmento)
+    template += bytes(struct.pack('B', 64))
+    template += bytes(struct.pack('B', protocol))
+    template += bytes(struct.pack('!H', 0)) #checksum a 0 ahora
+    template += bytes(struct.pack('!I', myIP))
+    template += bytes(struct.pack('!I', dstIP))
+    if ipOpts:
+        template += ipOpts
+
     for i in range (num_fragmentos):
-        print("---------------------- FRAGMENTO",i+1,"( i =",i,") ----------------------")
-        
-        header = bytearray()
-        header += bytes(struct.pack('B', 0b01000000 + int(header_len/4)))#byte con 04 en 4 bits y hlen reducido en otros 4
-        header += bytes([0x00])#type of service always 0
-        
+        header = bytearray(template)
+
         if i == num_fragmentos-1:
-            header += bytes(struct.pack('!H', len(data) - i*max_du + header_len)) #totalLength
+            header[2:4] = struct.pack('!H', len(data) - i*max_du + header_len) #totalLength
         else:
-            header += bytes(struct.pack('!H', max_du + header_len)) #totalLength
-        
-        header += bytes(struct.pack('!H', IPID))
-        
+            header[2:4] = struct.pack('!H', max_du + header_len) #totalLength
+
         div = int(i*max_du/8)
         if i == num_fragmentos-1:
-            header += bytes(struct.pack('B', div//256))
+            header[6:8] = struct.pack('!H', div)
         else:
-            header += bytes(struct.pack('B', div//256 + 0x20))
-        header += bytes(struct.pack('B', div%256))
-
-        header += bytes(struct.pack('B', 64))
-        header += bytes(struct.pack('B', protocol))
-        header += bytes(struct.pack('!H', 0)) #checksum a 0 ahora
-        header += bytes(struct.pack('!I', myIP))
-        header += bytes(struct.pack('!I', dstIP))
-        
-        if ipOpts: 
-            header += ipOpts
-        
+            header[6:8] = struct.pack('!H', div + 0x2000)
+
         header[10:12] = bytes(struct.pack('<H', chksum(header))) #calculamos el checksum
-        
+
         if i == num_fragmentos-1:
             header += data[i*max_du:]
         else:
             header += data[i*max_du:(i+1)*max_du]
-        
-        if (netmask & myIP) == (netmask & dstIP):
-            print("[sendIPDatagram] Seems", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',dstIP)) + " is in my network."))
-            sendEthernetFrame(header, len(header), bytes([0x08, 0x00]), ARPResolution(dstIP))
-        else:
-            print("[sendIPDatagram] Seems", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',dstIP)) + " is NOT in my network."))
-            sendEthernetFrame(header, len(header), bytes([0x08, 0x00]), ARPResolution(defaultGW))
 
-    print("[sendIPDatagram] IP datagram sent:", header)
-    IPID += 1
+        sendEthernetFrame(header, len(header), bytes([0x08, 0x00]), dstMac)
+
+    if ipTrace.debug:
+        ipTrace.log(TRACE_DEBUG,"[sendIPFragments] IPID {} sent in {} fragment(s), {} bytes",IPID,num_fragmentos,len(data))
+    IPID = (IPID + 1) & 0xFFFF
+    ipCounters.inc('tx_datagrams')
+    ipCounters.inc('tx_fragments',num_fragmentos)
     return True
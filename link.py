@@ -0,0 +1,303 @@
+'''
+    link.py
+    Backends de enlace para el nivel Ethernet. startEthernetLevel recibe un LinkBackend que abre el medio, envía las
+    tramas (send) y entrega las recibidas a una función (start). Implementaciones:
+        -PcapLiveLink: interfaz real con libpcap (pcap_open_live_tstamp/pcap_inject/pcap_loop)
+        -PcapFileLink: reproduce una traza pcap como tráfico recibido y graba (o solo cuenta) las tramas enviadas
+        -VirtualLink: puerto de un VirtualWire, un cable en memoria que une varias pilas del mismo proceso
+    Los backends que no son una interfaz real llevan la configuración IP (ipAddr, netmask, gateway, mtu) que de otro modo
+    se obtendría del sistema. loadStackInstance carga una copia independiente de los módulos de la pila para poder
+    unir varias pilas con un VirtualWire.
+'''
+
+from rc1_pcap import *
+import importlib
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+import types
+
+#Tamaño por defecto de la cola de recepción de cada puerto de un VirtualWire
+VIRTUAL_QUEUE_DEPTH = 4096
+#Módulos con estado de la pila, en orden de importación (ver loadStackInstance)
+STACK_MODULES = ['counters','ethernet','arp','ip','icmp','udp']
+#Tipos de marca de tiempo de pcap que toma el kernel con el reloj del sistema (None es el tipo por defecto, PCAP_TSTAMP_HOST)
+HOST_TSTAMP_TYPES = (None,PCAP_TSTAMP_HOST,PCAP_TSTAMP_HOST_LOWPREC,PCAP_TSTAMP_HOST_HIPREC)
+
+
+class LinkBackend():
+    '''
+        Interfaz común de los backends de enlace.
+            -mac: dirección MAC propia
+            -mtu, ipAddr, netmask, gateway: configuración IP del enlace (None si se obtiene del sistema)
+            -handle: descriptor de pcap si lo hay (por ejemplo para pcap_setnonblock) o None
+            -hostClock: True si la marca de tiempo de las tramas recibidas es la hora del sistema (la de time.time_ns), de
+             modo que se puede comparar con instantes tomados por la pila
+    '''
+    def __init__(self,mac,ipAddr=None,netmask=None,gateway=None,mtu=None):
+        self.mac = bytes(mac) if mac is not None else None
+        self.ipAddr = ipAddr
+        self.netmask = netmask
+        self.gateway = gateway
+        self.mtu = mtu
+        self.handle = None
+        self.hostClock = False
+
+    def open(self,errbuf):
+        '''
+            Abre el medio. Devuelve 0 si todo es correcto y -1 (rellenando errbuf) en otro caso
+        '''
+        return 0
+
+    def send(self,buf,size):
+        '''
+            Envía los size primeros bytes de buf (bytes, bytearray o memoryview). Devuelve los bytes enviados o -1
+        '''
+        raise NotImplementedError
+
+    def start(self,callback):
+        '''
+            Arranca la recepción: callback(us,header,data) se llamará con cada trama recibida
+        '''
+        pass
+
+    def setFilter(self,expr,errbuf):
+        '''
+            Instala un filtro de recepción (sintaxis de tcpdump) en el medio si este lo permite. Devuelve 0 si todo es
+            correcto (o si el medio no filtra) y -1 (rellenando errbuf) en otro caso. Se puede llamar con la recepción en
+            marcha (el nivel Ethernet lo hace al registrar cada Ethertype nuevo)
+        '''
+        return 0
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PcapLiveLink(LinkBackend):
+    '''
+        Interfaz de red real abierta con pcap_open_live_tstamp. La recepción se hace en un hilo que ejecuta pcap_loop.
+        precision y tstampType son la precisión y el tipo de marca de tiempo que se piden a libpcap; si la interfaz no
+        los admite se usan los de por defecto (la precisión obtenida queda en el atributo precision tras open).
+    '''
+    def __init__(self,interface,mac,snaplen=1514,promisc=1,to_ms=10,precision=PCAP_TSTAMP_PRECISION_NANO,tstampType=None):
+        LinkBackend.__init__(self,mac)
+        self.interface = interface
+        self.snaplen = snaplen
+        self.promisc = promisc
+        self.to_ms = to_ms
+        self.precision = precision
+        self.tstampType = tstampType
+        self.hostClock = tstampType in HOST_TSTAMP_TYPES
+        self.thread = None
+        self.callback = None
+
+    def open(self,errbuf):
+        self.handle = pcap_open_live_tstamp(self.interface,self.snaplen,self.promisc,self.to_ms,errbuf,self.precision,self.tstampType)
+        if not self.handle:
+            return -1
+        self.precision = pcap_get_tstamp_precision(self.handle)
+        return 0
+
+    def send(self,buf,size):
+        return pcap_inject(self.handle,buf,size)
+
+    def setFilter(self,expr,errbuf):
+        #Un pcap_t no se puede usar desde dos hilos a la vez: si el hilo de recepción está dentro de pcap_loop se para,
+        #se instala el filtro y se vuelve a arrancar. Las tramas que llegan mientras tanto esperan en el buffer del kernel
+        running = self.thread
+        if running is not None:
+            pcap_breakloop(self.handle)
+            running.join()
+            self.thread = None
+        ret = pcap_set_filter_expr(self.handle,expr,errbuf)
+        if running is not None:
+            self.start(self.callback)
+        return ret
+
+    def start(self,callback):
+        self.callback = callback
+        self.thread = threading.Thread(target=pcap_loop,args=(self.handle,-1,callback,None))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            pcap_breakloop(self.handle)
+            self.thread.join(1)
+            self.thread = None
+
+    def close(self):
+        if self.handle:
+            pcap_close(self.handle)
+            self.handle = None
+
+
+class PcapFileLink(LinkBackend):
+    '''
+        Enlace sobre ficheros pcap. Las tramas de infile (si se indica) se entregan como recibidas desde un hilo, tan
+        rápido como sea posible o respetando los tiempos de la traza (realtime=True). Las tramas enviadas van a un
+        PcapTxSink (atributo sink), que las cuenta y, si se indica outfile, las graba.
+    '''
+    def __init__(self,mac,infile=None,outfile=None,ipAddr=None,netmask=None,gateway=None,mtu=1500,realtime=False):
+        LinkBackend.__init__(self,mac,ipAddr,netmask,gateway,mtu)
+        self.infile = infile
+        self.outfile = outfile
+        self.realtime = realtime
+        self.sink = PcapTxSink()
+        self.thread = None
+
+    def open(self,errbuf):
+        if self.infile is not None:
+            self.handle = pcap_open_offline_mmap(self.infile,errbuf)
+            if self.handle is None:
+                return -1
+        if self.outfile is not None:
+            try:
+                self.sink.dumper = pcap_dump_open_file(self.outfile)
+            except OSError as e:
+                errbuf.extend(str(e).encode('ascii','replace'))
+                return -1
+        return 0
+
+    def send(self,buf,size):
+        return self.sink.inject(buf,size)
+
+    def replay(self,callback):
+        first = None
+        start = time.monotonic()
+        for header,data in packets(self.handle):
+            if self.realtime:
+                ts = header.ts.ns() / 1e9
+                if first is None:
+                    first = ts
+                delay = ts - first - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if self.handle.breakRequested:
+                break
+            callback(None,header,bytearray(data))
+
+    def start(self,callback):
+        if self.handle is None:
+            return
+        self.thread = threading.Thread(target=self.replay,args=(callback,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            pcap_breakloop(self.handle)
+            self.thread.join(1)
+            self.thread = None
+
+    def close(self):
+        if self.handle is not None:
+            pcap_close(self.handle)
+            self.handle = None
+        if self.sink.dumper is not None:
+            pcap_dump_close(self.sink.dumper)
+            self.sink.dumper = None
+
+
+class VirtualWire():
+    '''
+        Cable en memoria que une varios VirtualLink: cada trama enviada por un puerto se copia en la cola de recepción
+        de todos los demás. Se puede simular pérdida con loss (probabilidad de descartar cada copia).
+    '''
+    def __init__(self,loss=0.0):
+        self.ports = []
+        self.loss = loss
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def attach(self,port):
+        with self.lock:
+            self.ports = self.ports + [port]
+
+    def detach(self,port):
+        with self.lock:
+            self.ports = [p for p in self.ports if p is not port]
+
+    def transmit(self,src,buf,size):
+        frame = bytes(memoryview(buf)[:size])
+        for port in self.ports:
+            if port is src:
+                continue
+            if self.loss and self.random.random() < self.loss:
+                continue
+            port.deliver(frame)
+        return size
+
+
+class VirtualLink(LinkBackend):
+    '''
+        Puerto de un VirtualWire. Las tramas recibidas se encolan (hasta queueDepth; las que no caben se descartan y se
+        cuentan en dropped) y un hilo las entrega a la función de recepción, igual que haría el hilo de pcap_loop.
+    '''
+    def __init__(self,wire,mac,ipAddr,netmask,gateway=None,mtu=1500,queueDepth=VIRTUAL_QUEUE_DEPTH):
+        LinkBackend.__init__(self,mac,ipAddr,netmask,gateway,mtu)
+        self.wire = wire
+        self.queue = queue.Queue(queueDepth)
+        self.thread = None
+        self.dropped = 0
+        self.hostClock = True
+
+    def open(self,errbuf):
+        self.wire.attach(self)
+        return 0
+
+    def send(self,buf,size):
+        return self.wire.transmit(self,buf,size)
+
+    def deliver(self,frame):
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self,callback):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            now = time.time_ns()
+            callback(None,pcap_pkthdr(len(frame),len(frame),timeval(now // 1000000000,tv_nsec=now % 1000000000)),bytearray(frame))
+
+    def start(self,callback):
+        self.thread = threading.Thread(target=self.run,args=(callback,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(1)
+            self.thread = None
+
+    def close(self):
+        self.wire.detach(self)
+
+
+def loadStackInstance():
+    '''
+        Nombre: loadStackInstance
+        Descripción: Esta función importa una copia nueva de los módulos de la pila (STACK_MODULES) con su propio estado
+        (variables globales, caché ARP, tabla de rutas, contadores...) sin afectar a los ya importados. Así se pueden
+        tener varias pilas en el mismo proceso, por ejemplo unidas con un VirtualWire.
+        Argumentos: Ninguno
+        Retorno: Objeto con un atributo por módulo (counters, ethernet, arp, ip, icmp, udp)
+    '''
+    saved = {name:sys.modules.pop(name) for name in STACK_MODULES if name in sys.modules}
+    try:
+        modules = {name:importlib.import_module(name) for name in STACK_MODULES}
+    finally:
+        for name in STACK_MODULES:
+            sys.modules.pop(name,None)
+        sys.modules.update(saved)
+    return types.SimpleNamespace(**modules)
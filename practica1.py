@@ -2,6 +2,8 @@
     practica1.py
     Muestra el tiempo de llegada de los primeros 50 paquetes a la interfaz especificada
     como argumento y los vuelca a traza nueva con tiempo actual
+    Con --fast la función de callback solo encola los paquetes: un hilo escritor los vuelca por lotes (con volcado
+    periódico a disco y rotación de ficheros por tamaño o tiempo) y muestra un resumen de 1 de cada --sample paquetes
     Autor: Javier Ramos <javier.ramos@uam.es>
     2019 EPS-UAM
 '''
@@ -14,6 +16,8 @@ import argparse
 from argparse import RawTextHelpFormatter
 import time
 import logging
+import queue
+import threading
 
 ETH_FRAME_MAX = 1514
 PROMISC = 1
@@ -21,6 +25,10 @@ NO_PROMISC = 0
 TO_MS = 10
 num_paquete = 0
 TIME_OFFSET = 30*60
+#Paquetes descartados en modo --fast por tener la cola del escritor llena
+descartados = 0
+#Número máximo de paquetes que el escritor procesa de una vez
+WRITER_BATCH = 1024
 
 def signal_handler(nsignal,frame):
 	logging.info('Control C pulsado')
@@ -28,25 +36,132 @@ def signal_handler(nsignal,frame):
 		pcap_breakloop(handle)
 
 
+def hexdump(data,nbytes):
+	#Los nbytes primeros bytes en hexadecimal separados por espacios
+	return bytes(data[:nbytes]).hex(' ').upper()
+
+
 def procesa_paquete(us,header,data):
 	global num_paquete, pdumper
 	logging.info('Nuevo paquete de {} bytes capturado a las {}.{}'.format(header.len,header.ts.tv_sec,header.ts.tv_sec))
 	num_paquete += 1
 	#TODO imprimir los N primeros bytes
-
-	if args.nbytes > header.len:
-		for i in range(header.len):
-			print('{:02X}'.format(data[i]),end = ' ')
-	else:
-		for i in range(args.nbytes):
-			print('{:02X}'.format(data[i]),end = ' ')
-
-	print("\n")
+	print(hexdump(data,min(args.nbytes,header.len)) + '\n')
 	if args.interface != False:
 		header.ts.tv_sec += 1800
 		pcap_dump(pdumper, header, data)
 	#Escribir el tráfico al fichero de captura con el offset temporal
 
+
+def encola_paquete(us,header,data):
+	#Callback del modo --fast: no imprime ni escribe nada, solo encola el paquete para el hilo escritor
+	global num_paquete, descartados
+	num_paquete += 1
+	try:
+		cola.put_nowait((header,data))
+	except queue.Full:
+		descartados += 1
+
+
+class CaptureWriter(threading.Thread):
+	'''
+		Hilo escritor del modo --fast. Saca los paquetes de la cola por lotes, los vuelca con un PcapFileWriter (si se
+		ha indicado prefijo de fichero) y muestra un resumen de 1 de cada sample paquetes. Los resúmenes de cada lote se
+		escriben de una vez en la salida estándar. El fichero se vuelca a disco cada flushInterval segundos y se rota
+		(se cierra y se abre uno nuevo) cuando supera rotateSize bytes o lleva abierto rotateTime segundos (0 desactiva
+		cada criterio).
+	'''
+	def __init__(self,cola,prefix,nbytes,sample=1,flushInterval=1.0,rotateSize=0,rotateTime=0):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.cola = cola
+		self.prefix = prefix
+		self.nbytes = nbytes
+		self.sample = max(1,sample)
+		self.flushInterval = flushInterval
+		self.rotateSize = rotateSize
+		self.rotateTime = rotateTime
+		self.dumper = None
+		self.fileBytes = 0
+		self.fileOpened = 0
+		self.files = []
+		self.seen = 0
+		self.written = 0
+
+	def openFile(self):
+		if self.prefix is None:
+			return
+		if self.rotateSize or self.rotateTime:
+			fname = '{}.{:03d}.pcap'.format(self.prefix,len(self.files))
+		else:
+			fname = '{}.pcap'.format(self.prefix)
+		self.dumper = pcap_dump_open_file(fname,DLT_EN10MB,ETH_FRAME_MAX)
+		self.files.append(fname)
+		self.fileBytes = 0
+		self.fileOpened = time.monotonic()
+
+	def closeFile(self):
+		if self.dumper is not None:
+			pcap_dump_close(self.dumper)
+			self.dumper = None
+
+	def write(self,batch):
+		lines = []
+		for header,data in batch:
+			self.seen += 1
+			if self.seen % self.sample == 0:
+				lines.append('{} {}.{:06d} {} {}'.format(self.seen,header.ts.tv_sec,header.ts.tv_usec,header.len,
+					hexdump(data,min(self.nbytes,header.caplen))))
+			if self.dumper is None:
+				continue
+			if self.rotateSize and self.fileBytes >= self.rotateSize:
+				self.closeFile()
+				self.openFile()
+			header.ts.tv_sec += TIME_OFFSET
+			pcap_dump(self.dumper,header,data)
+			self.fileBytes += PCAP_RECORD_HLEN + header.caplen
+			self.written += 1
+		if lines:
+			sys.stdout.write('\n'.join(lines) + '\n')
+
+	def run(self):
+		self.openFile()
+		lastFlush = time.monotonic()
+		stop = False
+		while not stop:
+			try:
+				item = self.cola.get(timeout=self.flushInterval)
+			except queue.Empty:
+				item = ()
+			batch = []
+			while item is not None:
+				if item:
+					batch.append(item)
+				if len(batch) >= WRITER_BATCH:
+					break
+				try:
+					item = self.cola.get_nowait()
+				except queue.Empty:
+					break
+			stop = item is None
+			self.write(batch)
+			now = time.monotonic()
+			if self.dumper is not None and self.rotateTime and now - self.fileOpened >= self.rotateTime:
+				self.closeFile()
+				self.openFile()
+			elif now - lastFlush >= self.flushInterval:
+				if self.dumper is not None:
+					self.dumper.flush()
+				sys.stdout.flush()
+				lastFlush = now
+		self.closeFile()
+		sys.stdout.flush()
+
+	def stop(self):
+		#Se procesan todos los paquetes que queden en la cola antes de terminar
+		self.cola.put(None)
+		self.join()
+
 if __name__ == "__main__":
 	global pdumper,args,handle
 	parser = argparse.ArgumentParser(description='Captura tráfico de una interfaz ( o lee de fichero) y muestra la longitud y timestamp de los 50 primeros paquetes',
@@ -55,6 +170,12 @@ if __name__ == "__main__":
 	parser.add_argument('--itf', dest='interface', default=False,help='Interfaz a abrir')
 	parser.add_argument('--nbytes', dest='nbytes', type=int, default=14,help='Número de bytes a mostrar por paquete')
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
+	parser.add_argument('--fast', dest='fast', default=False, action='store_true',help='Modo de captura de alto rendimiento: volcado en un hilo aparte')
+	parser.add_argument('--sample', dest='sample', type=int, default=1,help='Con --fast, mostrar el resumen de 1 de cada N paquetes')
+	parser.add_argument('--queue', dest='queueDepth', type=int, default=65536,help='Con --fast, paquetes que caben en la cola del escritor')
+	parser.add_argument('--flush', dest='flush', type=float, default=1.0,help='Con --fast, segundos entre volcados a disco')
+	parser.add_argument('--rotate-size', dest='rotateSize', type=float, default=0,help='Con --fast, rotar el fichero de captura al superar N MB (0 no rota)')
+	parser.add_argument('--rotate-time', dest='rotateTime', type=float, default=0,help='Con --fast, rotar el fichero de captura cada N segundos (0 no rota)')
 	args = parser.parse_args()
 
 	if args.debug:
@@ -80,13 +201,26 @@ if __name__ == "__main__":
 	elif args.tracefile != False:
 		handle = pcap_open_offline(args.tracefile, errbuf)
 
-	#TODO abrir un dumper para volcar el tráfico (si se ha especificado interfaz)
-	descr = pcap_open_dead(DLT_EN10MB,ETH_FRAME_MAX)
+	if not handle:
+		logging.error('No se ha podido abrir la captura: {}'.format(errbuf.decode('ascii','replace')))
+		sys.exit(-1)
+
+	writer = None
+	descr = None
+	if args.fast:
+		cola = queue.Queue(args.queueDepth)
+		prefix = 'captura.'+args.interface+'.'+fecha if args.interface != False else None
+		writer = CaptureWriter(cola,prefix,args.nbytes,args.sample,args.flush,int(args.rotateSize*1024*1024),args.rotateTime)
+		writer.start()
+		ret = pcap_loop(handle,-1,encola_paquete,None)
+	else:
+		#TODO abrir un dumper para volcar el tráfico (si se ha especificado interfaz)
+		descr = pcap_open_dead(DLT_EN10MB,ETH_FRAME_MAX)
 
-	if args.interface != False:#handler de escritura
-		pdumper = pcap_dump_open(descr,'captura.'+args.interface+'.'+fecha+'.pcap')
+		if args.interface != False:#handler de escritura
+			pdumper = pcap_dump_open(descr,'captura.'+args.interface+'.'+fecha+'.pcap')
 
-	ret = pcap_loop(handle,-1,procesa_paquete,None)
+		ret = pcap_loop(handle,-1,procesa_paquete,None)
 	if ret == -1:
 		logging.error('Error al capturar un paquete')
 	elif ret == -2:
@@ -94,6 +228,9 @@ if __name__ == "__main__":
 	elif ret == 0:
 		logging.debug('No mas paquetes o limite superado')
 	logging.info('{} paquetes procesados'.format(num_paquete))
+	if writer is not None:
+		writer.stop()
+		logging.info('{} paquetes volcados en {} fichero(s), {} descartados por cola llena'.format(writer.written,len(writer.files),descartados))
 
 	#TODO si se ha creado un dumper cerrarlo
 	if pdumper != None:
@@ -31,6 +31,7 @@ if __name__ == "__main__":
 
 	if args.debug:
 		logging.basicConfig(level = logging.DEBUG, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+		setTraceLevel(None,TRACE_DEBUG)
 	else:
 		logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
 
@@ -35,10 +35,14 @@ if __name__ == "__main__":
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
 	parser.add_argument('--addOptions', dest='addOptions', default=False, action='store_true',help='Añadir opciones a los datagranas IP')
 	parser.add_argument('--dataFile',dest='dataFile',default = False,help='Fichero con datos a enviar')
+	parser.add_argument('--pingCount', dest='pingCount', type=int, default=100,help='Número de pings de la ráfaga (opción 3)')
+	parser.add_argument('--pingRate', dest='pingRate', type=float, default=10.0,help='Pings por segundo de la ráfaga (opción 3)')
+	parser.add_argument('--pingSize', dest='pingSize', type=int, default=56,help='Tamaño de los datos de cada ping de la ráfaga (opción 3)')
 	args = parser.parse_args()
 
 	if args.debug:
 		logging.basicConfig(level = logging.DEBUG, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+		setTraceLevel(None,TRACE_DEBUG)
 	else:
 		logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
 
@@ -76,7 +80,7 @@ if __name__ == "__main__":
 
 	while True:
 		try:
-			msg = input('Introduzca opcion:\n\t1.Enviar ping\n\t2.Enviar datagrama UDP:\n')
+			msg = input('Introduzca opcion:\n\t1.Enviar ping\n\t2.Enviar datagrama UDP\n\t3.Enviar ráfaga de pings:\n')
 			if msg == 'q':
 				break
 			elif msg == '1':
@@ -84,6 +88,8 @@ if __name__ == "__main__":
 				ICMP_SEQNUM += 1
 			elif msg == '2':
 				sendUDPDatagram(data,DST_PORT,struct.unpack('!I',socket.inet_aton(args.dstIP))[0])
+			elif msg == '3':
+				runPing(struct.unpack('!I',socket.inet_aton(args.dstIP))[0],args.pingCount,args.pingRate,args.pingSize)
 		except KeyboardInterrupt:
 			print('\n')
 			break
@@ -1,17 +1,51 @@
 import ctypes,sys
+import itertools
+import mmap
+import os
+import struct
+import time
+from array import array
 from ctypes.util import find_library
 
-user_callback = None
-
 DLT_EN10MB = 1
 
+#Números mágicos de la cabecera global de un fichero pcap (resolución de microsegundos y de nanosegundos)
+TCPDUMP_MAGIC = 0xa1b2c3d4
+NSEC_TCPDUMP_MAGIC = 0xa1b23c4d
+PCAP_VERSION_MAJOR = 2
+PCAP_VERSION_MINOR = 4
+#Tamaño de la cabecera global y de la cabecera de cada registro de un fichero pcap
+PCAP_FILE_HLEN = 24
+PCAP_RECORD_HLEN = 16
+#Precisión de las marcas de tiempo (pcap_set_tstamp_precision)
+PCAP_TSTAMP_PRECISION_MICRO = 0
+PCAP_TSTAMP_PRECISION_NANO = 1
+#Tipos de marca de tiempo (pcap_set_tstamp_type). Las de tipo ADAPTER las pone la tarjeta de red (hardware)
+PCAP_TSTAMP_HOST = 0
+PCAP_TSTAMP_HOST_LOWPREC = 1
+PCAP_TSTAMP_HOST_HIPREC = 2
+PCAP_TSTAMP_ADAPTER = 3
+PCAP_TSTAMP_ADAPTER_UNSYNCED = 4
+PCAP_TSTAMP_HOST_HIPREC_UNSYNCED = 5
+#Códigos de retorno de pcap_activate y de las funciones pcap_set_*
+PCAP_ERROR = -1
+PCAP_ERROR_CANTSET_TSTAMP_TYPE = -10
+PCAP_ERROR_TSTAMP_PRECISION_NOTSUP = -12
+PCAP_WARNING_TSTAMP_TYPE_NOTSUP = 3
+
 def mycallback(us,h,data):
+    #us es la clave del contexto registrado por pcap_loop/pcap_dispatch
+    #Si el descriptor tiene precisión de nanosegundos libpcap deja los nanosegundos en el campo tv_usec
+    callback_fun,user,nano = _callbackContexts[us]
     header = pcap_pkthdr ()
     header.len = h[0].len
     header.caplen = h[0].caplen
-    header.ts = timeval(h[0].tv_sec,h[0].tv_usec)
-    if user_callback is not None:
-        user_callback (us,header,bytearray(data[:header.caplen]))
+    header.ts = timeval(h[0].tv_sec,tv_nsec=h[0].tv_usec if nano else h[0].tv_usec*1000)
+    callback_fun (user,header,bytearray(ctypes.string_at(data,header.caplen)))
+
+def batchcallback(us,h,data):
+    #us es la clave del lote (PcapBatch) registrado por pcap_dispatch_batch
+    _callbackContexts[us].append_raw(h[0],data)
 
 
 
@@ -19,140 +53,788 @@ pcap = ctypes.cdll.LoadLibrary("libpcap.so")
 
 
 class timeval():
-    def __init__(self,tv_sec,tv_usec):
+    '''
+        Marca de tiempo de una trama con resolución de nanosegundos (tv_nsec). tv_usec se calcula a partir de tv_nsec,
+        de modo que el código que trabaja en microsegundos sigue funcionando igual
+    '''
+    __slots__ = ('tv_sec','tv_nsec')
+
+    def __init__(self,tv_sec,tv_usec=0,tv_nsec=None):
         self.tv_sec = tv_sec
-        self.tv_usec = tv_usec
+        self.tv_nsec = tv_nsec if tv_nsec is not None else tv_usec*1000
+
+    @property
+    def tv_usec(self):
+        return self.tv_nsec // 1000
+
+    @tv_usec.setter
+    def tv_usec(self,value):
+        self.tv_nsec = value*1000
+
+    def ns(self):
+        #Marca de tiempo completa en nanosegundos
+        return self.tv_sec*1000000000 + self.tv_nsec
 
 class pcap_pkthdr():
-    def __init__(self):
-        self.len=0
-        self.caplen=0
-        self.ts=timeval(0,0)
+    def __init__(self,len=0,caplen=0,ts=None):
+        self.len=len
+        self.caplen=caplen
+        self.ts=ts if ts is not None else timeval(0,0)
 
 class pcappkthdr(ctypes.Structure):
     _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long), ("caplen", ctypes.c_uint32), ("len", ctypes.c_uint32)]
 
 
-def pcap_open_offline(fname,errbuf):
+#  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
+PCAP_HANDLER = ctypes.CFUNCTYPE(None, ctypes.c_void_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
+#Los thunks de C se crean una única vez. Cada llamada en curso a pcap_loop/pcap_dispatch registra su contexto
+#en _callbackContexts y pasa la clave a libpcap como puntero de usuario, de modo que varios handles pueden
+#recibir a la vez desde hilos distintos.
+_pcapHandler = PCAP_HANDLER(mycallback)
+_batchHandler = PCAP_HANDLER(batchcallback)
+_callbackContexts = {}
+_contextKeys = itertools.count(1)
+
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+PCAP_ERRBUF_SIZE = 256
+
+class bpf_insn(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_ushort), ("jt", ctypes.c_ubyte), ("jf", ctypes.c_ubyte), ("k", ctypes.c_uint32)]
+
+class bpf_program(ctypes.Structure):
+    _fields_ = [("bf_len", ctypes.c_uint), ("bf_insns", ctypes.POINTER(bpf_insn))]
+
+
+def _bind(name,restype,argtypes):
+    #Obtiene la función de libpcap y fija sus tipos una única vez (al importar el módulo)
+    fun = getattr(pcap,name)
+    fun.restype = restype
+    fun.argtypes = argtypes
+    return fun
+
+def _bind_optional(name,restype,argtypes):
+    #Igual que _bind para las funciones que no existen en todas las versiones de libpcap: devuelve None si falta
+    try:
+        return _bind(name,restype,argtypes)
+    except AttributeError:
+        return None
+
+#Los pcap_t y pcap_dumper_t se manejan como punteros opacos (c_void_p): un entero o None si la llamada falla
+_c_pcap_open_live = _bind('pcap_open_live',ctypes.c_void_p,[ctypes.c_char_p,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_char_p])
+_c_pcap_open_offline = _bind('pcap_open_offline',ctypes.c_void_p,[ctypes.c_char_p,ctypes.c_char_p])
+_c_pcap_open_dead = _bind('pcap_open_dead',ctypes.c_void_p,[ctypes.c_int,ctypes.c_int])
+_c_pcap_close = _bind('pcap_close',None,[ctypes.c_void_p])
+_c_pcap_dump_open = _bind('pcap_dump_open',ctypes.c_void_p,[ctypes.c_void_p,ctypes.c_char_p])
+_c_pcap_dump = _bind('pcap_dump',None,[ctypes.c_void_p,ctypes.POINTER(pcappkthdr),ctypes.c_void_p])
+_c_pcap_dump_flush = _bind('pcap_dump_flush',ctypes.c_int,[ctypes.c_void_p])
+_c_pcap_dump_close = _bind('pcap_dump_close',None,[ctypes.c_void_p])
+#pcap_next devuelve un puntero a los datos (no una cadena C: las tramas contienen bytes nulos)
+_c_pcap_next = _bind('pcap_next',ctypes.c_void_p,[ctypes.c_void_p,ctypes.POINTER(pcappkthdr)])
+_c_pcap_next_ex = _bind('pcap_next_ex',ctypes.c_int,[ctypes.c_void_p,ctypes.POINTER(ctypes.POINTER(pcappkthdr)),
+    ctypes.POINTER(ctypes.c_void_p)])
+_c_pcap_loop = _bind('pcap_loop',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int,PCAP_HANDLER,ctypes.c_void_p])
+_c_pcap_dispatch = _bind('pcap_dispatch',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int,PCAP_HANDLER,ctypes.c_void_p])
+_c_pcap_breakloop = _bind('pcap_breakloop',None,[ctypes.c_void_p])
+_c_pcap_get_selectable_fd = _bind('pcap_get_selectable_fd',ctypes.c_int,[ctypes.c_void_p])
+_c_pcap_setnonblock = _bind('pcap_setnonblock',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int,ctypes.c_char_p])
+_c_pcap_geterr = _bind('pcap_geterr',ctypes.c_char_p,[ctypes.c_void_p])
+_c_pcap_compile = _bind('pcap_compile',ctypes.c_int,[ctypes.c_void_p,ctypes.POINTER(bpf_program),ctypes.c_char_p,ctypes.c_int,ctypes.c_uint32])
+_c_pcap_setfilter = _bind('pcap_setfilter',ctypes.c_int,[ctypes.c_void_p,ctypes.POINTER(bpf_program)])
+_c_pcap_freecode = _bind('pcap_freecode',None,[ctypes.POINTER(bpf_program)])
+_c_pcap_inject = _bind('pcap_inject',ctypes.c_int,[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_size_t])
+#Apertura en dos pasos (pcap_create + pcap_activate) y marcas de tiempo: pueden faltar en versiones antiguas de libpcap
+_c_pcap_create = _bind_optional('pcap_create',ctypes.c_void_p,[ctypes.c_char_p,ctypes.c_char_p])
+_c_pcap_set_snaplen = _bind_optional('pcap_set_snaplen',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int])
+_c_pcap_set_promisc = _bind_optional('pcap_set_promisc',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int])
+_c_pcap_set_timeout = _bind_optional('pcap_set_timeout',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int])
+_c_pcap_activate = _bind_optional('pcap_activate',ctypes.c_int,[ctypes.c_void_p])
+_c_pcap_statustostr = _bind_optional('pcap_statustostr',ctypes.c_char_p,[ctypes.c_int])
+_c_pcap_set_tstamp_type = _bind_optional('pcap_set_tstamp_type',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int])
+_c_pcap_tstamp_type_name_to_val = _bind_optional('pcap_tstamp_type_name_to_val',ctypes.c_int,[ctypes.c_char_p])
+_c_pcap_set_tstamp_precision = _bind_optional('pcap_set_tstamp_precision',ctypes.c_int,[ctypes.c_void_p,ctypes.c_int])
+_c_pcap_get_tstamp_precision = _bind_optional('pcap_get_tstamp_precision',ctypes.c_int,[ctypes.c_void_p])
+_c_pcap_open_offline_with_tstamp_precision = _bind_optional('pcap_open_offline_with_tstamp_precision',ctypes.c_void_p,
+    [ctypes.c_char_p,ctypes.c_uint,ctypes.c_char_p])
+_c_pcap_open_dead_with_tstamp_precision = _bind_optional('pcap_open_dead_with_tstamp_precision',ctypes.c_void_p,
+    [ctypes.c_int,ctypes.c_int,ctypes.c_uint])
+
+
+def _buffer_pointer(buf,size):
+    '''
+        Devuelve un objeto que ctypes puede pasar como const void* con los size primeros bytes de buf. Los bytes y los
+        buffers modificables (bytearray, memoryview sobre ellos) se pasan sin copiarlos; los de solo lectura se copian.
+    '''
+    if type(buf) is bytes:
+        return buf
+    try:
+        return (ctypes.c_char*size).from_buffer(buf)
+    except TypeError:
+        return (ctypes.c_char*size).from_buffer_copy(buf)
+
+
+class PcapBatch():
+    '''
+        Lote de tramas recibidas con pcap_dispatch_batch. Las tramas se copian en un área de memoria (arena)
+        reservada una única vez y que se reutiliza en cada llamada. Para cada trama se guardan su desplazamiento
+        dentro de la arena, la longitud capturada, la longitud real y la marca de tiempo (segundos y nanosegundos).
+        Las tramas (memoryview sobre la arena) solo son válidas hasta la siguiente llamada que rellene el lote.
+    '''
+    def __init__(self,maxcnt,snaplen=65535):
+        self.maxcnt = maxcnt
+        self.snaplen = snaplen
+        self.arena = bytearray(maxcnt*snaplen)
+        self.arenaView = memoryview(self.arena)
+        self.arenaAddr = ctypes.addressof((ctypes.c_char*len(self.arena)).from_buffer(self.arena))
+        self.offsets = array('L',[0])*maxcnt
+        self.caplens = array('L',[0])*maxcnt
+        self.lens = array('L',[0])*maxcnt
+        self.tv_sec = array('q',[0])*maxcnt
+        self.tv_nsec = array('q',[0])*maxcnt
+        #Precisión del descriptor que rellena el lote con append_raw (la fija pcap_dispatch_batch)
+        self.nano = False
+        self.count = 0
+        self.used = 0
+
+    def reset(self):
+        self.count = 0
+        self.used = 0
+
+    def append_raw(self,h,data):
+        #h es una estructura pcappkthdr y data un puntero a los bytes de la trama
+        i = self.count
+        if i >= self.maxcnt:
+            return
+        caplen = min(h.caplen,self.snaplen)
+        ctypes.memmove(self.arenaAddr+self.used,data,caplen)
+        self.offsets[i] = self.used
+        self.caplens[i] = caplen
+        self.lens[i] = h.len
+        self.tv_sec[i] = h.tv_sec
+        self.tv_nsec[i] = h.tv_usec if self.nano else h.tv_usec*1000
+        self.used += caplen
+        self.count = i+1
+
+    def append(self,header,data):
+        #Igual que append_raw pero con una cabecera pcap_pkthdr y cualquier objeto con protocolo buffer
+        i = self.count
+        if i >= self.maxcnt:
+            return
+        caplen = min(header.caplen,len(data),self.snaplen)
+        self.arenaView[self.used:self.used+caplen] = memoryview(data)[:caplen]
+        self.offsets[i] = self.used
+        self.caplens[i] = caplen
+        self.lens[i] = header.len
+        self.tv_sec[i] = header.ts.tv_sec
+        self.tv_nsec[i] = header.ts.tv_nsec
+        self.used += caplen
+        self.count = i+1
+
+    def __len__(self):
+        return self.count
+
+    def frame(self,i):
+        off = self.offsets[i]
+        return self.arenaView[off:off+self.caplens[i]]
+
+    def header(self,i):
+        return pcap_pkthdr(self.lens[i],self.caplens[i],timeval(self.tv_sec[i],tv_nsec=self.tv_nsec[i]))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.header(i),self.frame(i)
+
+
+def pcap_open_offline(fname,errbuf,precision=PCAP_TSTAMP_PRECISION_MICRO):
     #pcap_t *pcap_open_offline(const char *fname, char *errbuf);
-    poo = pcap.pcap_open_offline
+    #Con precision=PCAP_TSTAMP_PRECISION_NANO se usa pcap_open_offline_with_tstamp_precision (si libpcap la tiene)
+    #para que las trazas de nanosegundos no se redondeen a microsegundos
     fn =  bytes(str(fname), 'ascii')
-    poo.restype = ctypes.POINTER(ctypes.c_void_p)
-    eb = ctypes.create_string_buffer(256)
-    handle = poo(fn,eb)
+    eb = ctypes.create_string_buffer(PCAP_ERRBUF_SIZE)
+    if precision != PCAP_TSTAMP_PRECISION_MICRO and _c_pcap_open_offline_with_tstamp_precision is not None:
+        handle = _c_pcap_open_offline_with_tstamp_precision(fn,precision,eb)
+    else:
+        handle = _c_pcap_open_offline(fn,eb)
     errbuf.extend(bytes(format(eb.value).encode('ascii')))
     return handle
 
 
-def pcap_open_dead(linktype,snaplen):
+class PcapFileReader():
+    '''
+        Lector de trazas pcap en Python puro. El fichero se proyecta en memoria (mmap) y cada trama se entrega como
+        un memoryview de solo lectura sobre la proyección, sin pasar por libpcap ni copiar los datos.
+        Los memoryview entregados son válidos mientras el lector siga abierto.
+        Acepta ficheros con resolución de microsegundos y de nanosegundos, en cualquier orden de bytes; en los de
+        nanosegundos las marcas de tiempo se entregan sin redondear (timeval.tv_nsec).
+    '''
+    def __init__(self,fname):
+        self.file = open(fname,'rb')
+        self.map = None
+        self.view = None
+        try:
+            if os.fstat(self.file.fileno()).st_size < PCAP_FILE_HLEN:
+                raise ValueError('{}: fichero pcap truncado'.format(fname))
+            self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+            magic = struct.unpack_from('<I',self.map,0)[0]
+            if magic in (TCPDUMP_MAGIC,NSEC_TCPDUMP_MAGIC):
+                endian = '<'
+            else:
+                endian = '>'
+                magic = struct.unpack_from('>I',self.map,0)[0]
+                if magic not in (TCPDUMP_MAGIC,NSEC_TCPDUMP_MAGIC):
+                    raise ValueError('{}: número mágico desconocido {:#x}'.format(fname,magic))
+        except:
+            self.close()
+            raise
+        self.nano = (magic == NSEC_TCPDUMP_MAGIC)
+        _,_,_,_,self.snaplen,self.linktype = struct.unpack_from(endian+'HHiIII',self.map,4)
+        self.record = struct.Struct(endian+'IIII')
+        self.offset = PCAP_FILE_HLEN
+        self.breakRequested = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        ret = self.next()
+        if ret is None:
+            raise StopIteration
+        return ret
+
+    def next(self):
+        '''
+            Devuelve una tupla (cabecera pcap_pkthdr, memoryview con la trama) con el siguiente registro de la traza
+            o None si se ha llegado al final (o el último registro está truncado)
+        '''
+        offset = self.offset
+        if offset + PCAP_RECORD_HLEN > len(self.map):
+            return None
+        tv_sec,tv_frac,caplen,wirelen = self.record.unpack_from(self.map,offset)
+        start = offset + PCAP_RECORD_HLEN
+        end = start + caplen
+        if end > len(self.map):
+            return None
+        self.offset = end
+        if self.nano:
+            return pcap_pkthdr(wirelen,caplen,timeval(tv_sec,tv_nsec=tv_frac)),self.view[start:end]
+        return pcap_pkthdr(wirelen,caplen,timeval(tv_sec,tv_frac)),self.view[start:end]
+
+    def dispatch(self,cnt,callback_fun,user):
+        '''
+            Equivalente a pcap_dispatch sobre la traza: llama a callback_fun(user,header,frame) por cada trama hasta procesar
+            cnt tramas (todas si cnt <= 0). Devuelve el número de tramas procesadas o -2 si se ha llamado a breakloop.
+        '''
+        n = 0
+        while cnt <= 0 or n < cnt:
+            if self.breakRequested:
+                self.breakRequested = False
+                return -2
+            ret = self.next()
+            if ret is None:
+                break
+            callback_fun(user,ret[0],ret[1])
+            n += 1
+        return n
+
+    def loop(self,cnt,callback_fun,user):
+        '''
+            Equivalente a pcap_loop sobre la traza. Devuelve 0 al terminar o -2 si se ha llamado a breakloop.
+        '''
+        ret = self.dispatch(cnt,callback_fun,user)
+        return ret if ret < 0 else 0
+
+    def breakloop(self):
+        self.breakRequested = True
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                #Quedan memoryviews de tramas vivos: la proyección se liberará cuando desaparezcan
+                pass
+            self.map = None
+        self.file.close()
+
+
+class PcapFileWriter():
+    '''
+        Escritor de trazas pcap en Python puro con escritura en buffer. Sustituye a pcap_dump_open/pcap_dump
+        sin necesidad de un descriptor de pcap_open_dead. Acepta cualquier objeto con protocolo buffer
+        (bytes, bytearray o memoryview) sin copiarlo.
+    '''
+    def __init__(self,fname,linktype=DLT_EN10MB,snaplen=65535,nano=False,bufsize=1<<20):
+        self.file = open(fname,'wb',buffering=bufsize)
+        self.nano = nano
+        self.record = struct.Struct('<IIII')
+        magic = NSEC_TCPDUMP_MAGIC if nano else TCPDUMP_MAGIC
+        self.file.write(struct.pack('<IHHiIII',magic,PCAP_VERSION_MAJOR,PCAP_VERSION_MINOR,0,0,snaplen,linktype))
+
+    def dump(self,header,data):
+        caplen = header.caplen
+        if len(data) != caplen:
+            data = memoryview(data)[:caplen]
+            caplen = len(data)
+        frac = header.ts.tv_nsec if self.nano else header.ts.tv_usec
+        self.file.write(self.record.pack(header.ts.tv_sec,frac,caplen,header.len))
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PcapTxSink():
+    '''
+        Destino de transmisión sin interfaz. Puede usarse como handle en pcap_inject para ejecutar la pila sin red:
+        cuenta las tramas y los bytes enviados y, opcionalmente, las vuelca en un PcapFileWriter (dumper) o las guarda
+        en memoria (keep=True, en la lista frames).
+    '''
+    def __init__(self,dumper=None,keep=False):
+        self.dumper = dumper
+        self.keep = keep
+        self.frames = []
+        self.packets = 0
+        self.bytes = 0
+        self.header = pcap_pkthdr(0,0,timeval(0,0))
+
+    def inject(self,buf,size):
+        self.packets += 1
+        self.bytes += size
+        if self.dumper is not None:
+            now = time.time_ns()
+            self.header.len = self.header.caplen = size
+            self.header.ts.tv_sec = now // 1000000000
+            self.header.ts.tv_nsec = now % 1000000000
+            self.dumper.dump(self.header,memoryview(buf)[:size])
+        if self.keep:
+            self.frames.append(bytes(memoryview(buf)[:size]))
+        return size
+
+    def reset(self):
+        self.frames = []
+        self.packets = 0
+        self.bytes = 0
+
+
+def pcap_open_offline_mmap(fname,errbuf):
+    '''
+        Abre una traza con el lector PcapFileReader. Devuelve None y rellena errbuf si no se puede abrir.
+        El objeto devuelto puede pasarse a pcap_loop, pcap_dispatch, pcap_breakloop y pcap_close.
+    '''
+    try:
+        return PcapFileReader(fname)
+    except (OSError,ValueError) as e:
+        errbuf.extend(str(e).encode('ascii','replace'))
+        return None
+
+
+def pcap_dump_open_file(fname,linktype=DLT_EN10MB,snaplen=65535,nano=False):
+    '''
+        Crea un volcador PcapFileWriter. El objeto devuelto puede pasarse a pcap_dump y pcap_dump_close.
+    '''
+    return PcapFileWriter(fname,linktype,snaplen,nano)
+
+
+def pcap_open_dead(linktype,snaplen,precision=PCAP_TSTAMP_PRECISION_MICRO):
     #pcap_t *pcap_open_dead(int linktype, int snaplen)
-    pod = pcap.pcap_open_dead
-    pod.restype = ctypes.POINTER(ctypes.c_void_p)
-    lt = ctypes.c_int(linktype)
-    sn = ctypes.c_int(snaplen)
-    handle = pod(lt,sn)
-    return handle
+    #Con precision=PCAP_TSTAMP_PRECISION_NANO los volcadores abiertos sobre el descriptor escriben trazas de nanosegundos
+    if precision != PCAP_TSTAMP_PRECISION_MICRO and _c_pcap_open_dead_with_tstamp_precision is not None:
+        return _c_pcap_open_dead_with_tstamp_precision(linktype,snaplen,precision)
+    return _c_pcap_open_dead(linktype,snaplen)
+
+
+class PcapDumper():
+    '''
+        Volcador de libpcap (pcap_dump_open). Reutiliza una única estructura pcappkthdr y pasa los datos a pcap_dump
+        sin copiarlos (salvo buffers de solo lectura), de modo que cada trama cuesta una sola llamada a libpcap.
+        Tiene la misma interfaz que PcapFileWriter (dump, dump_many, flush, close). La traza tiene la precisión de
+        descr (ver pcap_open_dead).
+    '''
+    def __init__(self,descr,fname):
+        fn = bytes(str(fname), 'ascii')
+        self.dumper = _c_pcap_dump_open(descr,fn)
+        if not self.dumper:
+            raise OSError('pcap_dump_open {}: {}'.format(fname,(_c_pcap_geterr(descr) or b'').decode('ascii','replace')))
+        self.nano = (pcap_get_tstamp_precision(descr) == PCAP_TSTAMP_PRECISION_NANO)
+        self.hdr = pcappkthdr()
+        self.hdrRef = ctypes.byref(self.hdr)
+
+    def dump(self,header,data):
+        hdr = self.hdr
+        caplen = min(header.caplen,len(data))
+        hdr.len = header.len
+        hdr.caplen = caplen
+        hdr.tv_sec = header.ts.tv_sec
+        hdr.tv_usec = header.ts.tv_nsec if self.nano else header.ts.tv_usec
+        _c_pcap_dump(self.dumper,self.hdrRef,_buffer_pointer(data,caplen))
+
+    def dump_many(self,batch):
+        '''
+            Vuelca todas las tramas de batch: un PcapBatch (se pasan directamente las direcciones de su arena) o
+            cualquier iterable de tuplas (cabecera, datos)
+        '''
+        if not isinstance(batch,PcapBatch):
+            for header,data in batch:
+                self.dump(header,data)
+            return
+        hdr,ref,dumper,addr = self.hdr,self.hdrRef,self.dumper,batch.arenaAddr
+        div = 1 if self.nano else 1000
+        for i in range(batch.count):
+            hdr.len = batch.lens[i]
+            hdr.caplen = batch.caplens[i]
+            hdr.tv_sec = batch.tv_sec[i]
+            hdr.tv_usec = batch.tv_nsec[i] // div
+            _c_pcap_dump(dumper,ref,addr+batch.offsets[i])
+
+    def flush(self):
+        return _c_pcap_dump_flush(self.dumper)
+
+    def close(self):
+        if self.dumper:
+            _c_pcap_dump_close(self.dumper)
+            self.dumper = None
+
 
 def pcap_dump_open(descr, fname):
     #pcap_dumper_t *pcap_dump_open(pcap_t *p, const char *fname);
-    pdo = pcap.pcap_dump_open
-    pdo.restype = ctypes.POINTER(ctypes.c_void_p)
-    ds = ctypes.POINTER(ctypes.c_void_p(descr))
-    fn =  bytes(str(fname), 'ascii')
-    handle = pdo(ds,fn)
-    return handle
+    #Devuelve un PcapDumper o None si no se puede abrir el fichero
+    try:
+        return PcapDumper(descr,fname)
+    except OSError:
+        return None
 
 def pcap_dump(dumper,header,data):
     # void pcap_dump(u_char *user, struct pcap_pkthdr *h,u_char *sp);
-    pd = pcap.pcap_dump
-    dp = ctypes.c_void_p(dumper)
-    haux = pcappkthdr()
-    haux.len = header.len
-    haux.caplen = header.caplen
-    haux.tv_sec = header.ts.tv_sec
-    haux.tv_usec = header.ts.tv_usec
-    h = ctypes.byref(haux)
-    d = ctypes.c_char_p(bytes(data))
-    pd(dp,h,d)
+    dumper.dump(header,data)
+
+def pcap_dump_flush(dumper):
+    #int pcap_dump_flush(pcap_dumper_t *p);
+    if isinstance(dumper,PcapFileWriter):
+        dumper.flush()
+        return 0
+    return dumper.flush()
 
 
 
 def pcap_open_live(device,snaplen,promisc,to_ms,errbuf):
     
     #pcap_t *pcap_open_live(const char *device, int snaplen,int promisc, int to_ms, char *errbuf)
-    pol = pcap.pcap_open_live
-    pol.restype = ctypes.POINTER(ctypes.c_void_p)
     dv =  bytes(str(device), 'ascii')
-    sn = ctypes.c_int(snaplen)
-    tms = ctypes.c_int(to_ms)
-    pr = ctypes.c_int(promisc)
-    eb = ctypes.create_string_buffer(256)
-    handle = pol(dv,sn,pr,tms,eb)
+    eb = ctypes.create_string_buffer(PCAP_ERRBUF_SIZE)
+    handle = _c_pcap_open_live(dv,snaplen,promisc,to_ms,eb)
     errbuf.extend(bytes(format(eb.value).encode('ascii')))
 
     return handle
 
+def pcap_create(source,errbuf):
+    #pcap_t *pcap_create(const char *source, char *errbuf);
+    if _c_pcap_create is None:
+        errbuf.extend(b'pcap_create no disponible en esta version de libpcap')
+        return None
+    eb = ctypes.create_string_buffer(PCAP_ERRBUF_SIZE)
+    handle = _c_pcap_create(bytes(str(source), 'ascii'),eb)
+    errbuf.extend(eb.value)
+    return handle
+
+def pcap_set_snaplen(handle,snaplen):
+    #int pcap_set_snaplen(pcap_t *p, int snaplen);
+    return _c_pcap_set_snaplen(handle,snaplen)
+
+def pcap_set_promisc(handle,promisc):
+    #int pcap_set_promisc(pcap_t *p, int promisc);
+    return _c_pcap_set_promisc(handle,promisc)
+
+def pcap_set_timeout(handle,to_ms):
+    #int pcap_set_timeout(pcap_t *p, int to_ms);
+    return _c_pcap_set_timeout(handle,to_ms)
+
+def pcap_set_tstamp_type(handle,tstamp_type):
+    #int pcap_set_tstamp_type(pcap_t *p, int tstamp_type);
+    if _c_pcap_set_tstamp_type is None:
+        return PCAP_WARNING_TSTAMP_TYPE_NOTSUP
+    return _c_pcap_set_tstamp_type(handle,tstamp_type)
+
+def pcap_tstamp_type_name_to_val(name):
+    #int pcap_tstamp_type_name_to_val(const char *name); por ejemplo 'adapter' -> PCAP_TSTAMP_ADAPTER
+    if _c_pcap_tstamp_type_name_to_val is None:
+        return PCAP_ERROR
+    return _c_pcap_tstamp_type_name_to_val(bytes(str(name), 'ascii'))
+
+def pcap_set_tstamp_precision(handle,precision):
+    #int pcap_set_tstamp_precision(pcap_t *p, int tstamp_precision);
+    if _c_pcap_set_tstamp_precision is None:
+        return 0 if precision == PCAP_TSTAMP_PRECISION_MICRO else PCAP_ERROR_TSTAMP_PRECISION_NOTSUP
+    return _c_pcap_set_tstamp_precision(handle,precision)
+
+def pcap_get_tstamp_precision(handle):
+    #int pcap_get_tstamp_precision(pcap_t *p);
+    if isinstance(handle,PcapFileReader):
+        return PCAP_TSTAMP_PRECISION_NANO if handle.nano else PCAP_TSTAMP_PRECISION_MICRO
+    if _c_pcap_get_tstamp_precision is None or not handle:
+        return PCAP_TSTAMP_PRECISION_MICRO
+    return _c_pcap_get_tstamp_precision(handle)
+
+def pcap_activate(handle):
+    #int pcap_activate(pcap_t *p);
+    return _c_pcap_activate(handle)
+
+def pcap_statustostr(error):
+    #const char *pcap_statustostr(int error);
+    if _c_pcap_statustostr is None:
+        return 'error {}'.format(error).encode('ascii')
+    return _c_pcap_statustostr(error)
+
+def pcap_open_live_tstamp(device,snaplen,promisc,to_ms,errbuf,precision=PCAP_TSTAMP_PRECISION_NANO,tstamp_type=None):
+    '''
+        Equivalente a pcap_open_live pero abriendo la interfaz con pcap_create/pcap_activate para pedir la precisión de las
+        marcas de tiempo (PCAP_TSTAMP_PRECISION_*) y, si tstamp_type no es None, su tipo (PCAP_TSTAMP_*, por ejemplo
+        PCAP_TSTAMP_ADAPTER para las marcas que pone la tarjeta). Si la interfaz no admite la precisión o el tipo pedidos
+        se abre con los de por defecto; la precisión obtenida se consulta con pcap_get_tstamp_precision.
+        Devuelve el descriptor o None (rellenando errbuf) si no se puede abrir.
+    '''
+    if _c_pcap_create is None or _c_pcap_activate is None:
+        return pcap_open_live(device,snaplen,promisc,to_ms,errbuf)
+    handle = pcap_create(device,errbuf)
+    if not handle:
+        return None
+    pcap_set_snaplen(handle,snaplen)
+    pcap_set_promisc(handle,promisc)
+    pcap_set_timeout(handle,to_ms)
+    if tstamp_type is not None:
+        pcap_set_tstamp_type(handle,tstamp_type)
+    if precision != PCAP_TSTAMP_PRECISION_MICRO:
+        pcap_set_tstamp_precision(handle,precision)
+    ret = pcap_activate(handle)
+    if ret < 0:
+        errbuf.extend(pcap_geterr(handle) or pcap_statustostr(ret))
+        _c_pcap_close(handle)
+        return None
+    return handle
+
 def pcap_close(handle):
     #void pcap_close(pcap_t *p);
-    pc = pcap.pcap_close
-    pc(handle)
+    if isinstance(handle,PcapFileReader):
+        handle.close()
+        return
+    _c_pcap_close(handle)
 
 def pcap_dump_close(handle):
-    #void pcap_close(pcap_dumper_t *p);
-    pdc = pcap.pcap_dump_close
-    pdc(handle)
+    #void pcap_dump_close(pcap_dumper_t *p);
+    handle.close()
 
 def pcap_next(handle,header):
     #const u_char *pcap_next(pcap_t *p, struct pcap_pkthdr *h)
-    pn = pcap.pcap_next
-    pn.restype = ctypes.c_char_p
+    #Devuelve un bytearray con la trama o None si no se ha leído ninguna (ver packets para leer sin copias)
+    if isinstance(handle,PcapFileReader):
+        ret = handle.next()
+        if ret is None:
+            return None
+        header.len,header.caplen,header.ts = ret[0].len,ret[0].caplen,ret[0].ts
+        return bytearray(ret[1])
     h = pcappkthdr()
-    aux = pn(handle,ctypes.byref(h))
+    aux = _c_pcap_next(handle,ctypes.byref(h))
+    if not aux:
+        return None
     header.len = h.len
     header.caplen = h.caplen
-    header.ts = timeval(h.tv_sec,h.tv_usec)
-    return bytearray(aux)
+    header.ts = timeval(h.tv_sec,tv_nsec=h.tv_usec if pcap_get_tstamp_precision(handle) == PCAP_TSTAMP_PRECISION_NANO else h.tv_usec*1000)
+    return bytearray(ctypes.string_at(aux,h.caplen))
+
+
+class PcapPacketStream():
+    '''
+        Iterador de las tramas de un descriptor de pcap (o de un PcapFileReader) basado en pcap_next_ex. Cada iteración
+        devuelve una tupla (cabecera pcap_pkthdr, memoryview de solo lectura con la trama) sin copiar los datos: el
+        memoryview apunta al buffer de libpcap y solo es válido hasta la siguiente iteración (al avanzar se libera y
+        usarlo lanza ValueError). Para conservar una trama se usa copy(). Los memoryview obtenidos a partir de la trama
+        (por ejemplo con las vistas de views.py) tampoco deben usarse después de avanzar.
+        La iteración termina al llegar a cnt tramas (si cnt >= 0), al final de la traza, con pcap_breakloop o si hay un
+        error (que queda en el atributo error). En una captura en vivo los vencimientos del timeout de lectura se
+        ignoran, por lo que el descriptor debe estar en modo bloqueante.
+    '''
+    def __init__(self,handle,cnt=-1):
+        self.handle = handle
+        self.cnt = cnt
+        self.count = 0
+        self.error = None
+        self.header = None
+        self.frame = None
+        self.nano = (pcap_get_tstamp_precision(handle) == PCAP_TSTAMP_PRECISION_NANO)
+        self.hdrPtr = ctypes.POINTER(pcappkthdr)()
+        self.dataPtr = ctypes.c_void_p()
+        self.hdrRef = ctypes.byref(self.hdrPtr)
+        self.dataRef = ctypes.byref(self.dataPtr)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.release()
+        if self.cnt >= 0 and self.count >= self.cnt:
+            raise StopIteration
+        handle = self.handle
+        if isinstance(handle,PcapFileReader):
+            if handle.breakRequested:
+                handle.breakRequested = False
+                raise StopIteration
+            ret = handle.next()
+            if ret is None:
+                raise StopIteration
+            self.header,self.frame = ret
+        else:
+            while True:
+                ret = _c_pcap_next_ex(handle,self.hdrRef,self.dataRef)
+                if ret == 1:
+                    break
+                if ret == 0:
+                    continue
+                if ret == PCAP_ERROR:
+                    self.error = pcap_geterr(handle)
+                raise StopIteration
+            h = self.hdrPtr.contents
+            caplen = h.caplen
+            self.header = pcap_pkthdr(h.len,caplen,timeval(h.tv_sec,tv_nsec=h.tv_usec if self.nano else h.tv_usec*1000))
+            self.frame = memoryview((ctypes.c_char*caplen).from_address(self.dataPtr.value)).cast('B').toreadonly()
+        self.count += 1
+        return self.header,self.frame
+
+    def copy(self):
+        '''
+            Devuelve una tupla (cabecera, bytes) con una copia de la trama actual que sigue siendo válida tras avanzar
+        '''
+        if self.frame is None:
+            return None
+        return self.header,self.frame.tobytes()
+
+    def release(self):
+        #Invalida el memoryview de la trama actual antes de que libpcap reutilice su buffer
+        if self.frame is not None:
+            try:
+                self.frame.release()
+            except BufferError:
+                pass
+            self.frame = None
+
+    def close(self):
+        self.release()
+        self.cnt = 0
+
+
+def packets(handle,cnt=-1):
+    '''
+        Nombre: packets
+        Descripción: Esta función permite recorrer las tramas de un descriptor sin callbacks ni estado global, por ejemplo
+            for header,frame in packets(handle). Las tramas son memoryview de solo lectura válidos hasta la siguiente
+            iteración (ver PcapPacketStream y su método copy).
+        Argumentos:
+            -handle: descriptor de pcap_open_live/pcap_open_offline o PcapFileReader
+            -cnt: número máximo de tramas a leer (todas si es negativo)
+        Retorno: Iterador PcapPacketStream
+    '''
+    return PcapPacketStream(handle,cnt)
 
 
 def pcap_loop(handle,cnt,callback_fun,user):
-    global user_callback
-    user_callback = callback_fun
-    #  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
-    PCAP_HANDLER = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
-    cf = PCAP_HANDLER(mycallback)
+    if isinstance(handle,PcapFileReader):
+        return handle.loop(cnt,callback_fun,user)
+    key = next(_contextKeys)
+    _callbackContexts[key] = (callback_fun,user,pcap_get_tstamp_precision(handle) == PCAP_TSTAMP_PRECISION_NANO)
     #int pcap_loop(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
-    pl = pcap.pcap_loop
-    pl.restype = ctypes.c_int
-    us = ctypes.c_void_p(user)
-    c = ctypes.c_int(cnt)
-    ret = pl(handle,c,cf,us)
-    user_callback = None
+    try:
+        ret = _c_pcap_loop(handle,cnt,_pcapHandler,key)
+    finally:
+        del _callbackContexts[key]
     return ret
+
 def pcap_dispatch(handle,cnt,callback_fun,user):
-    global user_callback
-    user_callback = callback_fun
-    #  typedef void (*pcap_handler)(u_char *user, const struct pcap_pkthdr *h,const u_char *bytes);
-    PCAP_HANDLER = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
-    cf = PCAP_HANDLER(mycallback)
-    #int pcap_loop(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
-    pd = pcap.pcap_dispatch
-    pd.restype = ctypes.c_int
-    us = ctypes.c_void_p(user)
-    c = ctypes.c_int(cnt)
-    ret = pd(handle,c,cf,us)
-    user_callback = None
+    if isinstance(handle,PcapFileReader):
+        return handle.dispatch(cnt,callback_fun,user)
+    key = next(_contextKeys)
+    _callbackContexts[key] = (callback_fun,user,pcap_get_tstamp_precision(handle) == PCAP_TSTAMP_PRECISION_NANO)
+    #int pcap_dispatch(pcap_t *p, int cnt,pcap_handler callback, u_char *user);
+    try:
+        ret = _c_pcap_dispatch(handle,cnt,_pcapHandler,key)
+    finally:
+        del _callbackContexts[key]
     return ret
+
+def pcap_dispatch_batch(handle,batch):
+    '''
+        Lee hasta batch.maxcnt tramas en el lote (PcapBatch) indicado, reutilizando su arena.
+        Devuelve el número de tramas leídas o un valor negativo en caso de error (-1) o de pcap_breakloop (-2).
+    '''
+    batch.reset()
+    if isinstance(handle,PcapFileReader):
+        ret = handle.dispatch(batch.maxcnt,lambda us,header,data: batch.append(header,data),None)
+        return ret if ret < 0 else batch.count
+    batch.nano = (pcap_get_tstamp_precision(handle) == PCAP_TSTAMP_PRECISION_NANO)
+    key = next(_contextKeys)
+    _callbackContexts[key] = batch
+    try:
+        ret = _c_pcap_dispatch(handle,batch.maxcnt,_batchHandler,key)
+    finally:
+        del _callbackContexts[key]
+    return ret if ret < 0 else batch.count
 def pcap_breakloop(hanlde):
     #void pcap_breakloop(pcap_t *);
-    pbl = pcap.pcap_breakloop
-    pbl(hanlde)
+    if isinstance(hanlde,PcapFileReader):
+        hanlde.breakloop()
+        return
+    _c_pcap_breakloop(hanlde)
 
-def pcap_inject(handle,buf,size):
-    #int pcap_inject(pcap_t *p, const void *buf, size_t size);
-    pi = pcap.pcap_inject
-    pi.restype = ctypes.c_int
-    ret = pi(handle,ctypes.c_char_p(buf),ctypes.c_longlong(size))
+def pcap_get_selectable_fd(handle):
+    #int pcap_get_selectable_fd(pcap_t *p);
+    return _c_pcap_get_selectable_fd(handle)
+
+def pcap_setnonblock(handle,nonblock,errbuf):
+    #int pcap_setnonblock(pcap_t *p, int nonblock, char *errbuf);
+    eb = ctypes.create_string_buffer(PCAP_ERRBUF_SIZE)
+    ret = _c_pcap_setnonblock(handle,nonblock,eb)
+    errbuf.extend(bytes(format(eb.value).encode('ascii')))
     return ret
 
+def pcap_geterr(handle):
+    #char *pcap_geterr(pcap_t *p);
+    return _c_pcap_geterr(handle)
+
+def pcap_compile(handle,program,filterstr,optimize,netmask):
+    #int pcap_compile(pcap_t *p, struct bpf_program *fp, const char *str, int optimize, bpf_u_int32 netmask);
+    fs = bytes(str(filterstr), 'ascii')
+    return _c_pcap_compile(handle,ctypes.byref(program),fs,optimize,netmask)
 
+def pcap_setfilter(handle,program):
+    #int pcap_setfilter(pcap_t *p, struct bpf_program *fp);
+    return _c_pcap_setfilter(handle,ctypes.byref(program))
 
+def pcap_freecode(program):
+    #void pcap_freecode(struct bpf_program *);
+    _c_pcap_freecode(ctypes.byref(program))
+
+def pcap_set_filter_expr(handle,filterstr,errbuf,optimize=1,netmask=PCAP_NETMASK_UNKNOWN):
+    '''
+        Compila filterstr (sintaxis de tcpdump) e instala el programa BPF resultante en handle, de modo que el kernel
+        descarta las tramas que no cumplen el filtro antes de copiarlas al proceso. Devuelve 0 si todo es correcto y
+        -1 (rellenando errbuf con el error de pcap) en otro caso.
+    '''
+    program = bpf_program()
+    if pcap_compile(handle,program,filterstr,optimize,netmask) == -1:
+        errbuf.extend(pcap_geterr(handle) or b'')
+        return -1
+    ret = pcap_setfilter(handle,program)
+    if ret == -1:
+        errbuf.extend(pcap_geterr(handle) or b'')
+    pcap_freecode(program)
+    return ret
+
+def pcap_inject(handle,buf,size):
+    #int pcap_inject(pcap_t *p, const void *buf, size_t size);
+    if isinstance(handle,PcapTxSink):
+        return handle.inject(buf,size)
+    #bytes, bytearray o memoryview: se pasa la dirección del propio buffer sin copiarlo (ver _buffer_pointer)
+    return _c_pcap_inject(handle,_buffer_pointer(buf,size),size)
@@ -0,0 +1,413 @@
+'''
+    shard.py
+    Reparto del procesamiento de recepción entre varios procesos. Con un único intérprete toda la pila (hilo de
+    recepción, hilos de procesamiento y funciones de nivel superior) comparte el GIL y no pasa de un núcleo.
+    ShardedStack abre el enlace en el proceso principal, donde el hilo de recepción solo clasifica cada trama por
+    flujo (IP origen, IP destino y protocolo, de modo que todos los fragmentos de un datagrama van al mismo sitio) y
+    la escribe en el anillo de memoria compartida (ShmRing) de uno de los procesos de trabajo. Cada proceso ejecuta
+    una pila completa (Ethernet/ARP/IP/ICMP/UDP) sobre un ShardLink que lee de su anillo de recepción y escribe las
+    tramas que envía en su anillo de transmisión, del que las saca el proceso principal para enviarlas por el enlace.
+    Las peticiones ARP van solo al proceso 0 (para que conteste uno solo) y las respuestas ARP a todos.
+    Cada proceso envía periódicamente sus contadores (ver counters.py) y, opcionalmente, sus propios resultados al
+    proceso principal, que los agrega.
+'''
+
+from link import *
+import counters
+import logging
+import multiprocessing
+import queue
+import random
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+#Número de tramas de cada anillo y bytes reservados para cada una
+SHARD_RING_SLOTS = 4096
+SHARD_SNAPLEN = 1536
+#Número máximo de tramas que se sacan de un anillo de una vez
+SHARD_RING_BATCH = 256
+#Espera máxima (en segundos) entre dos consultas a un anillo vacío
+SHARD_MAX_IDLE = 0.001
+#Periodo (en segundos) con el que cada proceso envía sus contadores
+SHARD_STATS_INTERVAL = 1.0
+#Periodo (en segundos) con el que cada proceso comprueba si debe terminar
+SHARD_STOP_POLL = 0.05
+#Tiempo máximo (en segundos) de espera a que los procesos inicialicen su pila
+SHARD_START_TIMEOUT = 30
+
+#Zona de control del anillo: head (lo escribe solo el consumidor) y tail (solo el productor) en líneas de caché distintas
+RING_CTRL = 128
+RING_HEAD = 0
+RING_TAIL = 8
+RING_SLOTS = 2
+RING_STRIDE = 3
+#Cabecera de cada trama en el anillo: caplen, len, tv_sec, tv_nsec
+RING_SLOT_HEADER = struct.Struct('<IIqq')
+#IP origen e IP destino de un datagrama IP dentro de una trama Ethernet
+FLOW_ADDRESSES = struct.Struct('!II')
+
+shardCounters = counters.getCounters('shard',('rx_frames','rx_other','rx_dropped','tx_frames','tx_errors'))
+
+
+class ShmRing():
+    '''
+        Anillo de un productor y un consumidor sobre un segmento de memoria compartida (multiprocessing.shared_memory).
+        Cada posición tiene espacio para una trama de hasta snaplen bytes. El productor escribe la trama y después
+        avanza tail; el consumidor procesa las tramas y después avanza head, por lo que no hacen falta cerrojos.
+        Si name es None se crea el segmento; si no, se abre el existente (en otro proceso).
+    '''
+    def __init__(self,name=None,slots=SHARD_RING_SLOTS,snaplen=SHARD_SNAPLEN):
+        if name is None:
+            stride = (RING_SLOT_HEADER.size + snaplen + 63) & ~63
+            self.shm = shared_memory.SharedMemory(create=True,size=RING_CTRL + slots*stride)
+            self.owner = True
+            self.ctrl = self.shm.buf[:RING_CTRL].cast('Q')
+            self.ctrl[RING_HEAD] = 0
+            self.ctrl[RING_TAIL] = 0
+            self.ctrl[RING_SLOTS] = slots
+            self.ctrl[RING_STRIDE] = stride
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+            self.ctrl = self.shm.buf[:RING_CTRL].cast('Q')
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.slots = self.ctrl[RING_SLOTS]
+        self.stride = self.ctrl[RING_STRIDE]
+        self.snaplen = self.stride - RING_SLOT_HEADER.size
+
+    def __len__(self):
+        return self.ctrl[RING_TAIL] - self.ctrl[RING_HEAD]
+
+    def put(self,data,caplen,wirelen=0,tv_sec=0,tv_nsec=0):
+        '''
+            Copia los caplen primeros bytes de data (recortados a snaplen) en el anillo. Devuelve False si está lleno
+        '''
+        ctrl = self.ctrl
+        tail = ctrl[RING_TAIL]
+        if tail - ctrl[RING_HEAD] >= self.slots:
+            return False
+        caplen = min(caplen,len(data),self.snaplen)
+        offset = RING_CTRL + (tail % self.slots)*self.stride
+        RING_SLOT_HEADER.pack_into(self.buf,offset,caplen,wirelen or caplen,tv_sec,tv_nsec)
+        start = offset + RING_SLOT_HEADER.size
+        self.buf[start:start+caplen] = data[:caplen]
+        ctrl[RING_TAIL] = tail + 1
+        return True
+
+    def drain(self,callback,maxcount=SHARD_RING_BATCH):
+        '''
+            Llama a callback(frame,wirelen,tv_sec,tv_nsec) con hasta maxcount tramas y las libera. frame es un memoryview
+            sobre el anillo que solo es válido durante la llamada. Devuelve el número de tramas procesadas
+        '''
+        ctrl = self.ctrl
+        head = ctrl[RING_HEAD]
+        n = min(ctrl[RING_TAIL] - head,maxcount)
+        buf = self.buf
+        for i in range(head,head+n):
+            offset = RING_CTRL + (i % self.slots)*self.stride
+            caplen,wirelen,tv_sec,tv_nsec = RING_SLOT_HEADER.unpack_from(buf,offset)
+            start = offset + RING_SLOT_HEADER.size
+            callback(buf[start:start+caplen],wirelen,tv_sec,tv_nsec)
+        if n:
+            ctrl[RING_HEAD] = head + n
+        return n
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.ctrl.release()
+        self.ctrl = None
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+def pollRings(rings,callback,stop):
+    '''
+        Saca las tramas de rings (llamando a ring.drain(callback)) hasta que se activa stop. Cuando no hay tramas espera
+        cada vez más (hasta SHARD_MAX_IDLE) para no ocupar un núcleo con el enlace parado.
+    '''
+    idle = 0
+    while not stop.is_set():
+        n = 0
+        for ring in rings:
+            n += ring.drain(callback)
+        if n:
+            idle = 0
+        else:
+            idle = min(SHARD_MAX_IDLE,idle*2 or 0.00001)
+            time.sleep(idle)
+
+
+class ShardLink(LinkBackend):
+    '''
+        Enlace de la pila de un proceso de trabajo: recibe las tramas del anillo rx y envía las suyas por el anillo tx
+    '''
+    def __init__(self,rx,tx,mac,ipAddr=None,netmask=None,gateway=None,mtu=None,hostClock=False):
+        LinkBackend.__init__(self,mac,ipAddr,netmask,gateway,mtu)
+        #Las marcas de tiempo son las que puso el enlace del proceso principal
+        self.hostClock = hostClock
+        self.rx = rx
+        self.tx = tx
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+    def send(self,buf,size):
+        return size if self.tx.put(buf,size) else -1
+
+    def start(self,callback):
+        def deliver(frame,wirelen,tv_sec,tv_nsec):
+            callback(None,pcap_pkthdr(wirelen,len(frame),timeval(tv_sec,tv_nsec=tv_nsec)),bytearray(frame))
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=pollRings,args=([self.rx],deliver,self.stopEvent))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join(1)
+            self.thread = None
+
+    def close(self):
+        self.rx.close()
+        self.tx.close()
+
+
+def shardWorker(index,interface,config,rxName,txName,setup,results,stopFlag,statsInterval):
+    '''
+        Función principal de cada proceso de trabajo: inicializa la pila sobre un ShardLink, ejecuta setup(index) (si se
+        indica) y envía sus contadores a results cada statsInterval segundos hasta que stopFlag (un valor compartido) pasa
+        a 1. Si setup devuelve una función, su resultado (un diccionario) se envía junto con los contadores.
+        stopFlag se consulta periódicamente en lugar de esperar a un multiprocessing.Event porque un proceso que muere
+        esperando al evento dejaría bloqueado su set() en el proceso principal.
+    '''
+    import ethernet,ip,icmp,udp
+    #Todos los procesos envían con la misma IP: cada uno empieza en un IPID aleatorio para que sus secuencias no
+    #coincidan y el destino no mezcle fragmentos de datagramas distintos
+    ip.IPID = random.SystemRandom().getrandbits(16)
+    link = ShardLink(ShmRing(rxName),ShmRing(txName),**config)
+    #Las tramas que no caben en la cola del hilo de procesamiento se descartan: la respuesta ARP que espera ese hilo
+    #no debe quedarse en el anillo detrás de una recepción bloqueada
+    ok = ethernet.startEthernetLevel(interface,1,dropWhenFull=True,backend=link) == 0
+    if ok:
+        icmp.initICMP()
+        udp.initUDP()
+        ok = ip.initIP(interface)
+    collect = None
+    if ok and setup is not None:
+        try:
+            collect = setup(index)
+        except Exception:
+            logging.exception('[shardWorker {}] Error en setup'.format(index))
+            ok = False
+    results.put(('ready',index,ok))
+    if ok:
+        nextStats = time.monotonic() + statsInterval
+        while not stopFlag.value:
+            time.sleep(SHARD_STOP_POLL)
+            if time.monotonic() >= nextStats:
+                results.put(('stats',index,counters.snapshot(),collect() if collect is not None else None))
+                nextStats += statsInterval
+        results.put(('stats',index,counters.snapshot(),collect() if collect is not None else None))
+    ethernet.stopEthernetLevel()
+
+
+class ShardedStack():
+    '''
+        Pila repartida entre nshards procesos (ver la descripción del módulo). link es el enlace real del proceso
+        principal (un LinkBackend sin abrir) e interface el nombre con el que los procesos obtienen la configuración IP
+        que no lleve el enlace. Cuando el anillo de un proceso está lleno se espera a que haya sitio (dropWhenFull=False)
+        o se descarta la trama contabilizándola (dropWhenFull=True); si el proceso ha terminado se descarta siempre.
+        setup es una función (que se pueda serializar con pickle, es decir, definida a nivel de módulo) que cada proceso
+        ejecuta tras inicializar su pila, por ejemplo para ligar endpoints UDP (ver shardWorker).
+    '''
+    def __init__(self,link,interface,nshards,setup=None,slots=SHARD_RING_SLOTS,dropWhenFull=False,
+            statsInterval=SHARD_STATS_INTERVAL,context='spawn'):
+        if nshards < 1:
+            raise ValueError('nshards debe ser positivo')
+        self.link = link
+        self.interface = interface
+        self.nshards = nshards
+        self.setup = setup
+        self.slots = slots
+        self.dropWhenFull = dropWhenFull
+        self.statsInterval = statsInterval
+        self.context = multiprocessing.get_context(context)
+        self.rxRings = []
+        self.txRings = []
+        self.processes = []
+        self.enqueued = [0]*nshards
+        self.dropped = [0]*nshards
+        self.shardStats = [None]*nshards
+        self.shardResults = [None]*nshards
+        self.results = None
+        self.stopFlag = None
+        self.txStop = threading.Event()
+        self.txThread = None
+
+    def start(self):
+        '''
+            Abre el enlace, crea los anillos y arranca los procesos. Devuelve True cuando todos han inicializado su pila
+        '''
+        errbuf = bytearray()
+        if self.link.open(errbuf) != 0:
+            logging.error('[ShardedStack] Error abriendo el enlace: {}'.format(errbuf))
+            return False
+        mac = bytes(self.link.mac)
+        if self.link.setFilter('(ether dst {} or ether broadcast) and (arp or ip)'.format(mac.hex(':')),errbuf) != 0:
+            logging.warning('[ShardedStack] No se ha podido instalar el filtro de recepción: {}'.format(errbuf))
+        self.rxRings = [ShmRing(slots=self.slots) for i in range(self.nshards)]
+        self.txRings = [ShmRing(slots=self.slots) for i in range(self.nshards)]
+        self.txStop.clear()
+        self.txThread = threading.Thread(target=pollRings,args=(self.txRings,self.transmit,self.txStop))
+        self.txThread.daemon = True
+        self.txThread.start()
+        self.link.start(self.classify)
+
+        self.results = self.context.Queue()
+        self.stopFlag = self.context.RawValue('b',0)
+        config = {'mac':mac,'ipAddr':self.link.ipAddr,'netmask':self.link.netmask,'gateway':self.link.gateway,'mtu':self.link.mtu,
+            'hostClock':self.link.hostClock}
+        for i in range(self.nshards):
+            p = self.context.Process(target=shardWorker,args=(i,self.interface,config,self.rxRings[i].name,self.txRings[i].name,
+                self.setup,self.results,self.stopFlag,self.statsInterval))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+        ready = 0
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while ready < self.nshards:
+            try:
+                msg = self.results.get(timeout=max(0,deadline - time.monotonic()))
+            except queue.Empty:
+                logging.error('[ShardedStack] Los procesos no han arrancado a tiempo')
+                self.stop()
+                return False
+            if msg[0] == 'ready':
+                if not msg[2]:
+                    logging.error('[ShardedStack] El proceso {} no ha podido inicializar su pila'.format(msg[1]))
+                    self.stop()
+                    return False
+                ready += 1
+            else:
+                self.record(msg)
+        counters.registerCollector('shard_dispatcher',self.dispatchStats)
+        counters.registerCollector('shards',self.summary)
+        return True
+
+    def classify(self,us,header,data):
+        #Se ejecuta en el hilo de recepción del enlace
+        shardCounters.inc('rx_frames')
+        if len(data) < 14:
+            shardCounters.inc('rx_other')
+            return
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype == 0x0800 and len(data) >= 34:
+            src,dst = FLOW_ADDRESSES.unpack_from(data,26)
+            key = ((src*0x9E3779B1) ^ (dst*0x85EBCA6B) ^ data[23]) & 0xFFFFFFFF
+            self.enqueue((key ^ (key >> 16)) % self.nshards,header,data)
+        elif ethertype == 0x0806 and len(data) >= 22:
+            #Peticiones ARP al proceso 0; respuestas a todos (la resolución puede estar en curso en cualquiera)
+            if data[21] == 1:
+                self.enqueue(0,header,data)
+            else:
+                for i in range(self.nshards):
+                    self.enqueue(i,header,data)
+        else:
+            shardCounters.inc('rx_other')
+
+    def enqueue(self,i,header,data):
+        ring = self.rxRings[i]
+        while not ring.put(data,header.caplen,header.len,header.ts.tv_sec,header.ts.tv_nsec):
+            #Si el proceso ha terminado su anillo no se vaciará: se descarta para no bloquear el reparto a los demás
+            if self.dropWhenFull or self.txStop.is_set() or (i < len(self.processes) and not self.processes[i].is_alive()):
+                self.dropped[i] += 1
+                shardCounters.inc('rx_dropped')
+                return
+            time.sleep(0)
+        self.enqueued[i] += 1
+
+    def transmit(self,frame,wirelen,tv_sec,tv_nsec):
+        #Se ejecuta en el hilo de transmisión: envía por el enlace una trama de un anillo tx
+        if self.link.send(frame,len(frame)) < 0:
+            shardCounters.inc('tx_errors')
+        else:
+            shardCounters.inc('tx_frames')
+
+    def record(self,msg):
+        if msg[0] == 'stats':
+            self.shardStats[msg[1]] = msg[2]
+            self.shardResults[msg[1]] = msg[3]
+
+    def poll(self):
+        #Recoge los mensajes pendientes de los procesos
+        if self.results is None:
+            return
+        while True:
+            try:
+                self.record(self.results.get_nowait())
+            except queue.Empty:
+                return
+
+    def dispatchStats(self):
+        stats = {'shards':self.nshards,'enqueued':sum(self.enqueued),'dropped':sum(self.dropped)}
+        for i in range(self.nshards):
+            stats['enqueued_{}'.format(i)] = self.enqueued[i]
+            stats['dropped_{}'.format(i)] = self.dropped[i]
+            stats['backlog_{}'.format(i)] = len(self.rxRings[i]) if self.rxRings else 0
+        return stats
+
+    def stats(self):
+        '''
+            Devuelve un diccionario con los contadores del reparto (dispatcher), los últimos recibidos de cada proceso
+            (shards), su suma por grupo (total) y los resultados de la función de setup de cada proceso (results)
+        '''
+        self.poll()
+        total = {}
+        for snapshot in self.shardStats:
+            for group,values in (snapshot or {}).items():
+                merged = total.setdefault(group,{})
+                for name,value in values.items():
+                    if isinstance(value,(int,float)) and not isinstance(value,bool):
+                        merged[name] = merged.get(name,0) + value
+        return {'dispatcher':self.dispatchStats(),'shards':list(self.shardStats),'total':total,'results':list(self.shardResults)}
+
+    def summary(self):
+        #Suma de los contadores de todos los procesos en un solo grupo (para counters.snapshot/formatStats)
+        return {'{}_{}'.format(group,name):value for group,values in self.stats()['total'].items() for name,value in values.items()}
+
+    def stop(self):
+        '''
+            Para los procesos (recogiendo sus últimos contadores), el enlace y el hilo de transmisión y libera los anillos
+        '''
+        counters.registerCollector('shard_dispatcher',None)
+        counters.registerCollector('shards',None)
+        if self.stopFlag is not None:
+            self.stopFlag.value = 1
+        self.link.stop()
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        for p in self.processes:
+            while p.is_alive() and time.monotonic() < deadline:
+                #Se vacía la cola mientras se espera: un proceso no termina mientras tenga mensajes sin entregar
+                self.poll()
+                p.join(0.05)
+            if p.is_alive():
+                p.terminate()
+        self.poll()
+        self.processes = []
+        self.txStop.set()
+        if self.txThread is not None:
+            self.txThread.join(1)
+            self.txThread = None
+        self.link.close()
+        for ring in self.rxRings + self.txRings:
+            ring.close()
+        self.rxRings = []
+        self.txRings = []
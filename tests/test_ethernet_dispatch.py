@@ -0,0 +1,66 @@
+'''
+    test_ethernet_dispatch.py
+    Pruebas del repartidor de tramas del nivel Ethernet con varias pilas unidas por un VirtualWire (link.py). No necesitan
+    una interfaz de red, pero rc1_pcap carga libpcap al importarse.
+'''
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from link import *
+except OSError:
+    pytest.skip('libpcap no disponible',allow_module_level=True)
+
+
+NETWORK = 0x0a000000
+NETMASK = 0xffffff00
+FLOOD_PORT = 9000
+
+
+def startStack(wire,last,**kwargs):
+    stack = loadStackInstance()
+    backend = VirtualLink(wire,bytes([2,0,0,0,0,last]),NETWORK + last,NETMASK)
+    assert stack.ethernet.startEthernetLevel('veth{}'.format(last),backend=backend,**kwargs) == 0
+    stack.icmp.initICMP()
+    stack.udp.initUDP()
+    assert stack.ip.initIP('veth{}'.format(last))
+    return stack
+
+
+def test_arp_reply_not_blocked_by_full_queue():
+    #B tiene un solo hilo de procesamiento con una cola de 2 tramas. Mientras A lo inunda con datagramas UDP, el hilo
+    #de B resuelve la MAC de C: la respuesta ARP no debe quedarse detrás de la cola llena
+    wire = VirtualWire()
+    stacks = [startStack(wire,1),startStack(wire,2,numWorkers=1,queueDepth=2),startStack(wire,3)]
+    a,b,c = stacks
+    result = {}
+    done = threading.Event()
+
+    def onDatagram(srcIP,srcPort,data):
+        if done.is_set() or 'mac' in result:
+            return
+        start = time.monotonic()
+        result['mac'] = b.arp.ARPResolution(NETWORK + 3)
+        result['elapsed'] = time.monotonic() - start
+        done.set()
+
+    try:
+        b.udp.registerUDPPort(FLOOD_PORT,onDatagram)
+        for i in range(3000):
+            a.udp.sendUDPDatagram(b'x'*64,FLOOD_PORT,NETWORK + 2)
+            if done.is_set():
+                break
+        assert done.wait(b.arp.ARP_TIMEOUT*b.arp.ARP_RETRIES + 1)
+        assert result['mac'] == c.ethernet.macAddress
+        assert result['elapsed'] < b.arp.ARP_TIMEOUT
+        assert b.arp.cache.lookup(NETWORK + 3)[0] == b.arp.CACHE_FRESH
+    finally:
+        for stack in stacks:
+            stack.ethernet.stopEthernetLevel()
@@ -0,0 +1,82 @@
+'''
+    test_rc1_pcap.py
+    Pruebas de lectura y escritura de trazas pcap con resolución de microsegundos y de nanosegundos (PcapFileWriter,
+    PcapFileReader y packets). No necesitan una interfaz de red, pero rc1_pcap carga libpcap al importarse.
+'''
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from rc1_pcap import *
+except OSError:
+    pytest.skip('libpcap no disponible',allow_module_level=True)
+
+
+FRAMES = [bytes([0x02,0x00,0x00,0x00,0x00,0x01]) + bytes(8) + bytes([i])*(40 + i) for i in range(5)]
+TIMESTAMPS = [(1700000000 + i,i*111111111 + 7) for i in range(5)]
+
+
+def writeTrace(fname,nano):
+    writer = PcapFileWriter(fname,nano=nano)
+    for frame,(sec,nsec) in zip(FRAMES,TIMESTAMPS):
+        writer.dump(pcap_pkthdr(len(frame),len(frame),timeval(sec,tv_nsec=nsec)),frame)
+    writer.close()
+
+
+def readTrace(fname):
+    reader = PcapFileReader(fname)
+    try:
+        return reader.nano,[(header.ts.tv_sec,header.ts.tv_nsec,header.len,frame.tobytes()) for header,frame in packets(reader)]
+    finally:
+        reader.close()
+
+
+def test_nanosecond_trace_roundtrip(tmp_path):
+    fname = str(tmp_path / 'nano.pcap')
+    writeTrace(fname,True)
+    nano,records = readTrace(fname)
+    assert nano
+    assert [(sec,nsec) for sec,nsec,_,_ in records] == TIMESTAMPS
+    assert [frame for _,_,_,frame in records] == FRAMES
+    assert [wirelen for _,_,wirelen,_ in records] == [len(frame) for frame in FRAMES]
+
+
+def test_microsecond_trace_scaled(tmp_path):
+    fname = str(tmp_path / 'micro.pcap')
+    writeTrace(fname,False)
+    nano,records = readTrace(fname)
+    assert not nano
+    #El fichero guarda microsegundos: al leerlo tv_nsec es tv_usec*1000
+    assert [(sec,nsec) for sec,nsec,_,_ in records] == [(sec,(nsec // 1000)*1000) for sec,nsec in TIMESTAMPS]
+    assert [frame for _,_,_,frame in records] == FRAMES
+
+
+def test_timeval_usec_compat():
+    ts = timeval(3,250)
+    assert ts.tv_nsec == 250000
+    ts.tv_usec = 7
+    assert (ts.tv_usec,ts.tv_nsec,ts.ns()) == (7,7000,3000007000)
+    assert timeval(1,tv_nsec=1999).tv_usec == 1
+
+
+def test_packets_copy_and_release(tmp_path):
+    fname = str(tmp_path / 'nano.pcap')
+    writeTrace(fname,True)
+    reader = PcapFileReader(fname)
+    stream = packets(reader,2)
+    kept = []
+    views = []
+    for header,frame in stream:
+        assert frame.readonly
+        kept.append(stream.copy())
+        views.append(frame)
+    assert [frame for _,frame in kept] == FRAMES[:2]
+    #Los memoryview se liberan al avanzar
+    with pytest.raises(ValueError):
+        views[0][0]
+    reader.close()
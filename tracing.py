@@ -0,0 +1,172 @@
+'''
+    tracing.py
+    Trazas de la pila por nivel (eth, arp, ip, icmp, udp) que no cuestan nada cuando están desactivadas.
+    Cada nivel tiene un Tracer con atributos booleanos precalculados (error, info, debug), de modo que en el camino
+    de cada paquete la comprobación es una lectura de atributo:
+
+        if ipTrace.debug:
+            ipTrace.log(TRACE_DEBUG,'[process_IP_datagram] {} bytes de {}',length,ipOrigen)
+
+    El mensaje se formatea de forma perezosa: con la salida 'ring' se guardan el formato y los argumentos en un buffer
+    circular en memoria y solo se formatean al volcarlo con dumpTrace, sin escribir nada mientras se procesa el tráfico.
+    Los argumentos se guardan tal cual, por lo que no se deben pasar buffers que se vayan a reutilizar.
+    Los niveles iniciales se leen de la variable de entorno RC1_TRACE, por ejemplo RC1_TRACE=debug o
+    RC1_TRACE=info,ip=debug,arp=off.
+'''
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+TRACE_OFF = 0
+TRACE_ERROR = 1
+TRACE_INFO = 2
+TRACE_DEBUG = 3
+
+TRACE_LEVELS = {'off':TRACE_OFF,'error':TRACE_ERROR,'info':TRACE_INFO,'debug':TRACE_DEBUG}
+TRACE_LAYERS = ['eth','arp','ip','icmp','udp']
+TRACE_DEFAULT_LEVEL = TRACE_INFO
+TRACE_RING_SIZE = 65536
+
+tracers = {}
+#Salida actual: 'stdout' (print inmediato), 'logging' (módulo logging) o 'ring' (buffer circular en memoria)
+traceSink = 'stdout'
+traceRing = collections.deque(maxlen=TRACE_RING_SIZE)
+traceLock = threading.Lock()
+
+
+class Tracer():
+    '''
+        Trazas de un nivel de la pila. Los atributos error, info y debug indican si está activo cada nivel de traza
+        y se recalculan con setLevel.
+    '''
+    __slots__ = ('layer','level','error','info','debug')
+
+    def __init__(self,layer,level=TRACE_DEFAULT_LEVEL):
+        self.layer = layer
+        self.setLevel(level)
+
+    def setLevel(self,level):
+        self.level = level
+        self.error = level >= TRACE_ERROR
+        self.info = level >= TRACE_INFO
+        self.debug = level >= TRACE_DEBUG
+
+    def log(self,level,fmt,*args):
+        '''
+            Emite una traza. fmt es una cadena de str.format que solo se formatea cuando hace falta
+        '''
+        if level > self.level:
+            return
+        if traceSink == 'ring':
+            traceRing.append((time.time(),self.layer,level,fmt,args))
+        elif traceSink == 'logging':
+            logging.log(logging.DEBUG if level >= TRACE_DEBUG else logging.INFO if level == TRACE_INFO else logging.ERROR,
+                '[%s] %s',self.layer,LazyFormat(fmt,args))
+        else:
+            print(fmt.format(*args) if args else fmt)
+
+
+class LazyFormat():
+    #Se formatea solo si logging llega a escribir el mensaje
+    __slots__ = ('fmt','args')
+
+    def __init__(self,fmt,args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args) if self.args else self.fmt
+
+
+def parseLevels(spec):
+    #Convierte 'info,ip=debug' en {None: TRACE_INFO, 'ip': TRACE_DEBUG}
+    levels = {}
+    for item in spec.split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        layer,sep,name = item.rpartition('=')
+        if name not in TRACE_LEVELS:
+            continue
+        levels[layer if sep else None] = TRACE_LEVELS[name]
+    return levels
+
+
+envLevels = parseLevels(os.environ.get('RC1_TRACE',''))
+
+
+def getTracer(layer):
+    '''
+        Nombre: getTracer
+        Descripción: Esta función devuelve el Tracer de un nivel de la pila (lo crea la primera vez)
+        Argumentos:
+            -layer: nombre del nivel ('eth', 'arp', 'ip', 'icmp', 'udp', ...)
+        Retorno: Tracer del nivel
+    '''
+    with traceLock:
+        tracer = tracers.get(layer)
+        if tracer is None:
+            tracer = Tracer(layer,envLevels.get(layer,envLevels.get(None,TRACE_DEFAULT_LEVEL)))
+            tracers[layer] = tracer
+    return tracer
+
+
+def setTraceLevel(layer,level):
+    '''
+        Nombre: setTraceLevel
+        Descripción: Esta función cambia el nivel de traza de un nivel de la pila o de todos
+        Argumentos:
+            -layer: nombre del nivel o None para todos
+            -level: TRACE_OFF, TRACE_ERROR, TRACE_INFO, TRACE_DEBUG o su nombre ('off', 'error', 'info', 'debug')
+        Retorno: Ninguno
+    '''
+    if isinstance(level,str):
+        level = TRACE_LEVELS[level.lower()]
+    if layer is None:
+        for name in TRACE_LAYERS:
+            getTracer(name)
+        for tracer in list(tracers.values()):
+            tracer.setLevel(level)
+    else:
+        getTracer(layer).setLevel(level)
+
+
+def setTraceSink(sink,size=TRACE_RING_SIZE):
+    '''
+        Nombre: setTraceSink
+        Descripción: Esta función selecciona la salida de las trazas
+        Argumentos:
+            -sink: 'stdout', 'logging' o 'ring'
+            -size: número de trazas que guarda el buffer circular (solo para 'ring')
+        Retorno: Ninguno
+    '''
+    global traceSink,traceRing
+    if sink not in ('stdout','logging','ring'):
+        raise ValueError('Salida de trazas desconocida: {}'.format(sink))
+    if sink == 'ring' and traceRing.maxlen != size:
+        traceRing = collections.deque(traceRing,maxlen=size)
+    traceSink = sink
+
+
+def dumpTrace(f=None,clear=True):
+    '''
+        Nombre: dumpTrace
+        Descripción: Esta función formatea y escribe las trazas guardadas en el buffer circular
+        Argumentos:
+            -f: fichero donde escribir (por defecto la salida estándar)
+            -clear: si es True se vacía el buffer
+        Retorno: Número de trazas escritas
+    '''
+    if f is None:
+        f = sys.stdout
+    names = {v:k for k,v in TRACE_LEVELS.items()}
+    entries = list(traceRing)
+    if clear:
+        traceRing.clear()
+    for ts,layer,level,fmt,args in entries:
+        f.write('{:.6f} {:<4} {:<5} {}\n'.format(ts,layer,names[level],fmt.format(*args) if args else fmt))
+    return len(entries)
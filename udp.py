@@ -1,24 +1,216 @@
 from ip import *
+from collections import deque
+from threading import Lock,Condition
+import random
 import struct
 
+udpTrace = getTracer('udp')
+
 UDP_HLEN = 8
 UDP_PROTO = 17
+#Número máximo de datagramas encolados por defecto en un endpoint
+UDP_DEFAULT_QUEUE = 4096
+#Rango de puertos efímeros (RFC 6335) y número máximo de flujos con puerto origen propio en sendUDPDatagram
+EPHEMERAL_PORT_MIN = 49152
+EPHEMERAL_PORT_MAX = 65535
+MAX_FLOW_PORTS = 1024
+
+#Funciones a llamar con los datagramas recibidos (registerUDPPort), indexadas por puerto. Se protege con endpointLock
+udpPortCallbacks = {}
+#Endpoints ligados a un puerto local (bindUDPEndpoint), indexados por puerto destino. Se protege con endpointLock
+udpEndpoints = {}
+endpointLock = Lock()
+#Contadores del nivel UDP
+udpCounters = counters.getCounters('udp',('rx_datagrams','rx_malformed','rx_no_port','rx_delivered','tx_datagrams'))
+
+
+class UDPPortAllocator():
+    '''
+        Asignador de puertos UDP locales. Un mapa de bits indica qué puertos están ocupados y una lista libre (en orden
+        aleatorio) da los puertos efímeros, de modo que allocate y release son O(1) y no hacen llamadas al sistema.
+        Los puertos fijos (reserve) se marcan en el mapa y se saltan al sacarlos de la lista libre. Otro mapa (queued)
+        indica qué puertos están en la lista libre, para no añadir dos veces el mismo al liberarlo.
+    '''
+    def __init__(self,low=EPHEMERAL_PORT_MIN,high=EPHEMERAL_PORT_MAX):
+        self.low = low
+        self.high = high
+        self.lock = Lock()
+        self.used = bytearray(65536)
+        ports = list(range(low,high+1))
+        random.shuffle(ports)
+        self.free = deque(ports)
+        self.queued = bytearray(65536)
+        self.queued[low:high+1] = bytes([1])*(high - low + 1)
+        self.inUse = 0
+
+    def allocate(self):
+        '''
+            Devuelve un puerto efímero libre o None si están todos ocupados
+        '''
+        with self.lock:
+            free = self.free
+            used = self.used
+            while free:
+                port = free.popleft()
+                self.queued[port] = 0
+                if not used[port]:
+                    used[port] = 1
+                    self.inUse += 1
+                    return port
+            return None
+
+    def reserve(self,port):
+        '''
+            Marca como ocupado un puerto concreto. Devuelve False si ya lo estaba
+        '''
+        with self.lock:
+            if self.used[port]:
+                return False
+            self.used[port] = 1
+            self.inUse += 1
+            return True
+
+    def release(self,port):
+        with self.lock:
+            if not self.used[port]:
+                return
+            self.used[port] = 0
+            self.inUse -= 1
+            #Los efímeros vuelven al final de la lista para tardar en reutilizarse
+            if self.low <= port <= self.high and not self.queued[port]:
+                self.queued[port] = 1
+                self.free.append(port)
+
+    def stats(self):
+        return {'inUse':self.inUse,'free':self.high - self.low + 1 - sum(self.used[self.low:self.high+1])}
+
+
+portAllocator = UDPPortAllocator()
+#Puerto origen estable de cada flujo (IP destino, puerto destino) de sendUDPDatagram, en orden de creación
+flowPorts = {}
+flowLock = Lock()
+
+
+class UDPEndpoint():
+    '''
+        Endpoint UDP ligado a un puerto local. Los datagramas recibidos se guardan en una cola acotada (maxQueue); los que
+        llegan con la cola llena se descartan y se cuentan en dropped. Se leen de uno en uno con recv o por lotes con
+        recv_many, que devuelve todos los disponibles (hasta maxcount) con una sola adquisición del cerrojo.
+        Los datos de cada datagrama son un memoryview sobre el paquete recibido, que se mantiene en memoria hasta que se
+        liberan.
+    '''
+    def __init__(self,port,maxQueue=UDP_DEFAULT_QUEUE):
+        self.port = port
+        self.maxQueue = maxQueue
+        self.queue = deque()
+        self.cond = Condition(Lock())
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def deliver(self,srcIP,srcPort,data):
+        #Se llama desde los hilos de procesamiento de tramas
+        with self.cond:
+            if len(self.queue) >= self.maxQueue:
+                self.dropped += 1
+                return
+            self.queue.append((srcIP,srcPort,data))
+            self.received += 1
+            if len(self.queue) == 1:
+                self.cond.notify()
+
+    def recv(self,timeout=None):
+        '''
+            Devuelve una tupla (IP origen, puerto origen, datos) con el siguiente datagrama recibido o None si se
+            agota el timeout (segundos; None espera indefinidamente) o se cierra el endpoint
+        '''
+        datagrams = self.recv_many(1,timeout)
+        return datagrams[0] if datagrams else None
+
+    def recv_many(self,maxcount=64,timeout=None):
+        '''
+            Devuelve una lista con hasta maxcount tuplas (IP origen, puerto origen, datos). Solo espera (como mucho
+            timeout segundos) si la cola está vacía; la lista está vacía si se agota el timeout o se cierra el endpoint
+        '''
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait_for(lambda: self.queue or self.closed,timeout)
+            queue = self.queue
+            n = min(maxcount,len(queue))
+            return [queue.popleft() for i in range(n)]
+
+    def pending(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {'port':self.port,'queued':len(self.queue),'received':self.received,'dropped':self.dropped}
+
+    def sendto(self,data,dstIP,dstPort):
+        '''
+            Envía data a dstIP:dstPort usando como puerto origen el puerto del endpoint
+        '''
+        if not sendIPDatagram(dstIP,buildUDPDatagram(data,self.port,dstPort),UDP_PROTO):
+            return False
+        udpCounters.inc('tx_datagrams')
+        return True
+
+    def close(self):
+        with endpointLock:
+            if udpEndpoints.get(self.port) is self:
+                del udpEndpoints[self.port]
+                portAllocator.release(self.port)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
 
 def getUDPSourcePort():
     '''
         Nombre: getUDPSourcePort
-        Descripción: Esta función obtiene un puerto origen libre en la máquina actual.
+        Descripción: Esta función obtiene un puerto origen libre del asignador de la pila. El puerto queda ocupado
+        hasta que se libere con releaseUDPSourcePort.
         Argumentos:
             -Ninguno
-        Retorno: Entero de 16 bits con el número de puerto origen disponible
+        Retorno: Entero de 16 bits con el número de puerto origen disponible o None si no quedan puertos
 
     '''
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind(('', 0))
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    portNum =  s.getsockname()[1]
-    s.close()
-    return portNum
+    return portAllocator.allocate()
+
+def releaseUDPSourcePort(port):
+    '''
+        Nombre: releaseUDPSourcePort
+        Descripción: Esta función devuelve al asignador un puerto obtenido con getUDPSourcePort
+        Argumentos:
+            -port: entero de 16 bits con el puerto a liberar
+        Retorno: Ninguno
+    '''
+    portAllocator.release(port)
+
+def getFlowSourcePort(dstIP,dstPort):
+    '''
+        Nombre: getFlowSourcePort
+        Descripción: Esta función devuelve el puerto origen de un flujo (IP destino, puerto destino). La primera vez se
+        asigna uno nuevo y después se reutiliza, de modo que todos los datagramas del flujo salen por el mismo puerto.
+        Si hay más de MAX_FLOW_PORTS flujos se libera el puerto del más antiguo.
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino
+            -dstPort: entero de 16 bits con el puerto destino
+        Retorno: Entero de 16 bits con el puerto origen o None si no quedan puertos
+    '''
+    key = (dstIP,dstPort)
+    port = flowPorts.get(key)
+    if port is not None:
+        return port
+    with flowLock:
+        port = flowPorts.get(key)
+        if port is not None:
+            return port
+        if len(flowPorts) >= MAX_FLOW_PORTS:
+            oldest = next(iter(flowPorts))
+            portAllocator.release(flowPorts.pop(oldest))
+        port = portAllocator.allocate()
+        if port is not None:
+            flowPorts[key] = port
+    return port
 
 def process_UDP_datagram(us,header,data,srcIP):
     '''
@@ -27,10 +219,12 @@ def process_UDP_datagram(us,header,data,srcIP):
         un 17 en el campo protocolo de IP
         Esta función debe realizar, al menos, las siguientes tareas:
             -Extraer los campos de la cabecera UDP
-            -Loggear (usando logging.debug) los siguientes campos:
+            -Loggear (con una traza de nivel TRACE_DEBUG de udpTrace) los siguientes campos:
                 -Puerto origen
                 -Puerto destino
                 -Datos contenidos en el datagrama UDP
+            -Si hay un endpoint ligado al puerto destino (bindUDPEndpoint) encolar en él la IP y el puerto origen y
+            los datos; si no, si hay una función registrada para el puerto destino (registerUDPPort) llamarla con ellos
 
         Argumentos:
             -us: son los datos de usuarios pasados por pcap_loop (en nuestro caso este valor será siempre None)
@@ -41,15 +235,116 @@ def process_UDP_datagram(us,header,data,srcIP):
 
     '''
     #HACER
-    print("[process_UDP_message] RECEIVED", data)
-    puertoOrigen = bytes(data[0:2])
-    puertoDestino = bytes(data[2:4])
-    datos = bytes(data[8:])
-    logging.debug(puertoOrigen)
-    logging.debug(puertoDestino)
-    logging.debug(datos)
+    datagram = UDPView(data)
+    if not datagram.valid():
+        udpCounters.inc('rx_malformed')
+        return
+    puertoOrigen,puertoDestino,longitud,checksum = datagram.fields()
+    #Los datos son un memoryview sobre el paquete recibido: se entregan sin copiarlos
+    datos = datagram.buf[UDP_HLEN:longitud]
+    udpCounters.inc('rx_datagrams')
+    if udpTrace.debug:
+        udpTrace.log(TRACE_DEBUG,'[process_UDP_datagram] {} -> {} {}',puertoOrigen,puertoDestino,bytes(datos))
 
-    return
+    endpoint = udpEndpoints.get(puertoDestino)
+    if endpoint is not None:
+        endpoint.deliver(struct.unpack('!I', srcIP)[0], puertoOrigen, datos)
+        udpCounters.inc('rx_delivered')
+        return
+    callback = udpPortCallbacks.get(puertoDestino)
+    if callback is not None:
+        callback(struct.unpack('!I', srcIP)[0], puertoOrigen, datos)
+        udpCounters.inc('rx_delivered')
+        return
+    udpCounters.inc('rx_no_port')
+
+def registerUDPPort(port,callback):
+    '''
+        Nombre: registerUDPPort
+        Descripción: Esta función registra una función a la que se llamará con cada datagrama UDP recibido en un puerto.
+        El puerto se reserva en el asignador de la pila (no se puede registrar un puerto ocupado por un endpoint o usado
+        como puerto origen, ni uno ya registrado) hasta que se elimine el registro. Si callback es None se elimina el
+        registro y se libera el puerto.
+        Argumentos:
+            -port: entero de 16 bits con el puerto destino (si es None se asigna un puerto efímero)
+            -callback: función que recibe (srcIP, srcPort, data) con la IP origen (entero de 32 bits), el puerto
+            origen y los datos del datagrama (memoryview sobre el paquete recibido; bytes(data) para guardar una copia)
+        Retorno: Entero de 16 bits con el puerto registrado o None si el puerto ya está en uso (o si se elimina el registro)
+    '''
+    with endpointLock:
+        if callback is None:
+            if udpPortCallbacks.pop(port,None) is not None:
+                portAllocator.release(port)
+            return None
+        if port is None:
+            port = portAllocator.allocate()
+            if port is None:
+                logging.error('[registerUDPPort] No quedan puertos efímeros libres')
+                return None
+        elif port in udpPortCallbacks or port in udpEndpoints or not portAllocator.reserve(port):
+            logging.error('[registerUDPPort] El puerto {} ya está en uso'.format(port))
+            return None
+        udpPortCallbacks[port] = callback
+    return port
+
+def bindUDPEndpoint(port=None,maxQueue=UDP_DEFAULT_QUEUE):
+    '''
+        Nombre: bindUDPEndpoint
+        Descripción: Esta función crea un endpoint UDP ligado a un puerto local. El puerto se libera al cerrar el endpoint.
+        Argumentos:
+            -port: entero de 16 bits con el puerto local (si es None se asigna un puerto efímero)
+            -maxQueue: número máximo de datagramas encolados en el endpoint
+        Retorno: UDPEndpoint o None si el puerto ya está en uso
+    '''
+    with endpointLock:
+        if port is None:
+            port = portAllocator.allocate()
+            if port is None:
+                logging.error('[bindUDPEndpoint] No quedan puertos efímeros libres')
+                return None
+        elif port in udpPortCallbacks or not portAllocator.reserve(port):
+            logging.error('[bindUDPEndpoint] El puerto {} ya está en uso'.format(port))
+            return None
+        endpoint = UDPEndpoint(port,maxQueue)
+        udpEndpoints[port] = endpoint
+    return endpoint
+
+def endpointStats():
+    #Suma de los contadores de todos los endpoints ligados
+    endpoints = list(udpEndpoints.values())
+    return {'bound':len(endpoints),'queued':sum(e.pending() for e in endpoints),'received':sum(e.received for e in endpoints),
+        'dropped':sum(e.dropped for e in endpoints)}
+
+counters.registerCollector('udp_endpoints',endpointStats)
+
+def printUDPEndpoints():
+    '''
+        Nombre: printUDPEndpoints
+        Descripción: Esta función imprime los endpoints UDP ligados y sus contadores
+        Argumentos: Ninguno
+        Retorno: Ninguno
+    '''
+    print('{:>6}\t{:>8}\t{:>10}\t{:>10}'.format('Puerto','En cola','Recibidos','Descartados'))
+    for port,endpoint in sorted(udpEndpoints.items()):
+        print('{:>6}\t{:>8}\t{:>10}\t{:>10}'.format(port,endpoint.pending(),endpoint.received,endpoint.dropped))
+
+def buildUDPDatagram(data,srcPort,dstPort):
+    '''
+        Nombre: buildUDPDatagram
+        Descripción: Esta función construye un datagrama UDP (cabecera con checksum a 0 y datos) sin enviarlo
+        Argumentos:
+            -data: array de bytes con los datos a incluir como payload en el datagrama UDP
+            -srcPort: entero de 16 bits con el puerto origen
+            -dstPort: entero de 16 bits con el puerto destino
+        Retorno: Bytes con el datagrama UDP
+    '''
+    datagram = bytes()
+    datagram += struct.pack('!H', srcPort)
+    datagram += struct.pack('!H', dstPort)
+    datagram += struct.pack('!H', UDP_HLEN + len(data))
+    datagram += bytes([0x00,0x00]) #checksum always 0
+    datagram += data
+    return datagram
 
 def sendUDPDatagram(data,dstPort,dstIP):
     '''
@@ -57,7 +352,7 @@ def sendUDPDatagram(data,dstPort,dstIP):
         Descripción: Esta función construye un datagrama UDP y lo envía
         Esta función debe realizar, al menos, las siguientes tareas:
             -Construir la cabecera UDP:
-                -El puerto origen lo obtendremos llamando a getUDPSourcePort
+                -El puerto origen lo obtendremos llamando a getFlowSourcePort (el mismo para todo el flujo)
                 -El valor de checksum lo pondremos siempre a 0
             -Añadir los datos
             -Enviar el datagrama resultante llamando a sendIPDatagram
@@ -70,15 +365,17 @@ def sendUDPDatagram(data,dstPort,dstIP):
 
     '''
     #HACER
-    datagram = bytes()
-    datagram += struct.pack('!H', getUDPSourcePort())
-    datagram += struct.pack('!H', dstPort)
-    datagram += struct.pack('!H', UDP_HLEN + len(data))
-    datagram += bytes([0x00,0x00]) #checksum always 0
-    datagram += data
-    print("[sendICMPMessage] Sending datagram", datagram, "to", '{:12}'.format(socket.inet_ntoa(struct.pack('!I',dstIP))))
+    srcPort = getFlowSourcePort(dstIP, dstPort)
+    if srcPort is None:
+        return False
+    datagram = buildUDPDatagram(data, srcPort, dstPort)
+    if udpTrace.debug:
+        udpTrace.log(TRACE_DEBUG,"[sendUDPDatagram] Sending {} bytes from port {} to {}:{}",len(data),srcPort,socket.inet_ntoa(struct.pack('!I',dstIP)),dstPort)
 
-    sendIPDatagram(dstIP, datagram, UDP_PROTO)
+    if not sendIPDatagram(dstIP, datagram, UDP_PROTO):
+        return False
+    udpCounters.inc('tx_datagrams')
+    return True
 
 
 def initUDP():
@@ -95,5 +392,5 @@ def initUDP():
     '''
     #HACER
     registerIPProtocol(process_UDP_datagram, UDP_PROTO) #Mandar el proto en bytes?
-    print("[initUDP] UDP initialized succesfully")
+    udpTrace.log(TRACE_INFO,"[initUDP] UDP initialized succesfully")
     return
@@ -0,0 +1,254 @@
+'''
+    views.py
+    Vistas de las cabeceras de los paquetes recibidos. Cada vista envuelve un memoryview sobre la trama y decodifica
+    los campos de forma perezosa con struct.unpack_from solo cuando se leen, sin copiar nada. Los payloads (atributo
+    payload) son a su vez memoryview sobre la misma trama, de modo que cada nivel entrega al siguiente una vista y no
+    una copia: una trama recibida se copia una sola vez (al sacarla de pcap) hasta llegar a ICMP o UDP.
+    Los memoryview mantienen viva la trama completa mientras alguien los referencie; para guardar unos datos más allá
+    del procesamiento del paquete se copian con bytes().
+'''
+
+import struct
+
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+IP_FIXED_HEADER = struct.Struct('!BBHHHBBHII')
+ICMP_ECHO_HEADER = struct.Struct('!BBHHH')
+UDP_HEADER = struct.Struct('!HHHH')
+
+
+class PacketView():
+    '''
+        Vista genérica sobre un buffer (bytes, bytearray o memoryview). HLEN es la longitud mínima de la cabecera
+    '''
+    __slots__ = ('buf',)
+    HLEN = 0
+
+    def __init__(self,buf):
+        self.buf = buf if type(buf) is memoryview else memoryview(buf)
+
+    def __len__(self):
+        return len(self.buf)
+
+    def valid(self):
+        return len(self.buf) >= self.HLEN
+
+    @property
+    def payload(self):
+        return self.buf[self.HLEN:]
+
+    def tobytes(self):
+        return self.buf.tobytes()
+
+
+class EthernetView(PacketView):
+    __slots__ = ()
+    HLEN = 14
+
+    @property
+    def dst(self):
+        return self.buf[0:6]
+
+    @property
+    def src(self):
+        return self.buf[6:12]
+
+    @property
+    def ethertype(self):
+        return UINT16.unpack_from(self.buf,12)[0]
+
+
+class ARPView(PacketView):
+    '''
+        Mensaje ARP Ethernet/IPv4: cabecera común de 6 bytes, opcode y direcciones del emisor y del destinatario
+    '''
+    __slots__ = ()
+    HLEN = 28
+
+    @property
+    def common(self):
+        return self.buf[0:6]
+
+    @property
+    def opcode(self):
+        return UINT16.unpack_from(self.buf,6)[0]
+
+    @property
+    def senderMac(self):
+        return self.buf[8:14]
+
+    @property
+    def senderIP(self):
+        return UINT32.unpack_from(self.buf,14)[0]
+
+    @property
+    def targetMac(self):
+        return self.buf[18:24]
+
+    @property
+    def targetIP(self):
+        return UINT32.unpack_from(self.buf,24)[0]
+
+    @property
+    def addresses(self):
+        #Direcciones del mensaje sin la cabecera común ni el opcode
+        return self.buf[8:28]
+
+
+class IPView(PacketView):
+    '''
+        Datagrama IPv4. ihl y offset están en bytes; src y dst son enteros de 32 bits (srcBytes y dstBytes son las
+        mismas direcciones como vistas de 4 bytes). payload excluye la cabecera y el relleno posterior a totalLength.
+    '''
+    __slots__ = ()
+    HLEN = 20
+
+    def valid(self):
+        n = len(self.buf)
+        if n < 20:
+            return False
+        ihl = (self.buf[0] & 0x0F)*4
+        return 20 <= ihl <= UINT16.unpack_from(self.buf,2)[0] <= n
+
+    def fields(self):
+        '''
+            Decodifica de una vez la cabecera fija: (version/ihl, tos, totalLength, ipid, flags/offset, ttl, protocol,
+            checksum, src, dst)
+        '''
+        return IP_FIXED_HEADER.unpack_from(self.buf,0)
+
+    @property
+    def version(self):
+        return self.buf[0] >> 4
+
+    @property
+    def ihl(self):
+        return (self.buf[0] & 0x0F)*4
+
+    @property
+    def tos(self):
+        return self.buf[1]
+
+    @property
+    def totalLength(self):
+        return UINT16.unpack_from(self.buf,2)[0]
+
+    @property
+    def ipid(self):
+        return UINT16.unpack_from(self.buf,4)[0]
+
+    @property
+    def df(self):
+        return (self.buf[6] >> 6) & 0x01
+
+    @property
+    def mf(self):
+        return (self.buf[6] >> 5) & 0x01
+
+    @property
+    def offset(self):
+        return (UINT16.unpack_from(self.buf,6)[0] & 0x1FFF)*8
+
+    @property
+    def ttl(self):
+        return self.buf[8]
+
+    @property
+    def protocol(self):
+        return self.buf[9]
+
+    @property
+    def checksum(self):
+        return UINT16.unpack_from(self.buf,10)[0]
+
+    @property
+    def src(self):
+        return UINT32.unpack_from(self.buf,12)[0]
+
+    @property
+    def dst(self):
+        return UINT32.unpack_from(self.buf,16)[0]
+
+    @property
+    def srcBytes(self):
+        return self.buf[12:16]
+
+    @property
+    def dstBytes(self):
+        return self.buf[16:20]
+
+    @property
+    def options(self):
+        return self.buf[20:(self.buf[0] & 0x0F)*4]
+
+    @property
+    def payload(self):
+        return self.buf[(self.buf[0] & 0x0F)*4:UINT16.unpack_from(self.buf,2)[0]]
+
+
+class ICMPView(PacketView):
+    '''
+        Mensaje ICMP. id y seq solo tienen sentido en los mensajes de eco
+    '''
+    __slots__ = ()
+    HLEN = 8
+
+    def fields(self):
+        #(type, code, checksum, id, seq)
+        return ICMP_ECHO_HEADER.unpack_from(self.buf,0)
+
+    @property
+    def type(self):
+        return self.buf[0]
+
+    @property
+    def code(self):
+        return self.buf[1]
+
+    @property
+    def checksum(self):
+        return UINT16.unpack_from(self.buf,2)[0]
+
+    @property
+    def id(self):
+        return UINT16.unpack_from(self.buf,4)[0]
+
+    @property
+    def seq(self):
+        return UINT16.unpack_from(self.buf,6)[0]
+
+
+class UDPView(PacketView):
+    '''
+        Datagrama UDP. payload se limita al campo longitud
+    '''
+    __slots__ = ()
+    HLEN = 8
+
+    def valid(self):
+        n = len(self.buf)
+        return n >= 8 and 8 <= UINT16.unpack_from(self.buf,4)[0] <= n
+
+    def fields(self):
+        #(srcPort, dstPort, length, checksum)
+        return UDP_HEADER.unpack_from(self.buf,0)
+
+    @property
+    def srcPort(self):
+        return UINT16.unpack_from(self.buf,0)[0]
+
+    @property
+    def dstPort(self):
+        return UINT16.unpack_from(self.buf,2)[0]
+
+    @property
+    def length(self):
+        return UINT16.unpack_from(self.buf,4)[0]
+
+    @property
+    def checksum(self):
+        return UINT16.unpack_from(self.buf,6)[0]
+
+    @property
+    def payload(self):
+        return self.buf[8:UINT16.unpack_from(self.buf,4)[0]]